@@ -10,6 +10,11 @@ storage_config = pulumi.Config("storage")
 gsa_email = security_config.get("gcp_ksa_service_account_email")
 gcs_bucket = storage_config.get("bucket_name") or "pubmed-bucket-ac215"
 
+loader_config = pulumi.Config("loader")
+loader_shards = loader_config.get_int("shards") or 4  # parallel restore pods, one backup shard each
+# Snapshot version (or "latest") for the vector-db pod to restore at startup instead of running the loader job
+loader_snapshot = loader_config.get("snapshot")
+
 
 def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
     # Get image references from deploy_images stack
@@ -66,6 +71,17 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
             role="roles/storage.objectViewer",
             member=pulumi.Output.concat("serviceAccount:", gsa_email),
         )
+        # The loader job mirrors its restore checkpoints to gs://<bucket>/restore_checkpoints/
+        gcp.storage.BucketIAMMember(
+            "vector-db-loader-checkpoint-writer",
+            bucket=gcs_bucket,
+            role="roles/storage.objectUser",
+            member=pulumi.Output.concat("serviceAccount:", gsa_email),
+            condition=gcp.storage.BucketIAMMemberConditionArgs(
+                title="restore-checkpoints-only",
+                expression=f'resource.name.startsWith("projects/_/buckets/{gcs_bucket}/objects/restore_checkpoints/")',
+            ),
+        )
 
     # --- Frontend Deployment ---
     # Creates pods running the frontend container on port 3000
@@ -130,6 +146,29 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
         opts=pulumi.ResourceOptions(provider=k8s_provider, depends_on=[frontend_deployment]),
     )
 
+    # Restores a prebuilt Chroma directory snapshot (see models/snapshot.py) into the PVC before ChromaDB starts;
+    # a no-op when the volume already holds that snapshot version.
+    snapshot_init_containers = None
+    if loader_snapshot:
+        snapshot_init_containers = [
+            k8s.core.v1.ContainerArgs(
+                name="restore-snapshot",
+                image=vector_db_cli_tag.apply(lambda tags: tags[0]),
+                env=[
+                    k8s.core.v1.EnvVarArgs(name="GCP_PROJECT", value=project),
+                    k8s.core.v1.EnvVarArgs(name="SNAPSHOT_BUCKET_NAME", value=gcs_bucket),
+                ],
+                volume_mounts=[
+                    k8s.core.v1.VolumeMountArgs(
+                        name="chromadb-storage",
+                        mount_path="/chroma/chroma",
+                    ),
+                ],
+                command=["/bin/sh", "-c"],
+                args=[f"uv run /app/src/snapshot.py restore --dest /chroma/chroma --version {loader_snapshot}"],
+            )
+        ]
+
     # vector-db deployment
     vector_db_deployment = k8s.apps.v1.Deployment(
         "vector-db",
@@ -158,6 +197,9 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
                         run_as_group=1000,
                         fs_group=1000,
                     ),
+                    # GCS access for the snapshot init container
+                    service_account_name=ksa_name if loader_snapshot else None,
+                    init_containers=snapshot_init_containers,
                     containers=[
                         k8s.core.v1.ContainerArgs(
                             name="vector-db",
@@ -240,65 +282,107 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
         opts=pulumi.ResourceOptions(provider=k8s_provider, depends_on=[vector_db_deployment]),
     )
 
-    # Vector DB Loader Job
-    vector_db_loader_job = k8s.batch.v1.Job(
-        "vector-db-loader",
-        metadata=k8s.meta.v1.ObjectMetaArgs(
-            name="vector-db-loader",
-            namespace=namespace.metadata.name,
-        ),
-        spec=k8s.batch.v1.JobSpecArgs(
-            backoff_limit=3,  # Retry up to 4 times on failure
-            template=k8s.core.v1.PodTemplateSpecArgs(
-                spec=k8s.core.v1.PodSpecArgs(
-                    security_context=k8s.core.v1.PodSecurityContextArgs(
-                        run_as_user=1000,
-                        run_as_group=1000,
-                        fs_group=1000,
-                    ),
-                    service_account_name=ksa_name,  # Use Workload Identity for GCP access
-                    restart_policy="Never",  # Don't restart pod on completion
-                    containers=[
-                        k8s.core.v1.ContainerArgs(
-                            name="vector-db-loader",
-                            image=vector_db_cli_tag.apply(lambda tags: tags[0]),
-                            resources=k8s.core.v1.ResourceRequirementsArgs(
-                                requests={"cpu": "500m", "memory": "2Gi"},
-                                limits={"cpu": "1", "memory": "2Gi"},
+    # Vector DB Loader Job (skipped when the vector-db pod restores from a snapshot)
+    api_dependencies = [vector_db_service]
+    if not loader_snapshot:
+        vector_db_loader_job = k8s.batch.v1.Job(
+            "vector-db-loader",
+            metadata=k8s.meta.v1.ObjectMetaArgs(
+                name="vector-db-loader",
+                namespace=namespace.metadata.name,
+            ),
+            spec=k8s.batch.v1.JobSpecArgs(
+                backoff_limit=3,  # Retry up to 4 times on failure
+                # Indexed job: pod i restores shard i/N of the backup, all upserting into the same collection
+                completion_mode="Indexed",
+                completions=loader_shards,
+                parallelism=loader_shards,
+                template=k8s.core.v1.PodTemplateSpecArgs(
+                    spec=k8s.core.v1.PodSpecArgs(
+                        security_context=k8s.core.v1.PodSecurityContextArgs(
+                            run_as_user=1000,
+                            run_as_group=1000,
+                            fs_group=1000,
+                        ),
+                        service_account_name=ksa_name,  # Use Workload Identity for GCP access
+                        restart_policy="Never",  # Don't restart pod on completion
+                        # Local working copy of the checkpoints; the durable copy is in GCS (see below)
+                        volumes=[
+                            k8s.core.v1.VolumeArgs(
+                                name="restore-checkpoints",
+                                empty_dir=k8s.core.v1.EmptyDirVolumeSourceArgs(),
                             ),
-                            env=[
-                                k8s.core.v1.EnvVarArgs(name="GCP_PROJECT", value=project),
-                                k8s.core.v1.EnvVarArgs(
-                                    name="CHROMADB_HOST",
-                                    value="vector-db",
-                                ),
-                                k8s.core.v1.EnvVarArgs(name="CHROMADB_PORT", value="8000"),
-                                k8s.core.v1.EnvVarArgs(
-                                    name="CHROMA_SERVER_HOST",
-                                    value="vector-db",
-                                ),
-                                k8s.core.v1.EnvVarArgs(
-                                    name="CHROMA_SERVER_PORT",
-                                    value="8000",
+                        ],
+                        containers=[
+                            k8s.core.v1.ContainerArgs(
+                                name="vector-db-loader",
+                                image=vector_db_cli_tag.apply(lambda tags: tags[0]),
+                                resources=k8s.core.v1.ResourceRequirementsArgs(
+                                    requests={"cpu": "500m", "memory": "2Gi"},
+                                    limits={"cpu": "1", "memory": "2Gi"},
                                 ),
-                                k8s.core.v1.EnvVarArgs(
-                                    name="CHROMADB_BATCH_SIZE",
-                                    value="200",
-                                ),
-                            ],
-                            # Run the loader via Python so it resolves correctly in the image
-                            command=["/bin/sh", "-c"],
-                            args=["uv run /app/src/jsonl_to_chromadb.py --semantic"],
-                        ),
-                    ],
+                                env=[
+                                    k8s.core.v1.EnvVarArgs(name="GCP_PROJECT", value=project),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="CHROMADB_HOST",
+                                        value="vector-db",
+                                    ),
+                                    k8s.core.v1.EnvVarArgs(name="CHROMADB_PORT", value="8000"),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="CHROMA_SERVER_HOST",
+                                        value="vector-db",
+                                    ),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="CHROMA_SERVER_PORT",
+                                        value="8000",
+                                    ),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="CHROMADB_BATCH_SIZE",
+                                        value="200",
+                                    ),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="RESTORE_CHECKPOINT_DIR",
+                                        value="/restore-checkpoints",
+                                    ),
+                                    # Retried and rescheduled pods of this job share the job UID, so they
+                                    # resume from the shard checkpoints in GCS; a new job starts clean.
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="JOB_UID",
+                                        value_from=k8s.core.v1.EnvVarSourceArgs(
+                                            field_ref=k8s.core.v1.ObjectFieldSelectorArgs(
+                                                field_path="metadata.labels['batch.kubernetes.io/controller-uid']",
+                                            ),
+                                        ),
+                                    ),
+                                    k8s.core.v1.EnvVarArgs(
+                                        name="RESTORE_CHECKPOINT_GCS",
+                                        value=f"gs://{gcs_bucket}/restore_checkpoints/$(JOB_UID)",
+                                    ),
+                                ],
+                                volume_mounts=[
+                                    k8s.core.v1.VolumeMountArgs(
+                                        name="restore-checkpoints",
+                                        mount_path="/restore-checkpoints",
+                                    ),
+                                ],
+                                # Run the loader via Python so it resolves correctly in the image;
+                                # JOB_COMPLETION_INDEX is set by Kubernetes for indexed jobs
+                                command=["/bin/sh", "-c"],
+                                args=[
+                                    f"uv run /app/src/jsonl_to_chromadb.py --semantic "
+                                    f"--shard ${{JOB_COMPLETION_INDEX}}/{loader_shards}"
+                                ],
+                            ),
+                        ],
+                    ),
                 ),
             ),
-        ),
-        opts=pulumi.ResourceOptions(
-            provider=k8s_provider,
-            depends_on=[vector_db_service],
-        ),
-    )
+            opts=pulumi.ResourceOptions(
+                provider=k8s_provider,
+                depends_on=[vector_db_service],
+            ),
+        )
+        api_dependencies = [vector_db_loader_job]
 
     # api_service Deployment
     api_deployment = k8s.apps.v1.Deployment(
@@ -374,7 +458,7 @@ def setup_containers(project, namespace, k8s_provider, ksa_name, app_name):
                 ),
             ),
         ),
-        opts=pulumi.ResourceOptions(provider=k8s_provider, depends_on=[vector_db_loader_job]),
+        opts=pulumi.ResourceOptions(provider=k8s_provider, depends_on=api_dependencies),
     )
 
     # api_service Service
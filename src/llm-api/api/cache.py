@@ -0,0 +1,244 @@
+"""
+Small caches for the RAG API: an in-process LRU with a TTL, optionally backed by a shared second tier
+(SQLite file or a redis-compatible server) so replicas and restarts reuse each other's entries.
+
+Values are JSON-serialisable (embeddings, answers); keys are short strings such as sha256 digests.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Case, surrounding whitespace, repeated spaces and trailing punctuation do not change the query."""
+    return _WHITESPACE.sub(" ", question).strip().casefold().rstrip("?!. ")
+
+
+def cache_key(*parts: Any) -> str:
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe LRU of at most ``max_entries`` items, each expiring ``ttl_seconds`` after it was stored."""
+
+    def __init__(self, max_entries: int, ttl_seconds: float, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[str, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteStore:
+    """
+    Second tier in a SQLite file; several processes on one host (or a shared volume) can use the same file.
+    Expired rows are purged, and the soonest-expiring rows evicted beyond ``max_rows``, at open and then
+    every ``purge_every`` writes.
+    """
+
+    def __init__(
+        self, path: str, ttl_seconds: float, table: str = "cache", max_rows: int = 100_000, purge_every: int = 100
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.table = table
+        self.max_rows = max_rows
+        self.purge_every = purge_every
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+            )
+            self._connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_expires_at ON {table} (expires_at)")
+        self.purge()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def purge(self):
+        with self._lock, self._connection:
+            self._connection.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (time.time(),))
+            excess = self._connection.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0] - self.max_rows
+            if excess > 0:
+                # With one TTL per table the soonest to expire are the oldest entries.
+                self._connection.execute(
+                    f"DELETE FROM {self.table} WHERE key IN "
+                    f"(SELECT key FROM {self.table} ORDER BY expires_at LIMIT ?)",
+                    (excess,),
+                )
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + self.ttl_seconds),
+            )
+            self._writes += 1
+            purge = self._writes % self.purge_every == 0
+        if purge:
+            self.purge()
+
+
+class RedisStore:
+    """Second tier on a redis-compatible server (redis, valkey, memorystore); entries expire server-side."""
+
+    def __init__(self, url: str, ttl_seconds: float, prefix: str = "consult:"):
+        try:
+            import redis
+        except ImportError as exc:
+            raise RuntimeError("A redis cache URL needs the redis package.") from exc
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.2)
+
+    def get(self, key: str) -> Any:
+        value = self._client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, value: Any):
+        self._client.set(self.prefix + key, json.dumps(value), ex=max(1, int(self.ttl_seconds)))
+
+
+class TieredCache:
+    """
+    LRU in front of an optional shared store. Shared hits are copied into the LRU; writes go to both tiers.
+    A failing shared store is treated as a miss so the cache can never fail a request.
+    """
+
+    def __init__(self, local: LRUCache, shared=None):
+        self.local = local
+        self.shared = shared
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.shared_errors = 0
+
+    def get(self, key: str) -> Any:
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception:  # noqa: BLE001 - the shared tier is an optimisation only
+                self.shared_errors += 1
+                value = None
+            if value is not None:
+                self.shared_hits += 1
+                self.local.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self._set_shared(key, value)
+
+    async def aget(self, key: str) -> Any:
+        """``get`` for async handlers: the shared tier (disk or network) is read on a worker thread."""
+        value = self.local.get(key)
+        if value is not None:
+            self.local_hits += 1
+            return value
+        if self.shared is None:
+            self.misses += 1
+            return None
+        # ``get`` re-checks the (still missing) local entry, then the shared tier, and does the counting.
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any):
+        self.local.set(key, value)
+        if self.shared is not None:
+            await asyncio.to_thread(self._set_shared, key, value)
+
+    def _set_shared(self, key: str, value: Any):
+        try:
+            self.shared.set(key, value)
+        except Exception:  # noqa: BLE001
+            self.shared_errors += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.local_hits + self.shared_hits + self.misses
+        return {
+            "lookups": lookups,
+            "local_hits": self.local_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.local_hits + self.shared_hits) / lookups, 4) if lookups else 0.0,
+            "shared_errors": self.shared_errors,
+            "local_entries": len(self.local),
+            "shared_tier": type(self.shared).__name__ if self.shared is not None else None,
+        }
+
+
+def build_cache(
+    max_entries: int,
+    ttl_seconds: float,
+    shared_url: str = "",
+    table: str = "cache",
+    max_shared_entries: int = 100_000,
+) -> TieredCache:
+    """
+    ``shared_url`` picks the second tier: ``redis://``/``rediss://`` URLs use redis, ``sqlite:///path`` or a
+    plain path uses SQLite (bounded to ``max_shared_entries`` rows), and an empty value keeps the cache
+    in-process only. Redis bounds its own size through its eviction policy.
+    """
+    shared: Optional[Any] = None
+    if shared_url.startswith(("redis://", "rediss://", "unix://")):
+        shared = RedisStore(shared_url, ttl_seconds, prefix=f"consult:{table}:")
+    elif shared_url:
+        shared = SqliteStore(
+            shared_url.removeprefix("sqlite:///"), ttl_seconds, table=table, max_rows=max_shared_entries
+        )
+    return TieredCache(LRUCache(max_entries, ttl_seconds), shared)
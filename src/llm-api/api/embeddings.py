@@ -0,0 +1,141 @@
+"""
+Local query-embedding backends, selected with ``EMBEDDING_BACKEND``.
+
+``vertex`` (default) is handled by ``rag_module.generate_query_embedding`` with the shared Gemini client.
+``hash`` and ``onnx`` run in-process so the API can serve a collection built offline by the models ingest.
+Both must produce the same vectors as ``models/src/embedding_backends.py``. The API image is built without the
+models package, so the backends below are a copy of it with the same classes and interface, kept in step by a
+parity test in ``models/tests/unit/test_utils.py``.
+"""
+
+import os
+import re
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from typing import Dict, List, Sequence, Type
+
+import numpy as np
+
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "vertex").strip().lower()
+EMBEDDING_ONNX_MODEL_DIR = os.environ.get("EMBEDDING_ONNX_MODEL_DIR", "")
+EMBEDDING_ONNX_MAX_TOKENS = int(os.environ.get("EMBEDDING_ONNX_MAX_TOKENS", "256"))
+
+_WORD = re.compile(r"\w+")
+
+_backends: Dict[str, "EmbeddingBackend"] = {}
+_backends_lock = threading.Lock()
+
+
+class EmbeddingBackend(ABC):
+    """Turns a list of non-blank texts into one vector of ``dimensionality`` floats per text."""
+
+    name = ""
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str], dimensionality: int, **options) -> List[List[float]]:
+        """``options`` carries backend-specific settings (e.g. retries); backends ignore the ones they do not use."""
+
+
+def hashed_ngram_features(text: str) -> List[str]:
+    """Lower-cased words, word bigrams and character trigrams of ``<word>``, in text order."""
+    words = _WORD.findall(text.lower())
+    features = list(words)
+    features.extend(f"{left} {right}" for left, right in zip(words, words[1:]))
+    for word in words:
+        padded = f"<{word}>"
+        features.extend(padded[i : i + 3] for i in range(len(padded) - 2))
+    return features
+
+
+def hash_embed(texts: Sequence[str], dimensionality: int) -> np.ndarray:
+    """
+    Signed feature hashing: every n-gram adds +-1 to the column ``crc32 % dimensionality`` (sign from the top
+    CRC bit) and rows are L2-normalised. CRC32 keeps vectors identical across processes and machines.
+    """
+    feature_lists = [hashed_ngram_features(text) for text in texts]
+    counts = np.fromiter((len(features) for features in feature_lists), dtype=np.int64, count=len(feature_lists))
+    hashes = np.fromiter(
+        (zlib.crc32(feature.encode()) for features in feature_lists for feature in features),
+        dtype=np.uint64,
+        count=int(counts.sum()),
+    )
+    rows = np.repeat(np.arange(len(feature_lists)), counts)
+    columns = (hashes % np.uint64(dimensionality)).astype(np.int64)
+    signs = np.where(hashes >> np.uint64(31), -1.0, 1.0)
+    vectors = np.bincount(
+        rows * dimensionality + columns, weights=signs, minlength=len(feature_lists) * dimensionality
+    ).reshape(len(feature_lists), dimensionality)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+
+class HashingBackend(EmbeddingBackend):
+    name = "hash"
+
+    def embed(self, texts: Sequence[str], dimensionality: int, **options) -> List[List[float]]:
+        return hash_embed(texts, dimensionality).tolist()
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    Mean-pooled token embeddings of an ONNX sentence encoder. Vectors are cut to the first ``dimensionality``
+    components and re-normalised, which suits Matryoshka-trained models.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model_dir: str = EMBEDDING_ONNX_MODEL_DIR, max_tokens: int = EMBEDDING_ONNX_MAX_TOKENS):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as exc:
+            raise RuntimeError("EMBEDDING_BACKEND=onnx needs the onnxruntime and tokenizers packages.") from exc
+        if not model_dir:
+            raise RuntimeError("Set EMBEDDING_ONNX_MODEL_DIR to a directory with model.onnx and tokenizer.json.")
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=max_tokens)
+        self.tokenizer.enable_padding()
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"), providers=["CPUExecutionProvider"]
+        )
+        self._input_names = {node.name for node in self.session.get_inputs()}
+
+    def embed(self, texts: Sequence[str], dimensionality: int, **options) -> List[List[float]]:
+        encodings = self.tokenizer.encode_batch(list(texts))
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {k: v for k, v in inputs.items() if k in self._input_names})[0]
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1.0)
+        if pooled.shape[1] < dimensionality:
+            raise ValueError(f"ONNX model returns {pooled.shape[1]} dimensions; {dimensionality} were requested.")
+        pooled = pooled[:, :dimensionality]
+        pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled.astype(np.float32).tolist()
+
+
+LOCAL_BACKENDS: Dict[str, Type[EmbeddingBackend]] = {"hash": HashingBackend, "onnx": OnnxBackend}
+
+
+def create_backend(name: str = EMBEDDING_BACKEND) -> EmbeddingBackend:
+    """Instantiate a local backend by name; ``vertex`` is created by ``embedder.get_backend``."""
+    if name not in LOCAL_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {name!r} (expected vertex, {', '.join(LOCAL_BACKENDS)})")
+    return LOCAL_BACKENDS[name]()
+
+
+def get_local_backend(name: str = EMBEDDING_BACKEND) -> EmbeddingBackend:
+    """The shared in-process backend for ``name``, created on first use (loading an ONNX model is slow)."""
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = create_backend(name)
+        return _backends[name]
+
+
+def embed_query(query: str, dimensionality: int, backend: str = EMBEDDING_BACKEND) -> List[float]:
+    return get_local_backend(backend).embed([query], dimensionality)[0]
@@ -1,4 +1,7 @@
+import asyncio
+import math
 import os
+import threading
 from typing import Any, Dict, List, Tuple
 
 import chromadb
@@ -7,6 +10,9 @@ import chromadb
 from google import genai
 from google.genai import types
 
+from .cache import build_cache, cache_key, normalize_question
+from .embeddings import EMBEDDING_BACKEND, embed_query
+
 """
 This is a utility file that contain RAG related functions which will be called in the LLM-api pipeline
 1. Takes a user query as input.
@@ -26,15 +32,33 @@ CHROMADB_COLLECTION = "pubmed_abstract_semantic"
 CHROMADB_TOP_K = int(os.environ.get("CHROMADB_TOP_K", "20"))
 CHROMADB_CANDIDATE_K = int(os.environ.get("CHROMADB_CANDIDATE_K", "20"))
 CHROMADB_FILTERED_TOP_K = int(os.environ.get("CHROMADB_FILTERED_TOP_K", "5"))
+# One long-lived client per process: HTTP keep-alive pool size and how often the collection handle is re-fetched
+CHROMADB_HTTP_MAX_CONNECTIONS = int(os.environ.get("CHROMADB_HTTP_MAX_CONNECTIONS", "32"))
+CHROMADB_HTTP_KEEPALIVE_SECONDS = float(os.environ.get("CHROMADB_HTTP_KEEPALIVE_SECONDS", "120"))
+CHROMADB_REFRESH_SECONDS = float(os.environ.get("CHROMADB_REFRESH_SECONDS", "300"))
+# Filters Chroma cannot evaluate are applied locally; candidates are over-fetched by the observed survival ratio
+CHROMADB_MAX_CANDIDATE_K = int(os.environ.get("CHROMADB_MAX_CANDIDATE_K", "200"))
+CHROMADB_OVERFETCH_ALPHA = float(os.environ.get("CHROMADB_OVERFETCH_ALPHA", "0.2"))
 
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-004")
 EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "256"))
 
+# Query embeddings: in-process LRU with a TTL, plus an optional shared tier (redis:// URL or SQLite path)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "4096"))
+QUERY_EMBEDDING_CACHE_TTL_SECONDS = float(os.environ.get("QUERY_EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+QUERY_EMBEDDING_CACHE_URL = os.environ.get("QUERY_EMBEDDING_CACHE_URL", "")
+
 
 # llm_client = genai.Client(vertexai=True, project=GCP_PROJECT, location=GCP_LOCATION)
 # def get_llm_client(): return genai.Client(vertexai=True, project=GCP_PROJECT, location=GCP_LOCATION)
 
 llm_client = None
+query_embedding_cache = build_cache(
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_EMBEDDING_CACHE_TTL_SECONDS,
+    QUERY_EMBEDDING_CACHE_URL,
+    table="query_embeddings",
+)
 
 
 def get_llm_client():
@@ -44,24 +68,200 @@ def get_llm_client():
     return llm_client
 
 
+def _query_embedding_key(query: str) -> str:
+    # Repeated questions (same text up to case, spacing and trailing punctuation) skip the embedding call.
+    return cache_key(EMBEDDING_BACKEND, EMBEDDING_MODEL, EMBEDDING_DIMENSION, normalize_question(query))
+
+
 # Generate embedding for a query
 def generate_query_embedding(query):
-    llm_client = get_llm_client()
-    kwargs = {"output_dimensionality": EMBEDDING_DIMENSION}
-    response = llm_client.models.embed_content(
-        model=EMBEDDING_MODEL, contents=query, config=types.EmbedContentConfig(**kwargs)
+    key = _query_embedding_key(query)
+    cached = query_embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if EMBEDDING_BACKEND != "vertex":
+        embedding = embed_query(query, EMBEDDING_DIMENSION, backend=EMBEDDING_BACKEND)
+    else:
+        llm_client = get_llm_client()
+        kwargs = {"output_dimensionality": EMBEDDING_DIMENSION}
+        response = llm_client.models.embed_content(
+            model=EMBEDDING_MODEL, contents=query, config=types.EmbedContentConfig(**kwargs)
+        )
+        embedding = list(response.embeddings[0].values)
+    query_embedding_cache.set(key, embedding)
+    return embedding
+
+
+async def agenerate_query_embedding(query):
+    """``generate_query_embedding`` on the event loop, with the async Gemini client."""
+    key = _query_embedding_key(query)
+    cached = await query_embedding_cache.aget(key)
+    if cached is not None:
+        return cached
+
+    if EMBEDDING_BACKEND != "vertex":
+        # Local models are CPU-bound; keep them off the event loop.
+        embedding = await asyncio.to_thread(embed_query, query, EMBEDDING_DIMENSION, backend=EMBEDDING_BACKEND)
+    else:
+        kwargs = {"output_dimensionality": EMBEDDING_DIMENSION}
+        response = await get_llm_client().aio.models.embed_content(
+            model=EMBEDDING_MODEL, contents=query, config=types.EmbedContentConfig(**kwargs)
+        )
+        embedding = list(response.embeddings[0].values)
+    await query_embedding_cache.aset(key, embedding)
+    return embedding
+
+
+def _chroma_settings():
+    return chromadb.Settings(
+        anonymized_telemetry=False,
+        chroma_http_keepalive_secs=CHROMADB_HTTP_KEEPALIVE_SECONDS,
+        chroma_http_max_connections=CHROMADB_HTTP_MAX_CONNECTIONS,
+        chroma_http_max_keepalive_connections=CHROMADB_HTTP_MAX_CONNECTIONS,
     )
-    return response.embeddings[0].values
 
 
-def get_chromadb_collection():
-    # Connect to chroma DB
-    client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
+class ChromaConnection:
+    """
+    Process-wide Chroma client and collection handle. The client keeps a pool of keep-alive HTTP connections,
+    so a request only pays for its query. The handle is re-fetched in the background (e.g. after a snapshot
+    restore recreated the collection) and a failed query reconnects and is retried once.
+    """
+
+    def __init__(self, host: str, port: int, collection_name: str, refresh_seconds: float = CHROMADB_REFRESH_SECONDS):
+        self.host = host
+        self.port = port
+        self.collection_name = collection_name
+        self.refresh_seconds = refresh_seconds
+        self._collection = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher: threading.Thread | None = None
+        self.reconnects = 0
+
+    def _connect(self):
+        client = chromadb.HttpClient(host=self.host, port=self.port, settings=_chroma_settings())
+        return client.get_collection(name=self.collection_name)
+
+    def collection(self):
+        collection = self._collection
+        if collection is None:
+            with self._lock:
+                if self._collection is None:
+                    self._collection = self._connect()
+                collection = self._collection
+        return collection
+
+    def refresh(self):
+        """Re-fetch the handle; the current one stays in use if Chroma cannot be reached."""
+        try:
+            collection = self._connect()
+        except Exception as exc:  # noqa: BLE001 - keep serving with the old handle
+            print(f"Chroma refresh failed, keeping the current handle: {exc!r}")
+            return
+        with self._lock:
+            self._collection = collection
+
+    def query(self, **kwargs) -> Dict[str, Any]:
+        collection = self.collection()
+        try:
+            return collection.query(**kwargs)
+        except Exception:
+            # A dropped connection or a recreated collection: reconnect once, then let errors surface.
+            with self._lock:
+                if self._collection is collection:
+                    self._collection = None
+            self.reconnects += 1
+            return self.collection().query(**kwargs)
+
+    def start(self):
+        """Connect now (failures are retried on first use) and start the background refresh."""
+        try:
+            self.collection()
+        except Exception as exc:  # noqa: BLE001 - the vector DB may come up after the API
+            print(f"Chroma warm-up failed, will connect on first query: {exc!r}")
+        if self._refresher is None and self.refresh_seconds > 0:
+            self._refresher = threading.Thread(target=self._refresh_loop, name="chroma-refresh", daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while not self._stop.wait(self.refresh_seconds):
+            self.refresh()
+
+    def stop(self):
+        self._stop.set()
+
+
+class AsyncChromaConnection:
+    """``ChromaConnection`` for the event loop: one ``AsyncHttpClient`` and collection handle, refreshed by a task."""
+
+    def __init__(self, host: str, port: int, collection_name: str, refresh_seconds: float = CHROMADB_REFRESH_SECONDS):
+        self.host = host
+        self.port = port
+        self.collection_name = collection_name
+        self.refresh_seconds = refresh_seconds
+        self._collection = None
+        self._lock: asyncio.Lock | None = None
+        self._refresher: asyncio.Task | None = None
+        self.reconnects = 0
+
+    async def _connect(self):
+        client = await chromadb.AsyncHttpClient(host=self.host, port=self.port, settings=_chroma_settings())
+        return await client.get_collection(name=self.collection_name)
+
+    async def collection(self):
+        collection = self._collection
+        if collection is None:
+            # Created lazily so the lock belongs to the loop that serves requests.
+            self._lock = self._lock or asyncio.Lock()
+            async with self._lock:
+                if self._collection is None:
+                    self._collection = await self._connect()
+                collection = self._collection
+        return collection
+
+    async def refresh(self):
+        try:
+            self._collection = await self._connect()
+        except Exception as exc:  # noqa: BLE001 - keep serving with the old handle
+            print(f"Chroma refresh failed, keeping the current handle: {exc!r}")
+
+    async def query(self, **kwargs) -> Dict[str, Any]:
+        collection = await self.collection()
+        try:
+            return await collection.query(**kwargs)
+        except Exception:
+            if self._collection is collection:
+                self._collection = None
+            self.reconnects += 1
+            return await (await self.collection()).query(**kwargs)
+
+    async def start(self):
+        try:
+            await self.collection()
+        except Exception as exc:  # noqa: BLE001 - the vector DB may come up after the API
+            print(f"Chroma warm-up failed, will connect on first query: {exc!r}")
+        if self._refresher is None and self.refresh_seconds > 0:
+            self._refresher = asyncio.create_task(self._refresh_loop(), name="chroma-refresh")
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await self.refresh()
+
+    async def stop(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+
+
+chroma = ChromaConnection(CHROMADB_HOST, CHROMADB_PORT, CHROMADB_COLLECTION)
+achroma = AsyncChromaConnection(CHROMADB_HOST, CHROMADB_PORT, CHROMADB_COLLECTION)
 
-    # Get the collection
-    collection = client.get_collection(name=CHROMADB_COLLECTION)
 
-    return collection
+def get_chromadb_collection():
+    return chroma.collection()
 
 
 def _normalize_bool(value: Any) -> bool:
@@ -103,6 +303,67 @@ def _build_metadata_filter(frontend_filters: Dict[str, Any] | None) -> Dict[str,
     return filter_flags
 
 
+# The ingest stores metadata as strings (``str(True)``, ``"1"``); these are the spellings ``_normalize_bool``
+# accepts, so a ``$in`` over them selects exactly what the local check would keep.
+_TRUTHY_STRINGS = ["True", "true", "TRUE", "T", "t", "1", "Yes", "yes", "YES", "Y", "y"]
+_PUSHDOWN_FIELDS = {"top_journal": "is_top_journal", "last_year": "is_last_year", "last_5_years": "is_last_5_years"}
+# Over-fetch a bit beyond the expected need so a slightly unlucky query still fills the result set.
+_OVERFETCH_HEADROOM = 1.5
+
+
+def _build_where_clause(filter_flags: Dict[str, Any]) -> Tuple[Dict[str, Any] | None, Dict[str, Any]]:
+    """
+    Split filter flags into a Chroma ``where`` clause and the flags left for local filtering. "Without
+    disclosures" stays local: it must also keep chunks with no ``coi_flag`` at all, which ``$nin`` would drop.
+    """
+    conditions: List[Dict[str, Any]] = []
+    residual: Dict[str, Any] = {}
+    for flag, value in filter_flags.items():
+        if flag in _PUSHDOWN_FIELDS and value:
+            conditions.append({_PUSHDOWN_FIELDS[flag]: {"$in": _TRUTHY_STRINGS}})
+        elif flag == "coi_required" and value is True:
+            conditions.append({"coi_flag": {"$in": _TRUTHY_STRINGS}})
+        else:
+            residual[flag] = value
+
+    if not conditions:
+        return None, residual
+    return (conditions[0] if len(conditions) == 1 else {"$and": conditions}), residual
+
+
+class SelectivityEstimate:
+    """
+    EWMA, per combination of local-only filters, of the fraction of fetched candidates that survive local
+    filtering and PMID de-duplication. ``candidate_k`` scales the fetch so the expected survivors fill the
+    result set, bounded by ``CHROMADB_CANDIDATE_K`` and ``CHROMADB_MAX_CANDIDATE_K``.
+    """
+
+    def __init__(self, alpha: float, min_k: int, max_k: int):
+        self.alpha = alpha
+        self.min_k = min_k
+        self.max_k = max_k
+        self._ratios: Dict[Any, float] = {}
+        self._lock = threading.Lock()
+
+    def ratio(self, key) -> float:
+        return self._ratios.get(key, 1.0)
+
+    def candidate_k(self, key, final_k: int) -> int:
+        wanted = math.ceil(final_k * _OVERFETCH_HEADROOM / max(self.ratio(key), 1e-3))
+        return max(final_k, self.min_k, min(wanted, self.max_k))
+
+    def observe(self, key, fetched: int, kept: int):
+        if fetched <= 0:
+            return
+        observed = kept / fetched
+        with self._lock:
+            previous = self._ratios.get(key)
+            self._ratios[key] = observed if previous is None else previous + self.alpha * (observed - previous)
+
+
+selectivity = SelectivityEstimate(CHROMADB_OVERFETCH_ALPHA, CHROMADB_CANDIDATE_K, CHROMADB_MAX_CANDIDATE_K)
+
+
 def _metadata_matches_filters(metadata: Dict[str, Any], filters: Dict[str, Any]) -> bool:
     """Return True when a metadata dict satisfies the selected filters."""
     if not filters:
@@ -126,23 +387,30 @@ def _metadata_matches_filters(metadata: Dict[str, Any], filters: Dict[str, Any])
     return True
 
 
-def query_documents(
-    embedded_query, frontend_filters: Dict[str, Any] | None = None, n_results: int | None = None
-) -> List[Dict[str, Any]]:
-    """Query ChromaDB then apply filters locally to reduce load on the DB."""
-    collection = get_chromadb_collection()
+def _prepare_query(
+    embedded_query, frontend_filters: Dict[str, Any] | None, n_results: int | None
+) -> Tuple[Dict[str, Any], Dict[str, Any], tuple, int]:
+    """Chroma query arguments plus what ``_select_results`` needs to finish the query."""
     filter_flags = _build_metadata_filter(frontend_filters)
+    where, residual = _build_where_clause(filter_flags)
+    selectivity_key = tuple(sorted(residual.items()))
     requested_k = n_results or CHROMADB_TOP_K
     final_k = min(requested_k, CHROMADB_FILTERED_TOP_K)
-    candidate_k = max(final_k, CHROMADB_CANDIDATE_K)
+    candidate_k = selectivity.candidate_k(selectivity_key, final_k)
 
     query_kwargs = {
         "query_embeddings": [embedded_query],
         "n_results": candidate_k,
         "include": ["documents", "metadatas", "distances"],
     }
-    results = collection.query(**query_kwargs)
+    if where is not None:
+        query_kwargs["where"] = where
+    return query_kwargs, filter_flags, selectivity_key, final_k
+
 
+def _select_results(
+    results: Dict[str, Any], filter_flags: Dict[str, Any], selectivity_key: tuple, final_k: int
+) -> List[Dict[str, Any]]:
     docs = results.get("documents", [[]])[0]
     metadatas = results.get("metadatas", [[]])[0]
     ids = results.get("ids", [[]])[0]
@@ -159,7 +427,9 @@ def query_documents(
             }
         )
 
+    fetched = len(merged)
     if filter_flags:
+        # Pushed-down flags are re-checked too; it is cheap and guards against metadata written another way.
         merged = [item for item in merged if _metadata_matches_filters(item.get("metadata", {}) or {}, filter_flags)]
 
     deduped: List[Dict[str, Any]] = []
@@ -172,16 +442,48 @@ def query_documents(
         seen_pmids.add(key)
         deduped.append(item)
 
+    selectivity.observe(selectivity_key, fetched, len(deduped))
     return deduped[:final_k]
 
 
+def query_documents(
+    embedded_query, frontend_filters: Dict[str, Any] | None = None, n_results: int | None = None
+) -> List[Dict[str, Any]]:
+    """
+    Query ChromaDB with the filters it can evaluate pushed down as a ``where`` clause, then apply the rest
+    locally. The candidate count adapts to how many results the local filters and de-duplication discard.
+    """
+    query_kwargs, filter_flags, selectivity_key, final_k = _prepare_query(embedded_query, frontend_filters, n_results)
+    return _select_results(chroma.query(**query_kwargs), filter_flags, selectivity_key, final_k)
+
+
+async def aquery_documents(
+    embedded_query, frontend_filters: Dict[str, Any] | None = None, n_results: int | None = None
+) -> List[Dict[str, Any]]:
+    """``query_documents`` through the async Chroma client."""
+    query_kwargs, filter_flags, selectivity_key, final_k = _prepare_query(embedded_query, frontend_filters, n_results)
+    return _select_results(await achroma.query(**query_kwargs), filter_flags, selectivity_key, final_k)
+
+
 def build_context_and_citations(
     question: str, frontend_filters: Dict[str, Any] | None = None
 ) -> Tuple[str, List[Dict[str, Any]]]:
     """Retrieve supporting passages and build a context block plus citation payload."""
     embedded_query = generate_query_embedding(question)
     results = query_documents(embedded_query, frontend_filters=frontend_filters)
+    return _context_and_citations(results)
+
+
+async def abuild_context_and_citations(
+    question: str, frontend_filters: Dict[str, Any] | None = None
+) -> Tuple[str, List[Dict[str, Any]]]:
+    """``build_context_and_citations`` for async handlers: no blocking I/O on the event loop."""
+    embedded_query = await agenerate_query_embedding(question)
+    results = await aquery_documents(embedded_query, frontend_filters=frontend_filters)
+    return _context_and_citations(results)
+
 
+def _context_and_citations(results: List[Dict[str, Any]]) -> Tuple[str, List[Dict[str, Any]]]:
     context_lines: List[str] = []
     citations: List[Dict[str, Any]] = []
 
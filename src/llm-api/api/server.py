@@ -1,6 +1,8 @@
 import json
 import os
-from typing import Generator, Literal
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Literal
 
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,7 +13,8 @@ from pydantic import BaseModel, Field
 from google import genai
 from google.auth import exceptions as google_auth_exceptions
 
-from .rag_module import build_context_and_citations
+from .cache import build_cache, cache_key
+from .rag_module import abuild_context_and_citations, achroma, query_embedding_cache
 
 # GCP_PROJECT = os.environ["GCP_PROJECT"]
 GCP_PROJECT = os.environ.get("GCP_PROJECT", "local-test-project")
@@ -21,6 +24,16 @@ GEMINI_MODEL = os.environ.get(
     "projects/650165561090/locations/us-central1/endpoints/6751272973916700672",
 )
 GEMINI_MODEL = "gemini-2.5-flash"  # for testing
+GEMINI_TEMPERATURE = 0.4
+
+# Answers to repeated requests: in-process LRU with a TTL in front of an on-disk SQLite tier (or a redis:// URL;
+# set ANSWER_CACHE_URL to an empty value for an in-process cache only)
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL_SECONDS = float(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "21600"))
+ANSWER_CACHE_URL = os.environ.get(
+    "ANSWER_CACHE_URL", os.path.join(tempfile.gettempdir(), "consult-cache", "answers.sqlite3")
+)
+ANSWER_CACHE_MAX_ROWS = int(os.environ.get("ANSWER_CACHE_MAX_ROWS", "50000"))
 
 ROOT_PATH = os.environ.get("ROOT_PATH", "")
 
@@ -33,11 +46,28 @@ API_ALLOW_ORIGINS = [
 ]
 
 llm_client = genai.Client(vertexai=True, project=GCP_PROJECT, location=GCP_LOCATION)
+answer_cache = build_cache(
+    ANSWER_CACHE_SIZE,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_URL,
+    table="answers",
+    max_shared_entries=ANSWER_CACHE_MAX_ROWS,
+)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    # Open the Chroma connection pool before the first request instead of during it.
+    await achroma.start()
+    yield
+    await achroma.stop()
+
 
 app = FastAPI(
     title="The Consult · Gemini Proxy",
     description="Thin API proxy that calls Vertex AI Gemini directly (no RAG yet).",
     root_path=ROOT_PATH.rstrip("/"),
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -125,28 +155,47 @@ def _build_prompt(payload: AskRequest, context_block: str = "") -> str:
     )
 
 
-def _stream_gemini(prompt: str, citations: list[Citation] | None = None) -> Generator[str, None, None]:
-    """Yield Server-Sent Events with Gemini deltas."""
+def _answer_cache_key(payload: AskRequest) -> str:
+    """
+    The prompt built without retrieved context covers question, mode, patient context and filters, so a hit
+    skips retrieval as well as generation.
+    """
+    return cache_key(GEMINI_MODEL, GEMINI_TEMPERATURE, _build_prompt(payload))
+
+
+def _citations_event(citations: list[Citation] | None) -> str:
+    payload = json.dumps({"citations": [c.model_dump() for c in citations or []]})
+    return f"event: citations\ndata: {payload}\n\n"
+
+
+async def _stream_gemini(
+    prompt: str, citations: list[Citation] | None = None, answer_key: str | None = None
+) -> AsyncGenerator[str, None]:
+    """
+    Yield Server-Sent Events with Gemini deltas, reading the async stream so no worker thread is held.
+    A completed answer is stored under ``answer_key`` so repeats are replayed from the cache.
+    """
     if citations:
-        payload = json.dumps({"citations": [c.model_dump() for c in citations]})
-        yield f"event: citations\ndata: {payload}\n\n"
+        yield _citations_event(citations)
 
     try:
-        stream = llm_client.models.generate_content_stream(
+        stream = await llm_client.aio.models.generate_content_stream(
             model=GEMINI_MODEL,
             contents=prompt,
-            config={"temperature": 0.4},
+            config={"temperature": GEMINI_TEMPERATURE},
         )
     except AttributeError as exc:
         raise HTTPException(
             status_code=501, detail="Gemini streaming is not supported with the current client."
         ) from exc
 
+    pieces: list[str] = []
     try:
-        for chunk in stream:
+        async for chunk in stream:
             text = getattr(chunk, "text", None)
             if not text:
                 continue
+            pieces.append(text)
             payload = json.dumps({"delta": text})
             yield f"data: {payload}\n\n"
     except Exception as exc:
@@ -154,9 +203,21 @@ def _stream_gemini(prompt: str, citations: list[Citation] | None = None) -> Gene
         yield f"event: error\ndata: {error_payload}\n\n"
         return
 
+    if answer_key and pieces:
+        await answer_cache.aset(
+            answer_key, {"answer": "".join(pieces), "citations": [c.model_dump() for c in citations or []]}
+        )
     yield 'event: end\ndata: {"status": "completed"}\n\n'
 
 
+async def _replay_answer(cached: dict) -> AsyncGenerator[str, None]:
+    """A cached answer as the same event sequence a live stream produces, in a single delta."""
+    if cached["citations"]:
+        yield _citations_event([Citation(**c) for c in cached["citations"]])
+    yield f"data: {json.dumps({'delta': cached['answer']})}\n\n"
+    yield 'event: end\ndata: {"status": "completed", "cached": true}\n\n'
+
+
 # Routes
 @app.get("/")
 async def get_index():  # optional async, at start of line
@@ -168,12 +229,23 @@ def health_check():
     return {"status": "ok"}
 
 
+@app.get("/api/cache/stats")
+def cache_stats():
+    """Hit rates of the in-process caches (and their shared tier, when configured)."""
+    return {"query_embedding": query_embedding_cache.stats(), "answer": answer_cache.stats()}
+
+
 @app.post("/api/ask", response_model=AskResponse)
-def ask_vertex(payload: AskRequest) -> AskResponse:
+async def ask_vertex(payload: AskRequest) -> AskResponse:
     """Return a plain Gemini answer (no RAG yet)."""
+    answer_key = _answer_cache_key(payload)
+    cached = await answer_cache.aget(answer_key)
+    if cached is not None:
+        return AskResponse(**cached)
+
     filters = payload.filters.model_dump(by_alias=True) if payload.filters else None
     try:
-        context_block, citations_raw = build_context_and_citations(payload.question, filters)
+        context_block, citations_raw = await abuild_context_and_citations(payload.question, filters)
     except google_auth_exceptions.DefaultCredentialsError as exc:
         raise HTTPException(
             status_code=500,
@@ -183,23 +255,31 @@ def ask_vertex(payload: AskRequest) -> AskResponse:
     prompt = _build_prompt(payload, context_block=context_block)
 
     try:
-        response = llm_client.models.generate_content(
+        response = await llm_client.aio.models.generate_content(
             model=GEMINI_MODEL,
             contents=prompt,
-            config={"temperature": 0.4},
+            config={"temperature": GEMINI_TEMPERATURE},
         )
     except Exception as exc:  # pragma: no cover - surfaced via HTTP error for debugging
         raise HTTPException(status_code=500, detail=str(exc)) from exc
 
-    answer = response.text or "Gemini returned an empty response."
-    return AskResponse(answer=answer, citations=citations)
+    if not response.text:
+        return AskResponse(answer="Gemini returned an empty response.", citations=citations)
+    await answer_cache.aset(answer_key, {"answer": response.text, "citations": [c.model_dump() for c in citations]})
+    return AskResponse(answer=response.text, citations=citations)
 
 
 @app.post("/api/ask/stream")
-def ask_vertex_stream(payload: AskRequest):
+async def ask_vertex_stream(payload: AskRequest):
     """Stream Gemini deltas via Server-Sent Events."""
+    headers = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
+    answer_key = _answer_cache_key(payload)
+    cached = await answer_cache.aget(answer_key)
+    if cached is not None:
+        return StreamingResponse(_replay_answer(cached), media_type="text/event-stream", headers=headers)
+
     filters = payload.filters.model_dump(by_alias=True) if payload.filters else None
-    context_block, citations_raw = build_context_and_citations(payload.question, filters)
+    context_block, citations_raw = await abuild_context_and_citations(payload.question, filters)
 
     # try:
     #     context_block, citations_raw = build_context_and_citations(payload.question, filters)
@@ -210,9 +290,8 @@ def ask_vertex_stream(payload: AskRequest):
     #     ) from exc
     citations = [Citation(**c) for c in citations_raw]
     prompt = _build_prompt(payload, context_block=context_block)
-    headers = {"Cache-Control": "no-cache", "Connection": "keep-alive"}
     return StreamingResponse(
-        _stream_gemini(prompt, citations=citations),
+        _stream_gemini(prompt, citations=citations, answer_key=answer_key),
         media_type="text/event-stream",
         headers=headers,
     )
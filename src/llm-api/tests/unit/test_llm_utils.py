@@ -1,4 +1,6 @@
+import asyncio
 import importlib
+import math
 import sys
 from pathlib import Path
 from types import ModuleType, SimpleNamespace
@@ -8,7 +10,7 @@ from fastapi.testclient import TestClient
 
 
 @pytest.fixture()
-def server_module(monkeypatch):
+def server_module(monkeypatch, tmp_path):
     # Stub google auth/genai dependencies so the API can import without cloud credentials.
     auth_exceptions = ModuleType("google.auth.exceptions")
 
@@ -56,9 +58,29 @@ def server_module(monkeypatch):
             self.parent.embed_calls.append({"model": model, "contents": contents, "config": config})
             return SimpleNamespace(embeddings=[SimpleNamespace(values=[0.1, 0.2])])
 
+    class FakeAsyncModels:
+        def __init__(self, parent):
+            self.sync = FakeModels(parent)
+
+        async def generate_content(self, model, contents, config):
+            return self.sync.generate_content(model, contents, config)
+
+        async def generate_content_stream(self, model, contents, config):
+            chunks = list(self.sync.generate_content_stream(model, contents, config))
+
+            async def iterate():
+                for chunk in chunks:
+                    yield chunk
+
+            return iterate()
+
+        async def embed_content(self, model, contents, config):
+            return self.sync.embed_content(model, contents, config)
+
     class FakeClient:
         def __init__(self, *_args, **_kwargs):
             self.models = FakeModels(self)
+            self.aio = SimpleNamespace(models=FakeAsyncModels(self))
             self.generate_calls: list[dict] = []
             self.stream_calls: list[dict] = []
             self.embed_calls: list[dict] = []
@@ -74,6 +96,7 @@ def server_module(monkeypatch):
     monkeypatch.setenv("GCP_LOCATION", "test-location")
     monkeypatch.setenv("GEMINI_MODEL", "test-model")
     monkeypatch.setenv("API_ALLOW_ORIGINS", "http://localhost:8080,http://0.0.0.0:8080")
+    monkeypatch.setenv("ANSWER_CACHE_URL", str(tmp_path / "answers.sqlite3"))
 
     package_root = Path(__file__).resolve().parents[2]
     sys.path.insert(0, str(package_root))
@@ -96,9 +119,11 @@ def server_module(monkeypatch):
             "is_top_journal": "True",
         }
     ]
-    monkeypatch.setattr(
-        server, "build_context_and_citations", lambda _q, _f=None: ("[1] Title: trial", dummy_citations)
-    )
+
+    async def fake_context(_question, _filters=None):
+        return "[1] Title: trial", dummy_citations
+
+    monkeypatch.setattr(server, "abuild_context_and_citations", fake_context)
 
     return server
 
@@ -126,14 +151,30 @@ def rag_module(server_module, monkeypatch):
             return chromadb_stub.query_payload
 
     class DummyClient:
-        def __init__(self, *_, **__):
+        def __init__(self, *_, **kwargs):
             self.collections = []
+            chromadb_stub.clients.append(kwargs)
 
         def get_collection(self, name):
             self.collections.append(name)
             return DummyCollection()
 
+    class DummyAsyncCollection:
+        async def query(self, **kwargs):
+            return DummyCollection().query(**kwargs)
+
+    async def dummy_async_client(*_, **kwargs):
+        chromadb_stub.clients.append(kwargs)
+
+        async def get_collection(name):
+            return DummyAsyncCollection()
+
+        return SimpleNamespace(get_collection=get_collection)
+
     chromadb_stub.HttpClient = DummyClient
+    chromadb_stub.AsyncHttpClient = dummy_async_client
+    chromadb_stub.Settings = lambda **kwargs: kwargs
+    chromadb_stub.clients = []
     sys.modules["chromadb"] = chromadb_stub
 
     module = importlib.import_module("api.rag_module")
@@ -171,6 +212,35 @@ def test_stream_endpoint_emits_citations_and_deltas(client, server_module):
     assert server_module.llm_client.stream_calls, "Streaming model should be invoked once"
 
 
+def test_repeated_question_is_answered_from_cache(client, server_module):
+    payload = {"question": "Statins after 75?", "mode": "clinical", "filters": {"coiDisclosure": "With Disclosures"}}
+
+    first = client.post("/api/ask", json=payload).json()
+    second = client.post("/api/ask", json=payload).json()
+    other_mode = client.post("/api/ask", json={**payload, "mode": "research"}).json()
+
+    assert first == second == other_mode
+    assert len(server_module.llm_client.generate_calls) == 2
+    assert server_module.answer_cache.stats()["local_hits"] == 1
+
+
+def test_stream_endpoint_caches_and_replays_answers(client, server_module):
+    payload = {"question": "Replay me", "mode": "research"}
+
+    def stream_body():
+        with client.stream("POST", "/api/ask/stream", json=payload) as response:
+            return "\n".join(line for line in response.iter_lines() if line)
+
+    live = stream_body()
+    replayed = stream_body()
+
+    assert len(server_module.llm_client.stream_calls) == 1
+    assert '"delta": "alphabeta"' in replayed and '"cached": true' in replayed
+    assert "event: citations" in live and "event: citations" in replayed
+    assert client.post("/api/ask", json=payload).json()["answer"] == "alphabeta"
+    assert not server_module.llm_client.generate_calls
+
+
 def test_build_prompt_includes_context_and_filters(server_module):
     filters = server_module.EvidenceFilters(
         articleTypes=["Review"],
@@ -208,6 +278,116 @@ def test_generate_query_embedding(rag_module):
     assert call["contents"] == query
 
 
+def test_generate_query_embedding_with_local_backend(rag_module, monkeypatch):
+    monkeypatch.setattr(rag_module, "EMBEDDING_BACKEND", "hash")
+
+    embedding = rag_module.generate_query_embedding("aspirin and stroke")
+
+    assert len(embedding) == rag_module.EMBEDDING_DIMENSION
+    assert embedding == rag_module.generate_query_embedding("Aspirin and stroke")
+    assert rag_module.llm_client is None or not rag_module.llm_client.embed_calls
+
+
+def test_generate_query_embedding_caches_normalised_questions(rag_module):
+    first = rag_module.generate_query_embedding("What lowers LDL?")
+    second = rag_module.generate_query_embedding("  what lowers   ldl ")
+
+    assert first == second == [0.1, 0.2]
+    assert len(rag_module.llm_client.embed_calls) == 1
+    stats = rag_module.query_embedding_cache.stats()
+    assert (stats["local_hits"], stats["misses"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_tiered_cache_expires_entries_and_shares_through_sqlite(tmp_path):
+    from api.cache import LRUCache, TieredCache, build_cache
+
+    now = {"t": 0.0}
+    local = LRUCache(max_entries=2, ttl_seconds=10, clock=lambda: now["t"])
+    cache = TieredCache(local)
+    cache.set("a", [1.0])
+    cache.set("b", [2.0])
+    cache.set("c", [3.0])  # evicts the least recently used entry
+    assert cache.get("a") is None and cache.get("c") == [3.0]
+    now["t"] = 11
+    assert cache.get("c") is None
+
+    path = str(tmp_path / "cache.sqlite3")
+    build_cache(16, 60, path).set("question", [0.5, 0.25])
+    other_replica = build_cache(16, 60, f"sqlite:///{path}")
+    assert other_replica.get("question") == [0.5, 0.25]
+    assert other_replica.get("question") == [0.5, 0.25]
+    assert other_replica.stats()["shared_hits"] == 1 and other_replica.stats()["local_hits"] == 1
+
+
+def test_sqlite_store_purges_expired_rows_and_bounds_its_size(tmp_path, monkeypatch):
+    from api import cache as cache_module
+
+    now = {"t": 1000.0}
+    monkeypatch.setattr(cache_module.time, "time", lambda: now["t"])
+    store = cache_module.SqliteStore(str(tmp_path / "nested" / "cache.sqlite3"), 60, max_rows=3, purge_every=2)
+
+    for i in range(5):
+        now["t"] += 1
+        store.set(f"k{i}", i)
+    store.purge()
+    assert len(store) == 3 and store.get("k0") is None and store.get("k4") == 4
+
+    now["t"] += 120
+    store.purge()
+    assert len(store) == 0
+
+
+def test_tiered_cache_async_access_keeps_shared_tier_off_the_event_loop():
+    import threading
+
+    from api.cache import LRUCache, TieredCache
+
+    class RecordingStore:
+        def __init__(self):
+            self.values, self.threads = {}, []
+
+        def get(self, key):
+            self.threads.append(threading.current_thread())
+            return self.values.get(key)
+
+        def set(self, key, value):
+            self.threads.append(threading.current_thread())
+            self.values[key] = value
+
+    async def exercise(cache):
+        await cache.aset("k", [1.0])
+        cache.local = LRUCache(4, 60)  # a fresh replica: only the shared tier has the entry
+        return await cache.aget("k"), await cache.aget("k"), await cache.aget("missing")
+
+    shared = RecordingStore()
+    cache = TieredCache(LRUCache(4, 60), shared)
+
+    assert asyncio.run(exercise(cache)) == ([1.0], [1.0], None)
+    assert shared.threads and threading.main_thread() not in shared.threads
+    assert (cache.shared_hits, cache.local_hits, cache.misses) == (1, 1, 1)
+
+
+def test_cache_stats_endpoint_reports_hit_rate(client):
+    response = client.get("/api/cache/stats")
+
+    assert response.status_code == 200
+    assert set(response.json()["query_embedding"]) >= {"hit_rate", "local_hits", "misses"}
+    assert response.json()["answer"]["lookups"] == 0
+    assert response.json()["answer"]["shared_tier"] == "SqliteStore"
+
+
+def test_abuild_context_and_citations_uses_async_clients(rag_module):
+    context_block, citations = asyncio.run(
+        rag_module.abuild_context_and_citations("async question", {"articleImpact": ["Top Journal"]})
+    )
+
+    assert context_block.startswith("[1] Title:")
+    assert citations[0]["id"] == "id1"
+    assert rag_module.llm_client.embed_calls[0]["contents"] == "async question"
+    assert rag_module.chromadb.query_calls[-1]["where"] == {"is_top_journal": {"$in": rag_module._TRUTHY_STRINGS}}
+    assert len(sys.modules["chromadb"].clients) == 1 and rag_module.achroma.reconnects == 0
+
+
 def test_build_metadata_filter(rag_module):
     frontend_filters = {
         "articleImpact": ["Top Journal"],
@@ -222,7 +402,7 @@ def test_build_metadata_filter(rag_module):
     assert rag_module._build_metadata_filter({}) == {}
 
 
-def test_query_documents_filters_locally(rag_module):
+def test_query_documents_pushes_filters_into_where(rag_module):
     rag_module.chromadb.query_payload = {
         "documents": [["doc_a", "doc_b", "doc_c", "doc_d"]],
         "metadatas": [
@@ -245,10 +425,65 @@ def test_query_documents_filters_locally(rag_module):
 
     assert [item["id"] for item in results] == ["a"]
     query_call = rag_module.chromadb.query_calls[-1]
-    assert "where" not in query_call
+    assert query_call["where"] == {
+        "$and": [
+            {"is_top_journal": {"$in": rag_module._TRUTHY_STRINGS}},
+            {"coi_flag": {"$in": rag_module._TRUTHY_STRINGS}},
+        ]
+    }
     assert query_call["n_results"] == max(2, rag_module.CHROMADB_CANDIDATE_K)
 
 
+def test_query_documents_overfetches_for_local_only_filters(rag_module):
+    # "Without disclosures" cannot be pushed down; only one of four candidates survives it.
+    rag_module.chromadb.query_payload = {
+        "documents": [["a", "b", "c", "d"]],
+        "metadatas": [
+            [
+                {"pmid": str(pmid), "is_top_journal": "True", "coi_flag": "0" if pmid == 1 else "1"}
+                for pmid in range(1, 5)
+            ]
+        ],
+        "ids": [["a", "b", "c", "d"]],
+        "distances": [[0.1, 0.2, 0.3, 0.4]],
+    }
+    filters = {"articleImpact": ["Top Journal"], "coiDisclosure": "Without Disclosures"}
+
+    rag_module.query_documents([0.1], frontend_filters=filters)
+    rag_module.query_documents([0.1], frontend_filters=filters)
+
+    first, second = rag_module.chromadb.query_calls[-2:]
+    assert first["where"] == {"is_top_journal": {"$in": rag_module._TRUTHY_STRINGS}}
+    assert first["n_results"] == rag_module.CHROMADB_CANDIDATE_K
+    assert second["n_results"] == min(
+        rag_module.CHROMADB_MAX_CANDIDATE_K, math.ceil(rag_module.CHROMADB_FILTERED_TOP_K * 1.5 / 0.25)
+    )
+
+
+def test_query_documents_reuses_one_pooled_client(rag_module):
+    rag_module.query_documents([0.1, 0.2])
+    rag_module.query_documents([0.3, 0.4])
+
+    chromadb_stub = sys.modules["chromadb"]
+    assert len(chromadb_stub.clients) == 1
+    assert (
+        chromadb_stub.clients[0]["settings"]["chroma_http_max_connections"] == rag_module.CHROMADB_HTTP_MAX_CONNECTIONS
+    )
+    assert len(chromadb_stub.query_calls) == 2
+
+
+def test_query_documents_reconnects_once_after_a_failed_query(rag_module):
+    chromadb_stub = sys.modules["chromadb"]
+    stale = rag_module.chroma.collection()
+    stale.query = lambda **_kwargs: (_ for _ in ()).throw(ConnectionError("connection reset"))
+
+    results = rag_module.query_documents([0.1, 0.2])
+
+    assert results and rag_module.chroma.reconnects == 1
+    assert len(chromadb_stub.clients) == 2
+    assert rag_module.chroma.collection() is not stale
+
+
 def test_query_documents_caps_filtered_results(rag_module):
     rag_module.chromadb.query_payload = {
         "documents": [["d1", "d2", "d3", "d4", "d5", "d6"]],
@@ -1,10 +1,28 @@
+import fnmatch
+import glob
+import json
+import multiprocessing
 import os
+import time
 import chromadb
 from chromadb import PersistentClient
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+from typing import Any, Dict, List, Optional, Tuple
 
-# import json
-from .src.gcs import stream_backup_from_gcs
+from google.cloud import storage
+
+from .snapshot import SNAPSHOT_BUCKET, compact_chroma_dir, create_snapshot
+from .src.gcs import (
+    assign_backup_units,
+    backup_run,
+    is_superseded,
+    load_tombstones,
+    plan_backup_units,
+    stream_backup_from_gcs,
+    stream_backup_units,
+)
+from .src.journal import RunJournal
+from .src.uploader import ChromaUploader, server_max_batch_size
 
 # from .src.gcs import read_backup_from_gcs
 
@@ -13,7 +31,8 @@ GCP_PROJECT = os.environ.get("GCP_PROJECT", "apcomp215-project")
 BUCKET_NAME = os.environ.get("PROJECT_BUCKET_NAME", "pubmed-bucket-ac215")  # GCS bucket name
 CHROMADB_HOST = os.environ.get("CHROMADB_HOST", "35.193.38.202")
 CHROMADB_PORT = int(os.environ.get("CHROMADB_PORT", "8000"))
-CHROMADB_BATCH_SIZE = int(os.environ.get("CHROMADB_BATCH_SIZE", "25"))
+CHROMADB_BATCH_SIZE = int(os.environ.get("CHROMADB_BATCH_SIZE", "25"))  # initial size; the uploader adapts it
+CHROMADB_UPLOAD_WORKERS = int(os.environ.get("CHROMADB_UPLOAD_WORKERS", "4"))
 CHROMADB_COLLECTION = "pubmed_abstract_semantic"
 CHROMA_LOCAL_PATH = os.environ.get("CHROMA_LOCAL_PATH")  # when set, use embedded client
 
@@ -21,6 +40,28 @@ BACKUP_ENABLED = os.environ.get("ENABLE_GCS_BACKUP", "true").lower() in {"1", "t
 BACKUP_BUCKET = os.environ.get("BACKUP_BUCKET_NAME", BUCKET_NAME)
 BACKUP_PREFIX = os.environ.get("BACKUP_PREFIX", f"chromadb_backups/{CHROMADB_COLLECTION}")
 
+# Sharded restores: JSONL blobs above this size are split into byte ranges; each shard checkpoints locally
+RESTORE_SPLIT_MB = float(os.environ.get("RESTORE_SPLIT_MB", "256"))
+RESTORE_CHECKPOINT_DIR = os.environ.get("RESTORE_CHECKPOINT_DIR", f".restore_checkpoints/{CHROMADB_COLLECTION}")
+# gs://bucket/prefix mirror of the checkpoints, so a shard rescheduled onto a new pod still resumes
+RESTORE_CHECKPOINT_GCS = os.environ.get("RESTORE_CHECKPOINT_GCS", "")
+RESTORE_REPORT_SECONDS = float(os.environ.get("RESTORE_REPORT_SECONDS", "30"))
+
+# Offline snapshot build: large local batches and an HNSW configuration tuned for one bulk load
+SNAPSHOT_BUILD_DIR = os.environ.get("SNAPSHOT_BUILD_DIR", f".snapshot_build/{CHROMADB_COLLECTION}")
+SNAPSHOT_BATCH_SIZE = int(os.environ.get("SNAPSHOT_BATCH_SIZE", "5000"))  # capped by the client's max batch
+CHROMADB_HNSW_SPACE = os.environ.get("CHROMADB_HNSW_SPACE", "l2")  # same default as get_or_create_collection
+SNAPSHOT_HNSW_EF_CONSTRUCTION = int(os.environ.get("SNAPSHOT_HNSW_EF_CONSTRUCTION", "100"))
+SNAPSHOT_HNSW_MAX_NEIGHBORS = int(os.environ.get("SNAPSHOT_HNSW_MAX_NEIGHBORS", "16"))
+SNAPSHOT_HNSW_BATCH_SIZE = int(os.environ.get("SNAPSHOT_HNSW_BATCH_SIZE", "1000"))
+SNAPSHOT_HNSW_SYNC_THRESHOLD = int(os.environ.get("SNAPSHOT_HNSW_SYNC_THRESHOLD", "10000"))
+# Chroma's defaults, restored before the snapshot is taken so the served index persists as usual
+SERVING_HNSW_BATCH_SIZE = 100
+SERVING_HNSW_SYNC_THRESHOLD = 1000
+
+# Journal range that marks a whole unit as restored (record indices are >= 0)
+_UNIT_COMPLETE = (-1, 0)
+
 
 def connect_to_chromadb():
     if CHROMA_LOCAL_PATH:
@@ -32,7 +73,12 @@ def connect_to_chromadb():
     return client
 
 
-def load_backups_to_chromadb(client, semantic=True):
+def load_backups_to_chromadb(client, semantic=True, shard: Optional[Tuple[int, int]] = None):
+    """
+    Restore the GCS backup into the collection. With ``shard=(i, n)`` only shard ``i`` of ``n`` of the
+    backup units is restored, checkpointed to its own run journal so a restarted shard skips finished
+    work; records are upserted, so shards and retries can safely overlap.
+    """
     if not BACKUP_ENABLED:
         print("Backup loading is disabled.")
         return
@@ -40,45 +86,348 @@ def load_backups_to_chromadb(client, semantic=True):
     collection = client.get_or_create_collection(name=CHROMADB_COLLECTION)
     print(f"Loading backups into ChromaDB collection '{CHROMADB_COLLECTION}'...")
 
-    batch = []
+    uploader = ChromaUploader(
+        collection,
+        mode="upsert",
+        workers=CHROMADB_UPLOAD_WORKERS,
+        initial_batch_size=CHROMADB_BATCH_SIZE,
+        max_batch_size=server_max_batch_size(client),
+    )
+
+    journal = None
+    progress = None
+    tombstones: Dict[str, str] = {}
+    if shard is None:
+        source = (
+            (None, index, item) for index, item in enumerate(stream_backup_from_gcs(BACKUP_BUCKET, BACKUP_PREFIX))
+        )
+    else:
+        shard_index, shard_count = shard
+        bucket = storage.Client().bucket(BACKUP_BUCKET)
+        units = plan_backup_units(bucket, BACKUP_PREFIX, split_bytes=int(RESTORE_SPLIT_MB * 1024 * 1024))
+        my_units = assign_backup_units(units, shard_index, shard_count)
+        # Units of one run can land on different shards, so every shard applies all tombstones itself.
+        tombstones = load_tombstones(bucket, BACKUP_PREFIX)
+        journal_path = _shard_path(shard_index, shard_count, ".jsonl")
+        _pull_checkpoint(journal_path)
+        journal = RunJournal(journal_path)
+        todo = [unit for unit in my_units if not journal.is_done(unit.key, *_UNIT_COMPLETE)]
+        print(
+            f"Shard {shard_index}/{shard_count}: {len(my_units)} of {len(units)} backup units, "
+            f"{len(my_units) - len(todo)} already restored according to {journal.path}"
+        )
+        progress = {
+            "shard": f"{shard_index}/{shard_count}",
+            "units_total": len(my_units),
+            "units_done": len(my_units) - len(todo),
+            "records_loaded": 0,
+            "records_skipped": 0,
+            "records_failed": 0,
+            "finished": False,
+        }
+        _write_progress(shard_index, shard_count, progress)
+        source = stream_backup_units(todo)
+
+    batch: List[Tuple[int, Dict[str, Any]]] = []
     total_loaded = 0
-    for item in stream_backup_from_gcs(BACKUP_BUCKET, BACKUP_PREFIX):
-        batch.append(item)
+    skipped = 0
+    resumed = 0
+    superseded = 0
+    current_unit = None
+    unit_failures: Dict[str, int] = {}
+
+    def submit(unit, pending):
+        nonlocal total_loaded
+        total_loaded += len(pending)
+
+        def on_done(failed_ids: List[str]):
+            if journal is None:
+                return
+            if failed_ids:
+                unit_failures[unit.key] = unit_failures.get(unit.key, 0) + len(failed_ids)
+            else:
+                journal.record(unit.key, pending[0][0], pending[-1][0] + 1)
+
+        uploader.submit([record for _, record in pending], on_done=on_done)
+
+    def finish_unit(unit):
+        # Wait for the unit's uploads so it is only marked complete once all of it is in ChromaDB.
+        uploader.flush()
+        if journal is not None and not unit_failures.get(unit.key):
+            journal.record(unit.key, *_UNIT_COMPLETE)
+            progress["units_done"] += 1
+        if progress is not None:
+            progress.update(
+                records_loaded=total_loaded, records_skipped=skipped, records_failed=len(uploader.failed_ids)
+            )
+            _write_progress(*shard, progress)
+            _push_checkpoint(journal.path)
+
+    for unit, index, item in source:
+        if unit is not current_unit:
+            if batch:
+                submit(current_unit, batch)
+                batch = []
+            if current_unit is not None:
+                finish_unit(current_unit)
+            current_unit = unit
+        if journal is not None and journal.is_done(unit.key, index, index + 1):
+            resumed += 1
+            continue
+        if unit is not None and is_superseded(item, backup_run(unit.name), tombstones):
+            superseded += 1
+            continue
+        record = _to_record(item, semantic)
+        if record is None:
+            skipped += 1
+            continue
+        batch.append((index, record))
         if len(batch) >= CHROMADB_BATCH_SIZE:
-            _add_batch(collection, batch, semantic)
-            total_loaded += len(batch)
+            submit(unit, batch)
             print(f"Loaded {total_loaded} records so far...")
             batch = []
 
     if batch:
-        _add_batch(collection, batch, semantic)
-        total_loaded += len(batch)
+        submit(current_unit, batch)
+    if current_unit is not None:
+        finish_unit(current_unit)
+    uploader.close()
+    uploader.print_summary()
+
+    if progress is not None:
+        progress["finished"] = True
+        _write_progress(*shard, progress)
+    if resumed:
+        print(f"Skipped {resumed} records already restored according to the shard checkpoint.")
+    if superseded:
+        print(f"Skipped {superseded} backup records of articles deleted by a later run.")
+    if skipped:
+        print(f"Skipped {skipped} backup records without {'semantic ' if semantic else ''}embeddings.")
+    print(f"Finished loading {total_loaded - len(uploader.failed_ids)} records into '{CHROMADB_COLLECTION}'.")
+    if uploader.failed_ids:
+        raise SystemExit(f"{len(uploader.failed_ids)} records could not be restored; rerun to retry them.")
+
+
+def _shard_path(shard_index: int, shard_count: int, suffix: str) -> str:
+    return os.path.join(RESTORE_CHECKPOINT_DIR, f"shard-{shard_index:03d}-of-{shard_count:03d}{suffix}")
+
+
+def _checkpoint_location(gcs_url: str = RESTORE_CHECKPOINT_GCS) -> Tuple[Any, str]:
+    bucket_name, _, prefix = gcs_url.removeprefix("gs://").partition("/")
+    return storage.Client().bucket(bucket_name), prefix.strip("/")
+
+
+def _pull_checkpoint(path: str):
+    """Seed a local checkpoint file from the GCS mirror, when one is configured and has it."""
+    if not RESTORE_CHECKPOINT_GCS:
+        return
+    bucket, prefix = _checkpoint_location()
+    blob = bucket.blob(f"{prefix}/{os.path.basename(path)}")
+    if blob.exists():
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        blob.download_to_filename(path)
+        print(f"Resuming from checkpoint gs://{bucket.name}/{blob.name}")
+
+
+def _push_checkpoint(*paths: str):
+    """Copy local checkpoint files to the GCS mirror; called once per finished unit."""
+    if not RESTORE_CHECKPOINT_GCS:
+        return
+    bucket, prefix = _checkpoint_location()
+    for path in paths:
+        if os.path.exists(path):
+            bucket.blob(f"{prefix}/{os.path.basename(path)}").upload_from_filename(path)
+
 
-    print(f"Finished loading {total_loaded} records into '{CHROMADB_COLLECTION}'.")
+def _write_progress(shard_index: int, shard_count: int, progress: Dict[str, Any]):
+    path = _shard_path(shard_index, shard_count, ".progress.json")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({**progress, "updated_at": time.time()}, f)
+    os.replace(tmp_path, path)
+    _push_checkpoint(path)
 
 
-def _add_batch(collection, batch, semantic):
-    ids = [item["id"] for item in batch]
-    if semantic:
-        try:
-            embeddings = [item["embeddings_semantic"] for item in batch]
-        except KeyError as e:
-            print(e)
-            return
+def report_restore_progress(
+    checkpoint_dir: str = RESTORE_CHECKPOINT_DIR, gcs_url: str = RESTORE_CHECKPOINT_GCS
+) -> Dict[str, Any]:
+    """
+    Print and return the aggregate progress of every shard that has written a progress file, read from the
+    GCS mirror when one is configured (so all pods of a loader job are covered) and locally otherwise.
+    """
+    shards = []
+    if gcs_url:
+        bucket, prefix = _checkpoint_location(gcs_url)
+        for blob in sorted(bucket.list_blobs(prefix=f"{prefix}/"), key=lambda blob: blob.name):
+            if fnmatch.fnmatch(os.path.basename(blob.name), "shard-*.progress.json"):
+                shards.append(json.loads(blob.download_as_bytes()))
     else:
-        embeddings = [item["embedding"] for item in batch]
-    metadatas = [item["metadata"] for item in batch]
-    documents = [item["document"] for item in batch]
+        for path in sorted(glob.glob(os.path.join(checkpoint_dir, "shard-*.progress.json"))):
+            with open(path, "r", encoding="utf-8") as f:
+                shards.append(json.load(f))
+    keys = ["units_total", "units_done", "records_loaded", "records_skipped", "records_failed"]
+    total = {key: sum(shard[key] for shard in shards) for key in keys}
+    total["shards"] = len(shards)
+    total["shards_finished"] = sum(1 for shard in shards if shard["finished"])
+    print(
+        f"Restore progress: {total['shards_finished']}/{total['shards']} shards finished, "
+        f"{total['units_done']}/{total['units_total']} units, {total['records_loaded']} records loaded, "
+        f"{total['records_failed']} failed"
+    )
+    return total
 
-    collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=documents)
+
+def _run_shard(shard_index: int, shard_count: int, semantic: bool):
+    client = connect_to_chromadb()
+    load_backups_to_chromadb(client, semantic=semantic, shard=(shard_index, shard_count))
+
+
+def run_sharded_restore(shard: Tuple[int, int], workers: int, semantic: bool):
+    """
+    Restore ``shard`` (``(i, n)``, e.g. one pod of an indexed job) with ``workers`` local processes.
+    Each process takes one sub-shard ``i * workers + w`` of ``n * workers``; an aggregate progress
+    report is printed while they run.
+    """
+    shard_index, shard_count = shard
+    total = shard_count * workers
+    subshards = [shard_index * workers + worker for worker in range(workers)]
+    if workers == 1:
+        _run_shard(subshards[0], total, semantic)
+        report_restore_progress()
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_run_shard, args=(index, total, semantic), name=f"restore-{index}")
+        for index in subshards
+    ]
+    for process in processes:
+        process.start()
+    while any(process.is_alive() for process in processes):
+        for process in processes:
+            process.join(timeout=RESTORE_REPORT_SECONDS / len(processes))
+        report_restore_progress()
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        raise SystemExit(f"Restore failed in {failed}; rerun to resume from the shard checkpoints.")
+
+
+def _parse_shard(value: str) -> Tuple[int, int]:
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError(f"--shard expects i/N, got {value!r}")
+    if not 0 <= index < count:
+        raise ArgumentTypeError(f"--shard index must be in [0, N), got {value!r}")
+    return index, count
+
+
+def build_snapshot(build_dir: str = SNAPSHOT_BUILD_DIR, semantic=True, publish=True) -> Dict[str, Any]:
+    """
+    Load the whole backup into a fresh local ``PersistentClient`` directory, compact it and (by default)
+    publish it as a versioned snapshot in GCS that the vector-db pod can restore with a file copy.
+    """
+    if os.path.isdir(build_dir) and os.listdir(build_dir):
+        raise RuntimeError(f"Snapshot build directory {build_dir} is not empty; remove it or choose another.")
+
+    client = PersistentClient(path=build_dir)
+    # A large brute-force buffer and infrequent index persists suit one big load with no concurrent queries.
+    collection = client.create_collection(
+        name=CHROMADB_COLLECTION,
+        configuration={
+            "hnsw": {
+                "space": CHROMADB_HNSW_SPACE,
+                "ef_construction": SNAPSHOT_HNSW_EF_CONSTRUCTION,
+                "max_neighbors": SNAPSHOT_HNSW_MAX_NEIGHBORS,
+                "batch_size": SNAPSHOT_HNSW_BATCH_SIZE,
+                "sync_threshold": SNAPSHOT_HNSW_SYNC_THRESHOLD,
+            }
+        },
+    )
+    batch_size = min(SNAPSHOT_BATCH_SIZE, server_max_batch_size(client, default=SNAPSHOT_BATCH_SIZE))
+    print(f"Building snapshot of '{CHROMADB_COLLECTION}' in {build_dir} with batches of {batch_size}...")
+
+    batch: List[Dict[str, Any]] = []
+    skipped = 0
+
+    def add(records):
+        collection.add(
+            ids=[item["id"] for item in records],
+            documents=[item["document"] for item in records],
+            metadatas=[item["metadata"] for item in records],
+            embeddings=[item["embedding"] for item in records],
+        )
+
+    for item in stream_backup_from_gcs(BACKUP_BUCKET, BACKUP_PREFIX):
+        record = _to_record(item, semantic)
+        if record is None:
+            skipped += 1
+            continue
+        batch.append(record)
+        if len(batch) >= batch_size:
+            add(batch)
+            batch = []
+    if batch:
+        add(batch)
+
+    record_count = collection.count()
+    collection.modify(
+        configuration={"hnsw": {"batch_size": SERVING_HNSW_BATCH_SIZE, "sync_threshold": SERVING_HNSW_SYNC_THRESHOLD}}
+    )
+    print(f"Loaded {record_count} records ({skipped} without {'semantic ' if semantic else ''}embeddings skipped).")
+    # Release the embedded system so its files are closed before compaction and tarring.
+    collection = client = None
+    chromadb.api.client.SharedSystemClient.clear_system_cache()
+    compact_chroma_dir(build_dir)
+
+    metadata = {
+        "collection": CHROMADB_COLLECTION,
+        "record_count": record_count,
+        "embedding_key": "embeddings_semantic" if semantic else "embedding",
+        "hnsw_space": CHROMADB_HNSW_SPACE,
+        "chromadb_version": chromadb.__version__,
+        "source_backup": f"gs://{BACKUP_BUCKET}/{BACKUP_PREFIX}",
+    }
+    if not publish:
+        return metadata
+    return create_snapshot(build_dir, storage.Client().bucket(SNAPSHOT_BUCKET), metadata=metadata)
+
+
+def _to_record(item, semantic):
+    embedding_key = "embeddings_semantic" if semantic else "embedding"
+    if embedding_key not in item:
+        return None
+    return {
+        "id": item["id"],
+        "document": item["document"],
+        "metadata": item["metadata"],
+        "embedding": item[embedding_key],
+    }
 
 
 def main():
 
     parser = ArgumentParser()
     parser.add_argument("--semantic", action="store_true", help="Use semantic embeddings")
+    parser.add_argument("--shard", type=_parse_shard, help="Restore only shard i of N of the backup, e.g. 0/4")
+    parser.add_argument("--workers", type=int, default=1, help="Local restore processes (splits the shard further)")
+    parser.add_argument("--report", action="store_true", help="Print the aggregate progress of a sharded restore")
+    parser.add_argument(
+        "--build-snapshot", action="store_true", help="Build offline into SNAPSHOT_BUILD_DIR and publish a snapshot"
+    )
     args = parser.parse_args()
 
+    if args.report:
+        report_restore_progress()
+        return
+    if args.build_snapshot:
+        build_snapshot(semantic=args.semantic)
+        return
+    if args.shard is not None or args.workers > 1:
+        run_sharded_restore(args.shard or (0, 1), max(1, args.workers), args.semantic)
+        return
+
     print("Connecting to ChromaDB...")
     client = connect_to_chromadb()
 
@@ -1,14 +1,20 @@
-import json
 import os
-import tempfile
+from argparse import ArgumentParser
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Sequence, Tuple
+from typing import Any, Dict, List, Sequence, Set, Tuple
 
 import pandas as pd
 
-from .src.chunker import chunk_abstracts
-from .src.embedder import embed_chunk_lists
-from .src.gcs import read_parquet_from_gcs
+from .src.backup_sink import RollingBackupSink
+from .src.chunker import CHUNK_UNIT, ChunkLengthStats, ChunkSpans, chunk_abstract_spans
+from .src.dedup import DUPLICATE_PMIDS_KEY, ChunkDeduplicator, apply_duplicate_updates
+from .src.embedder import EMBEDDING_LOCATIONS, embed_texts, embedding_metrics
+from .src.fingerprints import FingerprintIndex, row_fingerprints
+from .src.gcs import iter_parquet_batches_from_gcs
+from .src.journal import RunJournal
+from .src.metrics import dump_summary, registry
+from .src.pipeline import Stage, print_stage_stats, run_pipeline
+from .src.uploader import ChromaUploader, server_max_batch_size
 
 # ChromaDB
 import chromadb
@@ -22,12 +28,34 @@ PARQUET_FOLDER = os.environ.get(
 )  # only process parquet files in this folder
 CHROMADB_HOST = os.environ.get("CHROMADB_HOST", "35.193.38.202")
 CHROMADB_PORT = int(os.environ.get("CHROMADB_PORT", "8000"))
-CHROMADB_BATCH_SIZE = int(os.environ.get("CHROMADB_BATCH_SIZE", "50"))
+CHROMADB_BATCH_SIZE = int(os.environ.get("CHROMADB_BATCH_SIZE", "50"))  # initial size; the uploader adapts it
+CHROMADB_UPLOAD_WORKERS = int(os.environ.get("CHROMADB_UPLOAD_WORKERS", "4"))
 CHROMADB_COLLECTION = "pubmed_abstract"
 
+# Streaming ingest: rows per batch, batches buffered between stages, concurrent embedding requests
+INGEST_BATCH_ROWS = int(os.environ.get("INGEST_BATCH_ROWS", "1000"))
+INGEST_QUEUE_SIZE = int(os.environ.get("INGEST_QUEUE_SIZE", "2"))
+# two concurrent embedding requests per region in EMBEDDING_LOCATIONS unless set explicitly
+INGEST_EMBED_WORKERS = int(os.environ.get("INGEST_EMBED_WORKERS", str(2 * len(EMBEDDING_LOCATIONS))))
+
+# Resumable runs: completed batches are journaled locally and skipped on restart
+INGEST_JOURNAL_PATH = os.environ.get("INGEST_JOURNAL_PATH", f".ingest_journal/{CHROMADB_COLLECTION}.jsonl")
+INGEST_SKIP_EXISTING = os.environ.get("INGEST_SKIP_EXISTING", "true").lower() in {"1", "true", "yes"}
+# Delta ingest (--delta): pmid -> row fingerprint of everything already in the collection
+INGEST_FINGERPRINT_PATH = os.environ.get(
+    "INGEST_FINGERPRINT_PATH", f".ingest_journal/{CHROMADB_COLLECTION}.fingerprints.sqlite3"
+)
+CHROMADB_DELETE_BATCH_SIZE = int(os.environ.get("CHROMADB_DELETE_BATCH_SIZE", "500"))
+# Near-duplicate chunks (errata, reprints, multi-journal publications) are dropped before embedding
+INGEST_DEDUP = os.environ.get("INGEST_DEDUP", "true").lower() in {"1", "true", "yes"}
+# Canonical chunk signatures and duplicate PMIDs of everything already in the collection
+INGEST_DEDUP_PATH = os.environ.get("INGEST_DEDUP_PATH", f".ingest_journal/{CHROMADB_COLLECTION}.dedup.sqlite3")
+
 BACKUP_ENABLED = os.environ.get("ENABLE_GCS_BACKUP", "true").lower() in {"1", "true", "yes"}
 BACKUP_BUCKET = os.environ.get("BACKUP_BUCKET_NAME", BUCKET_NAME)
 BACKUP_PREFIX = os.environ.get("BACKUP_PREFIX", f"chromadb_backups/{CHROMADB_COLLECTION}")
+BACKUP_FORMAT = os.environ.get("BACKUP_FORMAT", "parquet").lower()  # "parquet" (columnar, zstd) or "jsonl" (gzip)
+BACKUP_EMBEDDING_DTYPE = os.environ.get("BACKUP_EMBEDDING_DTYPE", "float32")  # parquet only: float32 or float16
 
 METADATA_COLUMNS = [
     "pmid",
@@ -49,17 +77,34 @@ def connect_to_chromadb():
     return client
 
 
-def _stringify(value: Any) -> str | None:
-    if value is None:
-        return None
-    try:
-        if pd.isna(value):
-            return None
-    except TypeError:
-        pass
-    if isinstance(value, pd.Timestamp):
-        return value.isoformat()
-    return str(value)
+def _stringify_column(series: pd.Series) -> List[str | None]:
+    """Stringify a metadata column: NA becomes None, timestamps ISO 8601 strings, everything else ``str``."""
+    missing = series.isna().to_numpy()
+    if series.dtype == object or pd.api.types.is_datetime64_any_dtype(series):
+        # Object columns may mix types (and hold Timestamps), so only these fall back to per-value dispatch.
+        values = [value.isoformat() if isinstance(value, pd.Timestamp) else str(value) for value in series.tolist()]
+    else:
+        values = series.astype(str).tolist()
+    return [None if is_missing else value for value, is_missing in zip(values, missing)]
+
+
+def _row_base_ids(df: pd.DataFrame, row_offset: int = 0) -> List[str]:
+    """Id prefix for each row: the PMID when present, otherwise the row's global position."""
+    pmids = _stringify_column(df["pmid"]) if "pmid" in df.columns else [None] * len(df)
+    return [pmid or f"row-{row_offset + row_idx}" for row_idx, pmid in enumerate(pmids)]
+
+
+def _row_metadata(df: pd.DataFrame, base_ids: Sequence[str]) -> List[Dict[str, Any]]:
+    """Build the shared metadata dict of every source row once, one column at a time."""
+    columns = {column: _stringify_column(df[column]) for column in METADATA_COLUMNS if column in df.columns}
+    names = list(columns)
+    column_values = zip(*columns.values()) if columns else [()] * len(base_ids)
+    rows: List[Dict[str, Any]] = []
+    for base_id, values in zip(base_ids, column_values):
+        metadata = {name: value for name, value in zip(names, values) if value is not None}
+        metadata.setdefault("pmid", base_id)
+        rows.append(metadata)
+    return rows
 
 
 def _build_chunk_records(
@@ -67,96 +112,230 @@ def _build_chunk_records(
     chunk_map: Sequence[Tuple[int, int]],
     chunk_texts: Sequence[str],
     embeddings: Sequence[Sequence[float]],
+    row_offset: int = 0,
 ) -> List[Dict[str, Any]]:
     if len(chunk_map) != len(chunk_texts) or len(chunk_map) != len(embeddings):
         raise ValueError("Chunk map, texts, and embeddings must have identical lengths.")
 
-    records: List[Dict[str, Any]] = []
-    for (row_idx, chunk_idx), chunk_text, embedding in zip(chunk_map, chunk_texts, embeddings):
-        row = df.iloc[row_idx]
-        pmid_value = _stringify(row["pmid"]) if "pmid" in row else None
-        base_id = pmid_value or f"row-{row_idx}"
-        metadata: Dict[str, Any] = {}
-
-        for column in METADATA_COLUMNS:
-            if column in df.columns:
-                column_value = _stringify(row[column])
-                if column_value is not None:
-                    metadata[column] = column_value
-
-        metadata["pmid"] = metadata.get("pmid", base_id)
-        metadata["chunk_index"] = chunk_idx
-        metadata["chunk_char_count"] = len(chunk_text)
-
-        records.append(
-            {
-                "id": f"{base_id}-{chunk_idx}",
-                "document": chunk_text,
-                "metadata": metadata,
-                "embedding": list(embedding),
-            }
-        )
-    return records
-
-
-def _upload_records(collection, records: Sequence[Dict[str, Any]], batch_size: int = CHROMADB_BATCH_SIZE):
-    total_records = len(records)
-    if total_records == 0:
-        print("No chunk records to upload to ChromaDB.")
-        return
-
-    print(f"Uploading {total_records} chunk embeddings to ChromaDB (batch size={batch_size}) ...")
-    for start in range(0, total_records, batch_size):
-        batch = records[start : start + batch_size]
-        collection.add(
-            ids=[item["id"] for item in batch],
-            documents=[item["document"] for item in batch],
-            metadatas=[item["metadata"] for item in batch],
-            embeddings=[item["embedding"] for item in batch],
-        )
-        print(f"Inserted {min(start + batch_size, total_records)}/{total_records} chunks.")
+    base_ids = _row_base_ids(df, row_offset)
+    row_metadata = _row_metadata(df, base_ids)
 
+    # Each chunk only adds its own two fields on top of its row's prebuilt metadata.
+    return [
+        {
+            "id": f"{base_ids[row_idx]}-{chunk_idx}",
+            "document": chunk_text,
+            "metadata": {**row_metadata[row_idx], "chunk_index": chunk_idx, "chunk_char_count": len(chunk_text)},
+            # Embeddings already arrive as lists; copying 256 floats per chunk dominated record building.
+            "embedding": embedding if isinstance(embedding, list) else list(embedding),
+        }
+        for (row_idx, chunk_idx), chunk_text, embedding in zip(chunk_map, chunk_texts, embeddings)
+    ]
 
-def _backup_records_to_gcs(records: Sequence[Dict[str, Any]]):
-    if not BACKUP_ENABLED:
-        print("GCS backup disabled via ENABLE_GCS_BACKUP.")
-        return
-    if not records:
-        print("No records available for GCS backup.")
-        return
 
+def _make_backup_sink() -> RollingBackupSink:
+    """Backup parts for this run go under ``<BACKUP_PREFIX>/<collection>-<timestamp>/``."""
     timestamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
-    blob_name = f"{BACKUP_PREFIX.rstrip('/')}/{CHROMADB_COLLECTION}-{timestamp}.jsonl"
+    bucket = storage.Client().bucket(BACKUP_BUCKET)
+    return RollingBackupSink(
+        bucket,
+        f"{BACKUP_PREFIX.rstrip('/')}/{CHROMADB_COLLECTION}-{timestamp}",
+        backup_format=BACKUP_FORMAT,
+        embedding_dtype=BACKUP_EMBEDDING_DTYPE,
+    )
+
+
+def _read_batches(batch_rows: int = INGEST_BATCH_ROWS, journal: RunJournal | None = None):
+    """
+    Reader stage: yield row batches from the parquet folder, tagged with their global row offset.
+    Batches already recorded in the journal are skipped before any chunking or embedding happens.
+    """
+    row_offset = 0
+    skipped = 0
+    for source, row_start, df in iter_parquet_batches_from_gcs(BUCKET_NAME, PARQUET_FOLDER, batch_rows=batch_rows):
+        row_end = row_start + len(df)
+        if journal is not None and journal.is_done(source, row_start, row_end):
+            skipped += len(df)
+        else:
+            yield {"source": source, "row_start": row_start, "row_end": row_end, "row_offset": row_offset, "df": df}
+        row_offset += len(df)
+    if skipped:
+        print(f"Skipped {skipped} rows already completed according to the run journal.")
+
+
+def _delete_articles(collection, pmids: Sequence[str]):
+    """Delete every chunk of ``pmids``, whatever their chunk count was."""
+    for start in range(0, len(pmids), CHROMADB_DELETE_BATCH_SIZE):
+        collection.delete(where={"pmid": {"$in": list(pmids[start : start + CHROMADB_DELETE_BATCH_SIZE])}})
+
+
+def _make_delta_stage(
+    index: FingerprintIndex,
+    collection,
+    deleted: List[str] | None = None,
+    deduplicator: ChunkDeduplicator | None = None,
+    requeued: Set[str] | None = None,
+):
+    """
+    Keep only rows that are new or whose abstract/metadata changed since their fingerprint was committed.
+    Chunks of changed articles are deleted first, since the new version may have fewer chunks; their PMIDs
+    are appended to ``deleted`` so the backup can record them. Articles that were only stored as duplicates of
+    the deleted chunks lose their fingerprints, so they pass this stage as new rows when they come by later,
+    and are added to ``requeued`` until they do.
+    """
+
+    def delta(batch: Dict[str, Any]) -> Dict[str, Any] | None:
+        df = batch["df"]
+        base_ids = _row_base_ids(df, batch["row_offset"])
+        fingerprints = row_fingerprints(df, ["abstract", *METADATA_COLUMNS])
+        new, changed = index.changes(base_ids, fingerprints)
+        stale = [base_id for base_id, flag in zip(base_ids, changed) if flag]
+        if stale:
+            _delete_articles(collection, stale)
+            if deleted is not None:
+                deleted.extend(stale)
+            if deduplicator is not None:
+                _requeue_duplicates(deduplicator, index, stale, requeued)
+        keep = new | changed
+        if requeued:
+            requeued.difference_update(base_id for base_id, flag in zip(base_ids, keep) if flag)
+        if not keep.any():
+            return None
+        # Ids are fixed before rows are dropped, so rows without a PMID keep their positional id.
+        batch["df"] = df.assign(pmid=base_ids)[keep].reset_index(drop=True)
+        batch["fingerprints"] = ([base_id for base_id, flag in zip(base_ids, keep) if flag], fingerprints[keep])
+        return batch
+
+    return delta
+
+
+def _requeue_duplicates(
+    deduplicator: ChunkDeduplicator, index: FingerprintIndex, pmids: Sequence[str], requeued: Set[str] | None
+) -> List[str]:
+    """Forget deleted articles in the dedup state and invalidate the fingerprints of their orphaned duplicates."""
+    orphaned = deduplicator.forget_articles(pmids)
+    if orphaned:
+        index.remove(orphaned)
+        if requeued is not None:
+            requeued.update(orphaned)
+    return orphaned
+
+
+def _make_chunk_stage(stats: ChunkLengthStats | None = None):
+    def chunk_batch(batch: Dict[str, Any]) -> Dict[str, Any]:
+        # Batches are small, so a process pool per batch would cost more than it saves.
+        batch["spans"] = chunk_abstract_spans(batch["df"], parallel=False, unit=CHUNK_UNIT, stats=stats)
+        return batch
+
+    return chunk_batch
+
+
+def _make_skip_existing_stage(collection):
+    """
+    Drop the chunks of rows whose chunk ids are all present in the collection already,
+    using one bulk ``collection.get`` per batch so that no embedding is spent on them.
+    """
+
+    def skip_existing(batch: Dict[str, Any]) -> Dict[str, Any]:
+        spans: ChunkSpans = batch["spans"]
+        base_ids = _row_base_ids(batch["df"], batch["row_offset"])
+        row_ids = [
+            [f"{base_id}-{chunk_idx}" for chunk_idx in range(count)]
+            for base_id, count in zip(base_ids, spans.counts_per_row().tolist())
+        ]
+        candidate_ids = [chunk_id for ids in row_ids for chunk_id in ids]
+        if not candidate_ids:
+            return batch
+
+        existing = set(collection.get(ids=candidate_ids, include=[])["ids"])
+        if not existing:
+            return batch
+        done_rows = [bool(ids) and all(chunk_id in existing for chunk_id in ids) for ids in row_ids]
+        if any(done_rows):
+            batch["spans"] = spans.without_rows(done_rows)
+            print(f"Skipping {sum(done_rows)} rows whose chunks already exist in '{CHROMADB_COLLECTION}'.")
+        return batch
+
+    return skip_existing
+
+
+def _make_dedup_stage(deduplicator: ChunkDeduplicator):
+    """Drop chunks that near-duplicate a chunk of another article seen earlier in the run."""
+
+    def dedup(batch: Dict[str, Any]) -> Dict[str, Any]:
+        spans: ChunkSpans = batch["spans"]
+        if not len(spans):
+            return batch
+        base_ids = _row_base_ids(batch["df"], batch["row_offset"])
+        rows = spans.rows.tolist()
+        ids = [f"{base_ids[row]}-{chunk_idx}" for row, chunk_idx in zip(rows, spans.chunk_indices().tolist())]
+        keep = deduplicator.filter(ids, [base_ids[row] for row in rows], spans.texts())
+        if not keep.all():
+            batch["spans"] = spans.select(keep)
+            print(f"Dropped {int((~keep).sum())} near-duplicate chunks before embedding.")
+        return batch
+
+    return dedup
+
+
+def _embed_batch(batch: Dict[str, Any]) -> Dict[str, Any] | None:
+    spans: ChunkSpans = batch["spans"]
+    if not len(spans):
+        # Delta batches still go downstream so their fingerprints are committed.
+        if "fingerprints" not in batch:
+            return None
+        batch["embeddings"] = []
+        return batch
+    # Chunk strings only exist for the duration of the request; the record stage slices them again.
+    batch["embeddings"] = embed_texts(spans.texts())
+    return batch
+
+
+def _make_records_stage(deduplicator: ChunkDeduplicator | None = None):
+    def build_batch_records(batch: Dict[str, Any]) -> Dict[str, Any]:
+        spans: ChunkSpans = batch.pop("spans")
+        batch["records"] = _build_chunk_records(
+            batch.pop("df"),
+            spans.chunk_map(),
+            spans.texts(),
+            batch.pop("embeddings"),
+            row_offset=batch["row_offset"],
+        )
+        if deduplicator is not None:
+            for record in batch["records"]:
+                duplicate_pmids = deduplicator.duplicate_pmids_for(record["id"])
+                if duplicate_pmids:
+                    record["metadata"][DUPLICATE_PMIDS_KEY] = duplicate_pmids
+        return batch
 
-    print(f"Backing up {len(records)} records to gs://{BACKUP_BUCKET}/{blob_name} ...")
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(BACKUP_BUCKET)
+    return build_batch_records
 
-    with tempfile.NamedTemporaryFile(mode="w", delete=False, encoding="utf-8") as tmpfile:
-        temp_path = tmpfile.name
-        for record in records:
-            tmpfile.write(json.dumps(record))
-            tmpfile.write("\n")
 
-    try:
-        blob = bucket.blob(blob_name)
-        blob.upload_from_filename(temp_path)
-        print(f"✅ Backup uploaded to gs://{BACKUP_BUCKET}/{blob_name}")
-    finally:
-        try:
-            os.remove(temp_path)
-        except OSError:
-            pass
+def _make_upload_stage(
+    uploader: ChromaUploader,
+    backup: RollingBackupSink | None,
+    journal: RunJournal | None = None,
+    fingerprints: FingerprintIndex | None = None,
+):
+    def upload(batch: Dict[str, Any]):
+        records = batch["records"]
+        if backup is not None:
+            backup.write(records)
 
+        def on_uploaded(failed_ids: List[str]):
+            # Only journal a batch once all of it is in ChromaDB, so a crash or failed record redoes it.
+            if journal is not None and not failed_ids:
+                journal.record(batch["source"], batch["row_start"], batch["row_end"], [item["id"] for item in records])
+            if fingerprints is not None and not failed_ids:
+                fingerprints.commit(*batch["fingerprints"])
 
-def main():
-    df = read_parquet_from_gcs(BUCKET_NAME, PARQUET_FOLDER)
-    print(f"Found {len(df)} rows in the combined DataFrame.")
+        uploader.submit(records, on_done=on_uploaded)
 
-    print("Chunking abstracts ...")
-    df = chunk_abstracts(df)
-    print(df[["pmid", "abstract_chunks"]].head())
+    return upload
 
+
+def main(args=None):
+    registry.reset()
     client = connect_to_chromadb()
 
     # Create or get collection
@@ -164,17 +343,160 @@ def main():
 
     print(f"Using ChromaDB collection: {CHROMADB_COLLECTION}")
 
-    chunk_lists = df["abstract_chunks"].tolist()
-    chunk_map, chunk_texts, embeddings = embed_chunk_lists(chunk_lists)
-    if not chunk_texts:
-        print("No non-empty chunks found after chunking. Exiting without uploading data.")
-        return
+    # upsert keeps reruns idempotent: ids inserted by an interrupted run are overwritten, not rejected
+    uploader = ChromaUploader(
+        collection,
+        mode="upsert",
+        workers=CHROMADB_UPLOAD_WORKERS,
+        initial_batch_size=CHROMADB_BATCH_SIZE,
+        max_batch_size=server_max_batch_size(client),
+    )
+
+    if BACKUP_ENABLED:
+        backup = _make_backup_sink()
+    else:
+        print("GCS backup disabled via ENABLE_GCS_BACKUP.")
+        backup = None
+
+    delta = bool(args and args.delta)
+    fingerprints = None
+    if delta:
+        # The fingerprint index tracks progress per row, so the batch journal is not used.
+        fingerprints = FingerprintIndex(INGEST_FINGERPRINT_PATH)
+        print(f"Delta ingest against {INGEST_FINGERPRINT_PATH} ({len(fingerprints)} articles fingerprinted)")
+
+    journal = None
+    if not delta and (args is None or not args.no_journal):
+        journal = RunJournal(INGEST_JOURNAL_PATH, fresh=bool(args and args.fresh))
+        print(f"Run journal: {INGEST_JOURNAL_PATH} ({journal.entries} completed batches recorded)")
+
+    chunk_stats = ChunkLengthStats(unit=CHUNK_UNIT)
+
+    deduplicator = None
+    if INGEST_DEDUP:
+        deduplicator = ChunkDeduplicator(path=INGEST_DEDUP_PATH or None, fresh=bool(args and args.fresh))
+        print(f"Dedup state: {INGEST_DEDUP_PATH or 'this run only'} ({deduplicator.index.size} canonical chunks)")
+
+    # reader -> chunker -> embedder -> record builder -> uploader, connected by bounded queues
+    stages = []
+    replaced: List[str] = []
+    requeued: Set[str] = set()
+    if fingerprints is not None:
+        stages.append(
+            Stage(
+                "delta",
+                _make_delta_stage(fingerprints, collection, replaced, deduplicator, requeued),
+                size=lambda b: len(b["df"]),
+            )
+        )
+    stages.append(Stage("chunk", _make_chunk_stage(chunk_stats), size=lambda b: len(b["df"])))
+    if INGEST_SKIP_EXISTING:
+        stages.append(Stage("skip", _make_skip_existing_stage(collection), size=lambda b: len(b["df"])))
+    if deduplicator is not None:
+        stages.append(Stage("dedup", _make_dedup_stage(deduplicator), size=lambda b: len(b["spans"])))
+    stages += [
+        Stage(
+            "embed",
+            _embed_batch,
+            workers=INGEST_EMBED_WORKERS,
+            size=lambda b: len(b["spans"]),
+        ),
+        Stage("records", _make_records_stage(deduplicator), size=lambda b: len(b["spans"])),
+        Stage("upload", _make_upload_stage(uploader, backup, journal, fingerprints), size=lambda b: len(b["records"])),
+    ]
+
+    gone: List[str] = []
+    requeue_stats = []
+    try:
+        stats = run_pipeline(
+            _read_batches(INGEST_BATCH_ROWS, journal),
+            stages,
+            queue_size=INGEST_QUEUE_SIZE,
+            source_size=lambda b: len(b["df"]),
+        )
+        if fingerprints is not None and args.prune:
+            # Only after a complete pass over the source: an article not seen in it is gone upstream.
+            gone = fingerprints.unseen()
+            _delete_articles(collection, gone)
+            if deduplicator is not None:
+                _requeue_duplicates(deduplicator, fingerprints, gone, requeued)
+            fingerprints.remove(gone)
+            print(f"Pruned {len(gone)} articles no longer in {PARQUET_FOLDER}.")
+        if requeued:
+            # Duplicates whose canonical chunk was deleted after their row went by: once their in-flight
+            # uploads have committed, drop their fingerprints again and pick them up in a second pass.
+            uploader.flush()
+            fingerprints.remove(sorted(requeued))
+            print(f"Re-ingesting {len(requeued)} articles whose canonical duplicate chunk was deleted.")
+            requeued.clear()
+            requeue_stats = run_pipeline(
+                _read_batches(INGEST_BATCH_ROWS, journal),
+                stages,
+                queue_size=INGEST_QUEUE_SIZE,
+                source_size=lambda b: len(b["df"]),
+            )
+    finally:
+        # Drain in-flight uploads even on failure so finished batches get journaled, and back up
+        # whatever made it into ChromaDB since journaled batches are skipped on restart.
+        try:
+            uploader.close()
+        finally:
+            if backup is not None:
+                try:
+                    # Tombstones for replaced and pruned articles, so restores drop their chunks from earlier runs.
+                    backup.write_tombstones(replaced)
+                    backup.write_tombstones(gone)
+                    backup.finish()
+                finally:
+                    backup.discard()
+
+    if deduplicator is not None:
+        # Canonical chunks uploaded before their duplicates turned up get the PMIDs afterwards.
+        updated = apply_duplicate_updates(collection, deduplicator)
+        deduplicator.close()
+        print(
+            f"Near-duplicate chunks: {deduplicator.dropped} of {deduplicator.checked} dropped; "
+            f"{updated} canonical chunks updated after upload."
+        )
 
-    print(f"Embedding complete for {len(chunk_texts)} chunks.")
-    chunk_records = _build_chunk_records(df, chunk_map, chunk_texts, embeddings)
-    _upload_records(collection, chunk_records)
-    _backup_records_to_gcs(chunk_records)
+    if fingerprints is not None:
+        print(
+            f"Delta ingest: {fingerprints.new} new, {fingerprints.changed} changed, "
+            f"{fingerprints.unchanged} unchanged articles."
+        )
+        fingerprints.close()
+
+    print_stage_stats(stats)
+    if requeue_stats:
+        print("Re-ingest pass:")
+        print_stage_stats(requeue_stats)
+    chunk_stats.report()
+    uploader.print_summary()
+    dump_summary(
+        "Ingest metrics",
+        extra={
+            "embedding": embedding_metrics(),
+            "stages": [st.as_dict() for st in stats],
+            "requeue_stages": [st.as_dict() for st in requeue_stats],
+            "chunk_lengths": chunk_stats.summary(),
+        },
+    )
+    if uploader.failed_ids:
+        # Their batches were not journaled, so a rerun picks them up again.
+        raise SystemExit(f"{len(uploader.failed_ids)} records could not be uploaded; rerun to retry them.")
 
 
 if __name__ == "__main__":
-    main()
+    parser = ArgumentParser()
+    parser.add_argument("--fresh", action="store_true", help="Discard the run journal and start from scratch")
+    parser.add_argument("--no-journal", action="store_true", help="Do not read or write the run journal")
+    parser.add_argument(
+        "--delta", action="store_true", help="Only ingest articles that are new or changed since the last delta run"
+    )
+    parser.add_argument(
+        "--prune", action="store_true", help="With --delta, delete articles that are no longer in the source folder"
+    )
+    args = parser.parse_args()
+    if args.prune and not args.delta:
+        parser.error("--prune requires --delta")
+    main(args)
@@ -9,6 +9,11 @@ from unittest.mock import Mock
 import google.genai as genai
 from google.genai import types
 
+try:
+    from .src.embedding_backends import EMBEDDING_BACKEND, get_local_backend
+except ImportError:  # run as a script: python query_rag_model.py
+    from src.embedding_backends import EMBEDDING_BACKEND, get_local_backend
+
 
 """This file allows you to chat with a Large Language Model (LLM) using Retrieval Augmented Generation (RAG).
 It performs the following steps:
@@ -75,6 +80,9 @@ llm_client = None
 
 # Generate embedding for a query
 def generate_query_embedding(query):
+    if EMBEDDING_BACKEND != "vertex":
+        # must match the backend the collection was ingested with
+        return get_local_backend(EMBEDDING_BACKEND).embed([query], EMBEDDING_DIMENSION)[0]
     kwargs = {"output_dimensionality": EMBEDDING_DIMENSION}
     client = llm_client or get_llm_client()
     response = client.models.embed_content(
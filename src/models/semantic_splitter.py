@@ -1,92 +1,63 @@
 """Experimental **text splitter** based on semantic similarity."""
 
 import copy
+import multiprocessing
 import re
-from typing import Any, Dict, Iterable, List, Literal, Optional, Sequence, Tuple, cast
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Tuple, cast
 
 import numpy as np
-from langchain_community.utils.math import (
-    cosine_similarity,
-)
 from langchain_core.documents import BaseDocumentTransformer, Document
 
+from .src.embedder import embed_texts
+from .src.metrics import SIZE_BUCKETS, dump_summary, registry
+
 # from langchain_core.embeddings import Embeddings
 
 
-def combine_sentences(sentences: List[dict], buffer_size: int = 1) -> List[dict]:
-    """Combine sentences based on buffer size.
+def combine_sentences(sentences: Sequence[str], buffer_size: int = 1) -> List[str]:
+    """Build the sentence window around each sentence.
 
     Args:
-        sentences: List of sentences to combine.
-        buffer_size: Number of sentences to combine. Defaults to 1.
+        sentences: Sentences of one document.
+        buffer_size: Number of neighbouring sentences on each side. Defaults to 1.
 
     Returns:
-        List of sentences with combined sentences.
+        One window per sentence: the sentence joined with up to ``buffer_size``
+        sentences before and after it.
     """
+    count = len(sentences)
+    return [" ".join(sentences[max(0, i - buffer_size) : i + 1 + buffer_size]) for i in range(count)]
 
-    # Go through each sentence dict
-    for i in range(len(sentences)):
-        # Create a string that will hold the sentences which are joined
-        combined_sentence = ""
-
-        # Add sentences before the current one, based on the buffer size.
-        for j in range(i - buffer_size, i):
-            # Check if the index j is not negative
-            # (to avoid index out of range like on the first one)
-            if j >= 0:
-                # Add the sentence at index j to the combined_sentence string
-                combined_sentence += sentences[j]["sentence"] + " "
-
-        # Add the current sentence
-        combined_sentence += sentences[i]["sentence"]
-
-        # Add sentences after the current one, based on the buffer size
-        for j in range(i + 1, i + 1 + buffer_size):
-            # Check if the index j is within the range of the sentences list
-            if j < len(sentences):
-                # Add the sentence at index j to the combined_sentence string
-                combined_sentence += " " + sentences[j]["sentence"]
-
-        # Then add the whole thing to your dict
-        # Store the combined sentence in the current sentence dict
-        sentences[i]["combined_sentence"] = combined_sentence
 
-    return sentences
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Scale every row to unit length; all-zero rows stay zero."""
+    matrix = np.asarray(matrix, dtype=np.float64)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
 
 
-def calculate_cosine_distances(sentences: List[dict]) -> Tuple[List[float], List[dict]]:
-    """Calculate cosine distances between sentences.
+def calculate_cosine_distances(embeddings: np.ndarray, normalized: bool = False) -> np.ndarray:
+    """Cosine distance between each row of ``embeddings`` and the next one.
 
     Args:
-        sentences: List of sentences to calculate distances for.
+        embeddings: Sentence (window) embedding matrix, one row per sentence.
+        normalized: Whether the rows already have unit length.
 
     Returns:
-        Tuple of distances and sentences.
+        Array of ``len(embeddings) - 1`` distances.
     """
-    distances = []
-    for i in range(len(sentences) - 1):
-        embedding_current = sentences[i]["combined_sentence_embedding"]
-        embedding_next = sentences[i + 1]["combined_sentence_embedding"]
-
-        # Calculate cosine similarity
-        similarity = cosine_similarity([embedding_current], [embedding_next])[0][0]
-
-        # Convert to cosine distance
-        distance = 1 - similarity
-
-        # Append cosine distance to the list
-        distances.append(distance)
-
-        # Store distance in the dictionary
-        sentences[i]["distance_to_next"] = distance
-
-    # Optionally handle the last sentence
-    # sentences[-1]['distance_to_next'] = None  # or a default value
-
-    return distances, sentences
+    matrix = np.asarray(embeddings, dtype=np.float64) if normalized else normalize_rows(embeddings)
+    if len(matrix) < 2:
+        return np.zeros(0, dtype=np.float64)
+    return 1.0 - np.einsum("ij,ij->i", matrix[:-1], matrix[1:])
 
 
 BreakpointThresholdType = Literal["percentile", "standard_deviation", "interquartile", "gradient"]
+WindowEmbeddingMode = Literal["exact", "pooled"]
 BREAKPOINT_DEFAULTS: Dict[BreakpointThresholdType, float] = {
     "percentile": 95,
     "standard_deviation": 3,
@@ -116,6 +87,14 @@ class SemanticChunker(BaseDocumentTransformer):
         number_of_chunks: Optional[int] = None,
         sentence_split_regex: str = r"(?<=[.?!])\s+",
         embedding_function=None,
+        embedding_batch_size: int = 250,
+        embedding_batch_chars: int = 60000,
+        max_pending_windows: int = 10000,
+        window_embedding: WindowEmbeddingMode = "exact",
+        workers: int = 1,
+        documents_per_task: int = 500,
+        embedding_workers: int = 1,
+        report_metrics: bool = True,
     ):
         self._add_start_index = add_start_index
         self.buffer_size = buffer_size
@@ -126,51 +105,65 @@ class SemanticChunker(BaseDocumentTransformer):
             self.breakpoint_threshold_amount = BREAKPOINT_DEFAULTS[breakpoint_threshold_type]
         else:
             self.breakpoint_threshold_amount = breakpoint_threshold_amount
-        self.embedding_function = embedding_function
-
-    def _calculate_breakpoint_threshold(self, distances: List[float]) -> Tuple[float, List[float]]:
+        # By default requests go through ``embedder.embed_texts``, whose region pool and token buckets are shared
+        # by every embedding caller in the process, so the chunker's threads stay within the same quota.
+        self.embedding_function = embedding_function if embedding_function is not None else embed_texts
+        # Sentence windows of many documents are packed into requests of this many texts / characters.
+        self.embedding_batch_size = max(1, embedding_batch_size)
+        self.embedding_batch_chars = embedding_batch_chars
+        self.max_pending_windows = max(1, max_pending_windows)
+        if window_embedding not in ("exact", "pooled"):
+            raise ValueError(f"Got unexpected `window_embedding`: {window_embedding}")
+        # "pooled" embeds every sentence once and derives windows and chunks from the sentence vectors.
+        self.window_embedding = window_embedding
+        self.embedding_stats = {"requests": 0, "texts": 0, "chars": 0}
+        # workers > 1 segments and cuts in a process pool; embedding stays in this process, where
+        # ``embedding_workers`` threads send packed requests through the one ``embedding_function``.
+        self.workers = max(1, workers)
+        self.documents_per_task = max(1, documents_per_task)
+        self.embedding_workers = max(1, embedding_workers)
+        # Print the embedding metrics summary as JSON whenever a run over a text iterable finishes
+        # (``split_text`` on a single text does not report).
+        self.report_metrics = report_metrics
+
+    def _calculate_breakpoint_threshold(self, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Thresholds for the last axis of ``distances``, which may be one document's distances or a matrix
+        of equally long documents. Returns ``(thresholds, breakpoint_array)`` with the thresholds kept
+        broadcastable against the breakpoint array.
+        """
+        distances = np.asarray(distances, dtype=np.float64)
         if self.breakpoint_threshold_type == "percentile":
-            return (
-                cast(
-                    float,
-                    np.percentile(distances, self.breakpoint_threshold_amount),
-                ),
-                distances,
-            )
+            return np.percentile(distances, self.breakpoint_threshold_amount, axis=-1, keepdims=True), distances
         elif self.breakpoint_threshold_type == "standard_deviation":
             return (
-                cast(
-                    float,
-                    np.mean(distances) + self.breakpoint_threshold_amount * np.std(distances),
-                ),
+                distances.mean(axis=-1, keepdims=True)
+                + self.breakpoint_threshold_amount * distances.std(axis=-1, keepdims=True),
                 distances,
             )
         elif self.breakpoint_threshold_type == "interquartile":
-            q1, q3 = np.percentile(distances, [25, 75])
+            q1, q3 = np.percentile(distances, [25, 75], axis=-1, keepdims=True)
             iqr = q3 - q1
 
-            return np.mean(distances) + self.breakpoint_threshold_amount * iqr, distances
+            return distances.mean(axis=-1, keepdims=True) + self.breakpoint_threshold_amount * iqr, distances
         elif self.breakpoint_threshold_type == "gradient":
             # Calculate the threshold based on the distribution of gradient of distance array. # noqa: E501
-            distance_gradient = np.gradient(distances, range(0, len(distances)))
+            distance_gradient = np.gradient(distances, axis=-1)
             return (
-                cast(
-                    float,
-                    np.percentile(distance_gradient, self.breakpoint_threshold_amount),
-                ),
+                np.percentile(distance_gradient, self.breakpoint_threshold_amount, axis=-1, keepdims=True),
                 distance_gradient,
             )
         else:
             raise ValueError(f"Got unexpected `breakpoint_threshold_type`: " f"{self.breakpoint_threshold_type}")
 
-    def _threshold_from_clusters(self, distances: List[float]) -> float:
+    def _threshold_from_clusters(self, distances: np.ndarray) -> np.ndarray:
         """
         Calculate the threshold based on the number of chunks.
         Inverse of percentile method.
         """
         if self.number_of_chunks is None:
             raise ValueError("This should never be called if `number_of_chunks` is None.")
-        x1, y1 = len(distances), 0.0
+        x1, y1 = distances.shape[-1], 0.0
         x2, y2 = 1.0, 100.0
 
         x = max(min(self.number_of_chunks, x1), x2)
@@ -183,82 +176,322 @@ class SemanticChunker(BaseDocumentTransformer):
 
         y = min(max(y, 0), 100)
 
-        return cast(float, np.percentile(distances, y))
-
-    def _calculate_sentence_distances(self, single_sentences_list: List[str]) -> Tuple[List[float], List[dict]]:
-        """Split text into multiple components."""
+        return cast(np.ndarray, np.percentile(distances, y, axis=-1, keepdims=True))
 
-        _sentences = [{"sentence": x, "index": i} for i, x in enumerate(single_sentences_list)]
-        sentences = combine_sentences(_sentences, self.buffer_size)
-        # print(sentences)
-        # embeddings = self.embeddings.embed_documents(
-        #     [x["combined_sentence"] for x in sentences]
-        # )
-        embeddings = self.embedding_function([x["combined_sentence"] for x in sentences], batch_size=50)
-        for i, sentence in enumerate(sentences):
-            sentence["combined_sentence_embedding"] = embeddings[i]
-
-        return calculate_cosine_distances(sentences)
+    def _breakpoints(self, distances: np.ndarray) -> np.ndarray:
+        """Boolean mask of the distances above their document's threshold, for a matrix of equal-length documents."""
+        if self.number_of_chunks is not None:
+            return distances > self._threshold_from_clusters(distances)
+        thresholds, breakpoint_array = self._calculate_breakpoint_threshold(distances)
+        return breakpoint_array > thresholds
 
-    def split_text(
-        self,
-        text: str,
-    ) -> List[str]:
+    def _split_sentences(self, text: str) -> List[str]:
         # Splitting the essay (by default on '.', '?', and '!')
-        single_sentences_list = re.split(self.sentence_split_regex, text)
+        return re.split(self.sentence_split_regex, text)
 
+    def _needs_embedding(self, single_sentences_list: List[str]) -> bool:
         # having len(single_sentences_list) == 1 would cause the following
         # np.percentile to fail.
         if len(single_sentences_list) == 1:
-            return single_sentences_list
+            return False
         # similarly, the following np.gradient would fail
         if self.breakpoint_threshold_type == "gradient" and len(single_sentences_list) == 2:
-            return single_sentences_list
-        distances, sentences = self._calculate_sentence_distances(single_sentences_list)
-        if self.number_of_chunks is not None:
-            breakpoint_distance_threshold = self._threshold_from_clusters(distances)
-            breakpoint_array = distances
-        else:
-            (
-                breakpoint_distance_threshold,
-                breakpoint_array,
-            ) = self._calculate_breakpoint_threshold(distances)
-
-        indices_above_thresh = [i for i, x in enumerate(breakpoint_array) if x > breakpoint_distance_threshold]
+            return False
+        return True
 
-        chunks = []
-        start_index = 0
-
-        # Iterate through the breakpoints to slice the sentences
-        for index in indices_above_thresh:
-            # The end index is the current breakpoint
-            end_index = index
+    def _embed_packed(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed ``texts`` in requests of at most ``embedding_batch_size`` texts and ``embedding_batch_chars``
+        characters, so windows from many documents share one request instead of one request per document.
+        With ``embedding_workers`` > 1 the requests are sent concurrently.
+        """
+        packs: List[Tuple[int, int, int]] = []
+        start = 0
+        while start < len(texts):
+            end = start
+            chars = 0
+            while end < len(texts) and end - start < self.embedding_batch_size:
+                if end > start and chars + len(texts[end]) > self.embedding_batch_chars:
+                    break
+                chars += len(texts[end])
+                end += 1
+            packs.append((start, end, chars))
+            start = end
+
+        def embed(pack: Tuple[int, int, int]) -> List[List[float]]:
+            start, end, _ = pack
+            started = time.perf_counter()
+            embeddings = self.embedding_function(texts[start:end], batch_size=end - start)
+            registry.observe("semantic.request_seconds", time.perf_counter() - started)
+            registry.observe("semantic.request_texts", end - start, SIZE_BUCKETS)
+            return embeddings
+
+        if self.embedding_workers > 1 and len(packs) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.embedding_workers, len(packs))) as executor:
+                batches = list(executor.map(embed, packs))
+        else:
+            batches = [embed(pack) for pack in packs]
+
+        embeddings: List[List[float]] = []
+        for (start, end, chars), batch in zip(packs, batches):
+            if len(batch) != end - start:
+                raise ValueError(f"Embedding function returned {len(batch)} embeddings for {end - start} texts.")
+            embeddings.extend(batch)
+            self.embedding_stats["requests"] += 1
+            self.embedding_stats["texts"] += end - start
+            self.embedding_stats["chars"] += chars
+        registry.inc("semantic.requests", len(packs))
+        registry.inc("semantic.texts", len(texts))
+        registry.inc("semantic.chars", sum(pack[2] for pack in packs))
+        return embeddings
+
+    def _group_breakpoints(self, distances: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> List[np.ndarray]:
+        """
+        Breakpoint positions for each document, whose distances are ``distances[start : start + length]``.
+        Documents with the same number of sentences are stacked into one matrix so thresholds and
+        comparisons run once per sentence count instead of once per document.
+        """
+        breakpoints: List[np.ndarray] = [np.zeros(0, dtype=np.int64)] * len(starts)
+        for length in np.unique(lengths):
+            members = np.flatnonzero(lengths == length)
+            matrix = distances[starts[members, None] + np.arange(length)]
+            mask = self._breakpoints(matrix)
+            for member, row in zip(members.tolist(), mask):
+                breakpoints[member] = np.flatnonzero(row)
+        return breakpoints
+
+    def _pooled_windows(self, sentence_matrix: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+        """
+        Window embeddings as the normalised sum of each window's normalised sentence vectors. Every
+        document's sentences are the rows ``starts[d] : starts[d] + lengths[d]`` of ``sentence_matrix``;
+        one cumulative sum over the whole group gives every window as a difference of two rows.
+        """
+        cumulative = np.vstack([np.zeros((1, sentence_matrix.shape[1])), np.cumsum(sentence_matrix, axis=0)])
+        doc_starts = np.repeat(starts, lengths)
+        doc_ends = doc_starts + np.repeat(lengths, lengths)
+        index = np.arange(len(sentence_matrix))
+        lower = np.maximum(index - self.buffer_size, doc_starts)
+        upper = np.minimum(index + self.buffer_size + 1, doc_ends)
+        return normalize_rows(cumulative[upper] - cumulative[lower])
+
+    def _plan_group(
+        self, sentence_lists: List[List[str]], with_embeddings: bool
+    ) -> Tuple[List[str], List[int], List[int]]:
+        """
+        Texts to embed for a group of segmented documents, the positions of the documents they belong to and
+        where each of those documents starts in the texts. In ``exact`` mode these are the sentence windows;
+        in ``pooled`` mode every sentence once.
+        """
+        pooled = self.window_embedding == "pooled"
+        texts: List[str] = []
+        starts: List[int] = []
+        embedded: List[int] = []
+        for position, single_sentences_list in enumerate(sentence_lists):
+            wants_vectors = pooled and with_embeddings and any(sentence.strip() for sentence in single_sentences_list)
+            if self._needs_embedding(single_sentences_list) or wants_vectors:
+                embedded.append(position)
+                starts.append(len(texts))
+                if pooled:
+                    texts.extend(single_sentences_list)
+                else:
+                    texts.extend(combine_sentences(single_sentences_list, self.buffer_size))
+        return texts, embedded, starts
+
+    def _chunk_group(
+        self,
+        sentence_lists: List[List[str]],
+        embedded: List[int],
+        starts: List[int],
+        embeddings: Any,
+        with_embeddings: bool,
+    ) -> List[Tuple[List[str], Optional[np.ndarray]]]:
+        """
+        Cut the documents of a planned group into chunks given the embeddings of the planned texts. Pure CPU
+        work, so it can run in a worker process. Chunk vectors are only filled in here for ``pooled`` mode.
+        """
+        pooled = self.window_embedding == "pooled"
+        chunk_lists = [list(single_sentences_list) for single_sentences_list in sentence_lists]
+        bounds_by_position = {}
+        if embedded:
+            matrix = normalize_rows(np.asarray(embeddings, dtype=np.float64))
+            start_array = np.asarray(starts, dtype=np.int64)
+            sentence_counts = np.asarray([len(sentence_lists[position]) for position in embedded], dtype=np.int64)
+            windows = self._pooled_windows(matrix, start_array, sentence_counts) if pooled else matrix
+
+            # Distances between adjacent windows of the whole group in one product; the pairs that straddle two
+            # documents are simply never sliced out.
+            distances = calculate_cosine_distances(windows, normalized=True)
+            chunked = [i for i, position in enumerate(embedded) if self._needs_embedding(sentence_lists[position])]
+            breakpoints = self._group_breakpoints(distances, start_array[chunked], sentence_counts[chunked] - 1)
+
+            for i, indices in zip(chunked, breakpoints):
+                sentences = sentence_lists[embedded[i]]
+                bounds = [0, *(indices + 1).tolist(), len(sentences)]
+                bounds_by_position[embedded[i]] = bounds
+                chunk_lists[embedded[i]] = [" ".join(sentences[a:b]) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        if not (with_embeddings and pooled):
+            return [(chunks, None) for chunks in chunk_lists]
+
+        results = []
+        dimension = matrix.shape[1] if embedded else 0
+        cumulative = np.vstack([np.zeros((1, dimension)), np.cumsum(matrix, axis=0)]) if embedded else None
+        row_of = {position: start for position, start in zip(embedded, starts)}
+        for position, chunks in enumerate(chunk_lists):
+            if position not in row_of:  # a blank document
+                results.append((chunks, np.zeros((len(chunks), dimension))))
+                continue
+            count = len(sentence_lists[position])
+            bounds = np.asarray(bounds_by_position.get(position, range(count + 1)), dtype=np.int64)
+            rows = row_of[position] + bounds
+            results.append((chunks, normalize_rows(cumulative[rows[1:]] - cumulative[rows[:-1]])))
+        return results
+
+    def _embed_nonblank(self, texts: List[str]) -> np.ndarray:
+        """
+        One row per text; blank texts (e.g. the empty split after a trailing ". ") are not sent, since
+        embedding services drop them, and get zero rows, which add nothing to pooled sums.
+        """
+        keep = [i for i, text in enumerate(texts) if text.strip()]
+        if not keep:
+            return np.zeros((len(texts), 0))
+        vectors = np.asarray(self._embed_packed([texts[i] for i in keep]), dtype=np.float64)
+        matrix = np.zeros((len(texts), vectors.shape[1]))
+        matrix[keep] = vectors
+        return matrix
+
+    def _embed_chunk_texts(
+        self, results: List[Tuple[List[str], Optional[np.ndarray]]]
+    ) -> List[Tuple[List[str], np.ndarray]]:
+        """Exact mode pays for a second pass over the final chunk texts; blank chunks get zero vectors."""
+        chunk_lists = [chunks for chunks, _ in results]
+        flat = [chunk for chunks in chunk_lists for chunk in chunks]
+        chunk_matrix = normalize_rows(self._embed_nonblank(flat))
+        offsets = np.cumsum([0] + [len(chunks) for chunks in chunk_lists])
+        return [(chunks, chunk_matrix[offsets[i] : offsets[i + 1]]) for i, chunks in enumerate(chunk_lists)]
+
+    def _split_group(
+        self, sentence_lists: List[List[str]], with_embeddings: bool = False
+    ) -> List[Tuple[List[str], Optional[np.ndarray]]]:
+        """
+        Chunk already segmented documents with one packed embedding pass over the whole group. In
+        ``exact`` mode every sentence window is embedded; in ``pooled`` mode every sentence is embedded
+        once and windows (and, if requested, chunks) are pooled from the sentence vectors.
+        """
+        texts, embedded, starts = self._plan_group(sentence_lists, with_embeddings)
+        embeddings = self._embed_nonblank(texts) if texts else []
+        results = self._chunk_group(sentence_lists, embedded, starts, embeddings, with_embeddings)
+        if with_embeddings and self.window_embedding == "exact":
+            results = self._embed_chunk_texts(results)
+        return results
+
+    def _iter_groups(
+        self, texts: Iterable[str], with_embeddings: bool, report: bool = True
+    ) -> Iterator[Tuple[List[str], Any]]:
+        if self.workers > 1:
+            yield from self._iter_groups_parallel(texts, with_embeddings)
+        else:
+            yield from self._iter_groups_serial(texts, with_embeddings)
+        if report and self.report_metrics:
+            dump_summary("Semantic chunking metrics", extra={"embedding_stats": dict(self.embedding_stats)})
+
+    def _iter_groups_serial(self, texts: Iterable[str], with_embeddings: bool) -> Iterator[Tuple[List[str], Any]]:
+        pending: List[List[str]] = []
+        pending_windows = 0
+        for text in texts:
+            single_sentences_list = self._split_sentences(text)
+            pending.append(single_sentences_list)
+            if self._needs_embedding(single_sentences_list):
+                pending_windows += len(single_sentences_list)
+            if pending_windows >= self.max_pending_windows:
+                yield from self._split_group(pending, with_embeddings)
+                pending, pending_windows = [], 0
+        if pending:
+            yield from self._split_group(pending, with_embeddings)
+
+    def _worker_copy(self) -> "SemanticChunker":
+        # Workers only segment and cut; they never embed, so the (unpicklable) embedding client stays here.
+        clone = copy.copy(self)
+        clone.embedding_function = None
+        clone.workers = 1
+        clone.report_metrics = False
+        clone.embedding_stats = {"requests": 0, "texts": 0, "chars": 0}
+        return clone
+
+    def _iter_groups_parallel(self, texts: Iterable[str], with_embeddings: bool) -> Iterator[Tuple[List[str], Any]]:
+        """
+        Process-parallel driver: sentence segmentation and breakpoint/chunk computation run in ``workers``
+        processes, ``documents_per_task`` documents at a time, while this process embeds each planned group
+        through the one shared ``embedding_function``. Groups are yielded in input order.
+        """
+        iterator = iter(texts)
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=context, initializer=_init_worker, initargs=(self._worker_copy(),)
+        ) as pool:
+            planned: Deque[Future] = deque()
+            chunking: Deque[Future] = deque()
+
+            def plan_more():
+                while len(planned) < self.workers + 1:
+                    group = list(islice(iterator, self.documents_per_task))
+                    if not group:
+                        return
+                    planned.append(pool.submit(_plan_worker, group, with_embeddings))
+
+            plan_more()
+            while planned or chunking:
+                if planned:
+                    sentence_lists, planned_texts, embedded, starts = planned.popleft().result()
+                    plan_more()
+                    embeddings = self._embed_nonblank(planned_texts)
+                    chunking.append(
+                        pool.submit(_chunk_worker, sentence_lists, embedded, starts, embeddings, with_embeddings)
+                    )
+                while chunking and (chunking[0].done() or len(chunking) > self.workers or not planned):
+                    results = chunking.popleft().result()
+                    if with_embeddings and self.window_embedding == "exact":
+                        results = self._embed_chunk_texts(results)
+                    yield from results
+
+    def iter_split_texts(self, texts: Iterable[str]) -> Iterator[List[str]]:
+        """
+        Yield the chunks of each text, in order. Texts are segmented up front and their sentence windows
+        embedded together, ``max_pending_windows`` at a time, so memory stays bounded on large corpora.
+        """
+        for chunks, _ in self._iter_groups(texts, with_embeddings=False):
+            yield chunks
 
-            # Slice the sentence_dicts from the current start index to the end index
-            group = sentences[start_index : end_index + 1]
-            combined_text = " ".join([d["sentence"] for d in group])
-            chunks.append(combined_text)
+    def iter_split_texts_with_embeddings(self, texts: Iterable[str]) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """
+        Like ``iter_split_texts`` but also yields a unit-length embedding per chunk: pooled from the sentence
+        vectors in ``pooled`` mode, or from a packed embedding pass over the chunk texts in ``exact`` mode.
+        """
+        yield from self._iter_groups(texts, with_embeddings=True)
 
-            # Update the start index for the next group
-            start_index = index + 1
+    def split_texts(self, texts: Iterable[str]) -> List[List[str]]:
+        """Split many texts at once; sentence windows across documents are embedded in packed requests."""
+        return list(self.iter_split_texts(texts))
 
-        # The last group, if any sentences remain
-        if start_index < len(sentences):
-            combined_text = " ".join([d["sentence"] for d in sentences[start_index:]])
-            chunks.append(combined_text)
-        return chunks
+    def split_text(
+        self,
+        text: str,
+    ) -> List[str]:
+        return [chunks for chunks, _ in self._iter_groups([text], with_embeddings=False, report=False)][0]
 
     def create_documents(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[Document]:
         """Create documents from a list of texts."""
         _metadatas = metadatas or [{}] * len(texts)
         documents = []
-        for i, text in enumerate(texts):
+        for i, chunks in enumerate(self.iter_split_texts(texts)):
             start_index = 0
-            for chunk in self.split_text(text):
-                metadata = copy.deepcopy(_metadatas[i])
+            for chunk in chunks:
+                # Chunks of one text share its metadata dict (``model_construct`` skips pydantic's copy); only
+                # ``start_index`` needs a dict of its own.
+                metadata = _metadatas[i]
                 if self._add_start_index:
-                    metadata["start_index"] = start_index
-                new_doc = Document(page_content=chunk, metadata=metadata)
+                    metadata = {**metadata, "start_index": start_index}
+                new_doc = Document.model_construct(page_content=chunk, metadata=metadata)
                 documents.append(new_doc)
                 start_index += len(chunk)
         return documents
@@ -274,3 +507,74 @@ class SemanticChunker(BaseDocumentTransformer):
     def transform_documents(self, documents: Sequence[Document], **kwargs: Any) -> Sequence[Document]:
         """Transform sequence of documents by splitting them."""
         return self.split_documents(list(documents))
+
+
+_WORKER_CHUNKER: Optional[SemanticChunker] = None
+
+
+def _init_worker(chunker: SemanticChunker):
+    global _WORKER_CHUNKER
+    _WORKER_CHUNKER = chunker
+
+
+def _plan_worker(texts: List[str], with_embeddings: bool):
+    sentence_lists = [_WORKER_CHUNKER._split_sentences(text) for text in texts]
+    planned_texts, embedded, starts = _WORKER_CHUNKER._plan_group(sentence_lists, with_embeddings)
+    return sentence_lists, planned_texts, embedded, starts
+
+
+def _chunk_worker(sentence_lists, embedded, starts, embeddings, with_embeddings):
+    return _WORKER_CHUNKER._chunk_group(sentence_lists, embedded, starts, embeddings, with_embeddings)
+
+
+def _chunk_boundaries(chunks: List[str]) -> set:
+    # Chunks of the same text differ only in where they are cut; inner cut positions identify a split.
+    return set(np.cumsum([len(chunk) + 1 for chunk in chunks[:-1]]).tolist())
+
+
+def pooled_accuracy_report(texts: Sequence[str], embedding_function, **chunker_kwargs: Any) -> Dict[str, float]:
+    """
+    Run ``texts`` through the ``exact`` and ``pooled`` window modes and compare them: how many texts were
+    embedded by each, how often they cut the same chunks, and how close the pooled chunk embeddings are to
+    embeddings of the chunk texts.
+    """
+    chunker_kwargs = {"report_metrics": False, **chunker_kwargs}
+    exact = SemanticChunker(embedding_function=embedding_function, window_embedding="exact", **chunker_kwargs)
+    pooled = SemanticChunker(embedding_function=embedding_function, window_embedding="pooled", **chunker_kwargs)
+    exact_results = list(exact.iter_split_texts_with_embeddings(texts))
+    pooled_results = list(pooled.iter_split_texts_with_embeddings(texts))
+
+    identical = 0
+    true_positive = exact_cuts = pooled_cuts = 0
+    similarities: List[float] = []
+    for (exact_chunks, exact_vectors), (pooled_chunks, pooled_vectors) in zip(exact_results, pooled_results):
+        exact_bounds, pooled_bounds = _chunk_boundaries(exact_chunks), _chunk_boundaries(pooled_chunks)
+        true_positive += len(exact_bounds & pooled_bounds)
+        exact_cuts += len(exact_bounds)
+        pooled_cuts += len(pooled_bounds)
+        if exact_chunks == pooled_chunks:
+            identical += 1
+            # blank chunks have zero vectors in both modes and say nothing about accuracy
+            nonzero = np.any(exact_vectors != 0, axis=1) & np.any(pooled_vectors != 0, axis=1)
+            similarities.extend(np.einsum("ij,ij->i", exact_vectors[nonzero], pooled_vectors[nonzero]).tolist())
+
+    precision = true_positive / pooled_cuts if pooled_cuts else 1.0
+    recall = true_positive / exact_cuts if exact_cuts else 1.0
+    report = {
+        "documents": len(exact_results),
+        "identical_chunking": identical / max(len(exact_results), 1),
+        "boundary_precision": precision,
+        "boundary_recall": recall,
+        "boundary_f1": 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+        "chunk_embedding_cosine_mean": float(np.mean(similarities)) if similarities else float("nan"),
+        "chunk_embedding_cosine_min": float(np.min(similarities)) if similarities else float("nan"),
+        "exact_texts_embedded": exact.embedding_stats["texts"],
+        "pooled_texts_embedded": pooled.embedding_stats["texts"],
+        "exact_chars_embedded": exact.embedding_stats["chars"],
+        "pooled_chars_embedded": pooled.embedding_stats["chars"],
+        "exact_requests": exact.embedding_stats["requests"],
+        "pooled_requests": pooled.embedding_stats["requests"],
+    }
+    # Embedding is billed and rate limited by input size, and every window repeats its neighbours' sentences.
+    report["embedding_reduction"] = report["exact_chars_embedded"] / max(report["pooled_chars_embedded"], 1)
+    return report
@@ -0,0 +1,194 @@
+"""
+Versioned snapshots of a local Chroma persistent directory.
+
+A snapshot is a tarball of a compacted ``PersistentClient`` directory plus a JSON manifest, stored in GCS as
+``<prefix>/<version>/snapshot.tar.gz`` and ``<prefix>/<version>/manifest.json``; ``<prefix>/LATEST`` names the
+newest complete snapshot. The vector-db pod restores one from an init container instead of re-adding every
+vector over HTTP.
+
+This module only uses absolute imports so it can run on its own, e.g.
+``python snapshot.py restore --dest /chroma/chroma``.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import tarfile
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from google.cloud import storage
+
+BUCKET_NAME = os.environ.get("PROJECT_BUCKET_NAME", "pubmed-bucket-ac215")
+SNAPSHOT_BUCKET = os.environ.get("SNAPSHOT_BUCKET_NAME", BUCKET_NAME)
+SNAPSHOT_PREFIX = os.environ.get("SNAPSHOT_PREFIX", "chromadb_snapshots/pubmed_abstract_semantic")
+SNAPSHOT_UPLOAD_CHUNK_MB = int(os.environ.get("SNAPSHOT_UPLOAD_CHUNK_MB", "64"))
+
+ARCHIVE_NAME = "snapshot.tar.gz"
+MANIFEST_NAME = "manifest.json"
+LATEST_NAME = "LATEST"
+MARKER_NAME = ".snapshot_manifest.json"  # written into a restored directory
+FORMAT_VERSION = "1"
+
+
+def compact_chroma_dir(path: str):
+    """Compact a closed Chroma directory: ``chroma vacuum`` when the CLI is available, else a plain SQLite VACUUM."""
+    if shutil.which("chroma"):
+        subprocess.run(["chroma", "vacuum", "--path", path, "--force"], check=True)
+        return
+    connection = sqlite3.connect(os.path.join(path, "chroma.sqlite3"))
+    try:
+        connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def create_snapshot(
+    source_dir: str,
+    bucket,
+    prefix: str = SNAPSHOT_PREFIX,
+    version: Optional[str] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Tar ``source_dir`` and upload it with a manifest as a new snapshot version, then point ``LATEST`` at it.
+    ``LATEST`` is written last, so a failed upload never becomes the snapshot that pods restore.
+    """
+    version = version or datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    prefix = prefix.rstrip("/")
+    with tempfile.TemporaryDirectory() as workdir:
+        archive_path = os.path.join(workdir, ARCHIVE_NAME)
+        # Vectors barely compress; a fast level keeps tarring from dominating the build.
+        with tarfile.open(archive_path, "w:gz", compresslevel=1) as tar:
+            for entry in sorted(os.listdir(source_dir)):
+                if entry != MARKER_NAME:
+                    tar.add(os.path.join(source_dir, entry), arcname=entry)
+
+        manifest = {
+            "format_version": FORMAT_VERSION,
+            "version": version,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "archive": ARCHIVE_NAME,
+            "archive_bytes": os.path.getsize(archive_path),
+            "sha256": _sha256(archive_path),
+            **(metadata or {}),
+        }
+        print(f"Uploading snapshot {version} ({manifest['archive_bytes'] / 1024 / 1024:.1f} MB) to {prefix}/{version}/")
+        archive_blob = bucket.blob(
+            f"{prefix}/{version}/{ARCHIVE_NAME}", chunk_size=SNAPSHOT_UPLOAD_CHUNK_MB * 1024 * 1024
+        )
+        archive_blob.upload_from_filename(archive_path)
+
+    bucket.blob(f"{prefix}/{version}/{MANIFEST_NAME}").upload_from_string(
+        json.dumps(manifest, indent=2), content_type="application/json"
+    )
+    bucket.blob(f"{prefix}/{LATEST_NAME}").upload_from_string(version, content_type="text/plain")
+    print(f"✅ Snapshot {version} published; {prefix}/{LATEST_NAME} -> {version}")
+    return manifest
+
+
+def _read_marker(dest: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(os.path.join(dest, MARKER_NAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def restore_snapshot(
+    bucket, dest: str, prefix: str = SNAPSHOT_PREFIX, version: str = "latest", force: bool = False
+) -> Optional[Dict[str, Any]]:
+    """
+    Restore a snapshot into ``dest`` and return its manifest, or ``None`` when nothing was done.
+
+    ``dest`` is left alone when it already holds this snapshot version, or when it holds a database that
+    was not restored from a snapshot (unless ``force``). Otherwise its contents are replaced; ``dest``
+    itself is kept because it is usually a volume mount.
+    """
+    prefix = prefix.rstrip("/")
+    if version == "latest":
+        version = bucket.blob(f"{prefix}/{LATEST_NAME}").download_as_text().strip()
+    manifest = json.loads(bucket.blob(f"{prefix}/{version}/{MANIFEST_NAME}").download_as_text())
+
+    os.makedirs(dest, exist_ok=True)
+    marker = _read_marker(dest)
+    if marker is not None and marker.get("version") == version and not force:
+        print(f"{dest} already holds snapshot {version}; nothing to restore.")
+        return None
+    if marker is None and os.path.exists(os.path.join(dest, "chroma.sqlite3")) and not force:
+        print(f"{dest} holds a database that was not restored from a snapshot; pass --force to replace it.")
+        return None
+
+    staging = tempfile.mkdtemp(prefix=".snapshot-", dir=dest)
+    try:
+        archive_path = os.path.join(staging, ARCHIVE_NAME)
+        print(f"Downloading snapshot {version} ({manifest['archive_bytes'] / 1024 / 1024:.1f} MB)...")
+        bucket.blob(f"{prefix}/{version}/{manifest['archive']}").download_to_filename(archive_path)
+        if _sha256(archive_path) != manifest["sha256"]:
+            raise ValueError(f"Checksum mismatch for snapshot {version}")
+
+        extracted = os.path.join(staging, "data")
+        with tarfile.open(archive_path, "r:gz") as tar:
+            tar.extractall(extracted, filter="data")
+
+        for entry in os.listdir(dest):
+            path = os.path.join(dest, entry)
+            if path == staging:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        for entry in os.listdir(extracted):
+            shutil.move(os.path.join(extracted, entry), os.path.join(dest, entry))
+        with open(os.path.join(dest, MARKER_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    print(f"✅ Restored snapshot {version} into {dest}")
+    return manifest
+
+
+def main():
+    parser = ArgumentParser(description="Publish or restore Chroma directory snapshots in GCS")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    create_parser = subparsers.add_parser("create", help="Compact a local Chroma directory and publish it")
+    create_parser.add_argument("--source", required=True, help="Chroma persistent directory (not in use)")
+    create_parser.add_argument("--version", help="Snapshot version (defaults to a UTC timestamp)")
+
+    restore_parser = subparsers.add_parser("restore", help="Restore a snapshot into a Chroma directory")
+    restore_parser.add_argument("--dest", required=True, help="Target Chroma persistent directory")
+    restore_parser.add_argument("--version", default="latest", help="Snapshot version or 'latest'")
+    restore_parser.add_argument("--force", action="store_true", help="Replace a database not restored from a snapshot")
+
+    for sub in (create_parser, restore_parser):
+        sub.add_argument("--bucket", default=SNAPSHOT_BUCKET)
+        sub.add_argument("--prefix", default=SNAPSHOT_PREFIX)
+    args = parser.parse_args()
+
+    bucket = storage.Client().bucket(args.bucket)
+    if args.command == "create":
+        compact_chroma_dir(args.source)
+        create_snapshot(args.source, bucket, prefix=args.prefix, version=args.version)
+    else:
+        restore_snapshot(bucket, args.dest, prefix=args.prefix, version=args.version, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
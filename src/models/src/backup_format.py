@@ -0,0 +1,174 @@
+"""
+Columnar backup format for vector records.
+
+Records (``id``, ``document``, ``metadata`` and one or more embedding fields) are written to Parquet with
+zstd compression. Embeddings are stored as fixed-size-list float32 (or float16) columns instead of decimal
+text, metadata keys become typed struct fields, and any metadata that does not fit the schema inferred from
+the first batch is kept losslessly in a JSON ``extra_metadata`` column.
+"""
+
+import json
+from typing import Any, Dict, Generator, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FORMAT_VERSION = "1"
+EMBEDDING_DTYPES = {"float32": (np.float32, pa.float32()), "float16": (np.float16, pa.float16())}
+
+_SCALAR_TYPES = [(bool, pa.bool_()), (int, pa.int64()), (float, pa.float64()), (str, pa.string())]
+
+
+def _arrow_type(value: Any) -> Optional[pa.DataType]:
+    for py_type, arrow_type in _SCALAR_TYPES:
+        if isinstance(value, py_type):
+            return arrow_type
+    return None
+
+
+def _fits(value: Any, arrow_type: pa.DataType) -> bool:
+    # bool is a subclass of int, so match exact types to keep True from landing in an int64 column
+    return _arrow_type(value) == arrow_type
+
+
+class ParquetBackupWriter:
+    """Incrementally writes batches of records to one Parquet file."""
+
+    def __init__(
+        self,
+        path: str,
+        embedding_keys: Sequence[str] = ("embedding",),
+        embedding_dtype: str = "float32",
+        compression_level: int = 3,
+    ):
+        if embedding_dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype: {embedding_dtype}")
+        self.path = path
+        self.embedding_keys = list(embedding_keys)
+        self.embedding_dtype = embedding_dtype
+        self.compression_level = compression_level
+        self.record_count = 0
+        self._writer: Optional[pq.ParquetWriter] = None
+        self._schema: Optional[pa.Schema] = None
+        self._metadata_fields: Dict[str, pa.DataType] = {}
+
+    def _build_schema(self, records: Sequence[Dict[str, Any]]) -> pa.Schema:
+        for record in records:
+            for key, value in (record.get("metadata") or {}).items():
+                if key not in self._metadata_fields and _arrow_type(value) is not None:
+                    self._metadata_fields[key] = _arrow_type(value)
+
+        _, value_type = EMBEDDING_DTYPES[self.embedding_dtype]
+        fields = [
+            pa.field("id", pa.string(), nullable=False),
+            pa.field("document", pa.string()),
+        ]
+        # Parquet cannot store an empty struct, so the column is left out when no metadata key was typed.
+        if self._metadata_fields:
+            fields.append(pa.field("metadata", pa.struct([pa.field(k, t) for k, t in self._metadata_fields.items()])))
+        fields.append(pa.field("extra_metadata", pa.string()))
+        file_metadata = {"format_version": FORMAT_VERSION, "embedding_dtype": self.embedding_dtype}
+        for key in self.embedding_keys:
+            dim = len(records[0][key])
+            fields.append(pa.field(key, pa.list_(value_type, dim)))
+            file_metadata[f"dim:{key}"] = str(dim)
+        return pa.schema(fields, metadata=file_metadata)
+
+    def write(self, records: Sequence[Dict[str, Any]]):
+        if not records:
+            return
+        if self._schema is None:
+            self._schema = self._build_schema(records)
+            self._writer = pq.ParquetWriter(
+                self.path, self._schema, compression="zstd", compression_level=self.compression_level
+            )
+
+        metadata_columns: Dict[str, List[Any]] = {key: [] for key in self._metadata_fields}
+        extras: List[Optional[str]] = []
+        for record in records:
+            extra = {}
+            metadata = record.get("metadata") or {}
+            for key, arrow_type in self._metadata_fields.items():
+                value = metadata.get(key)
+                metadata_columns[key].append(value if value is not None and _fits(value, arrow_type) else None)
+            for key, value in metadata.items():
+                if value is not None and (
+                    key not in self._metadata_fields or not _fits(value, self._metadata_fields[key])
+                ):
+                    extra[key] = value
+            extras.append(json.dumps(extra) if extra else None)
+
+        np_dtype, value_type = EMBEDDING_DTYPES[self.embedding_dtype]
+        columns = [
+            pa.array([record["id"] for record in records], type=pa.string()),
+            pa.array([record.get("document") for record in records], type=pa.string()),
+        ]
+        if self._metadata_fields:
+            columns.append(
+                pa.StructArray.from_arrays(
+                    [pa.array(values, type=self._metadata_fields[key]) for key, values in metadata_columns.items()],
+                    fields=list(self._schema.field("metadata").type),
+                )
+            )
+        columns.append(pa.array(extras, type=pa.string()))
+        for key in self.embedding_keys:
+            matrix = np.asarray([record[key] for record in records], dtype=np_dtype)
+            dim = self._schema.field(key).type.list_size
+            if matrix.ndim != 2 or matrix.shape[1] != dim:
+                raise ValueError(f"Embedding '{key}' must have dimension {dim}, got shape {matrix.shape}.")
+            columns.append(pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1), type=value_type), dim))
+
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self._schema))
+        self.record_count += len(records)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+def write_backup_parquet(records: Sequence[Dict[str, Any]], path: str, **kwargs) -> int:
+    """Write ``records`` to ``path`` in one go; returns the number of records written."""
+    writer = ParquetBackupWriter(path, **kwargs)
+    try:
+        writer.write(records)
+    finally:
+        writer.close()
+    return writer.record_count
+
+
+def iter_backup_parquet(
+    path: str, batch_size: int = 4096, memory_map: bool = True
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Stream the records of a local Parquet backup, memory-mapping the file by default.
+    Yields dicts shaped like the JSONL backups (embeddings as lists of float32 values).
+    """
+    source = pa.memory_map(path, "r") if memory_map else path
+    parquet_file = pq.ParquetFile(source)
+    schema = parquet_file.schema_arrow
+    embedding_keys = [
+        name.split(":", 1)[1] for name in (k.decode() for k in (schema.metadata or {})) if name.startswith("dim:")
+    ]
+
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        ids = batch.column("id").to_pylist()
+        documents = batch.column("document").to_pylist()
+        has_metadata = batch.schema.get_field_index("metadata") >= 0
+        metadatas = batch.column("metadata").to_pylist() if has_metadata else [None] * batch.num_rows
+        extras = batch.column("extra_metadata").to_pylist()
+        embeddings = {}
+        for key in embedding_keys:
+            column = batch.column(key)
+            values = column.values.to_numpy(zero_copy_only=False).astype(np.float32, copy=False)
+            embeddings[key] = values.reshape(len(column), column.type.list_size).tolist()
+
+        for row, record_id in enumerate(ids):
+            metadata = {k: v for k, v in (metadatas[row] or {}).items() if v is not None}
+            if extras[row]:
+                metadata.update(json.loads(extras[row]))
+            record = {"id": record_id, "document": documents[row], "metadata": metadata}
+            for key in embedding_keys:
+                record[key] = embeddings[key][row]
+            yield record
@@ -0,0 +1,180 @@
+"""Rolling backup sink: writes records to compressed part files and uploads each part while ingest continues."""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+
+from .backup_format import ParquetBackupWriter
+
+BACKUP_PART_MB = float(os.environ.get("BACKUP_PART_MB", "256"))
+BACKUP_UPLOAD_CHUNK_MB = int(os.environ.get("BACKUP_UPLOAD_CHUNK_MB", "16"))
+BACKUP_UPLOAD_WORKERS = int(os.environ.get("BACKUP_UPLOAD_WORKERS", "2"))
+
+PART_SUFFIXES = {"parquet": ".parquet", "jsonl": ".jsonl.gz"}
+# One PMID per line; every record of those PMIDs in an earlier backup run is superseded (see gcs.load_tombstones).
+TOMBSTONE_SUFFIX = ".tombstones.txt"
+
+# GCS resumable uploads need chunk sizes that are a multiple of 256 KiB.
+_CHUNK_ALIGNMENT = 256 * 1024
+
+
+class _Part:
+    """One local part file; either a Parquet writer or a gzip-compressed JSONL stream."""
+
+    def __init__(self, backup_format: str, embedding_dtype: str):
+        suffix = PART_SUFFIXES[backup_format]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmpfile:
+            self.path = tmpfile.name
+        self.record_count = 0
+        self._parquet: Optional[ParquetBackupWriter] = None
+        self._gzip = None
+        if backup_format == "parquet":
+            self._parquet = ParquetBackupWriter(self.path, embedding_dtype=embedding_dtype)
+        else:
+            self._gzip = gzip.open(self.path, "wt", encoding="utf-8", compresslevel=6)
+
+    def write(self, records: Sequence[Dict[str, Any]]):
+        if self._parquet is not None:
+            self._parquet.write(records)
+        else:
+            for record in records:
+                self._gzip.write(json.dumps(record))
+                self._gzip.write("\n")
+        self.record_count += len(records)
+
+    def size(self) -> int:
+        # Compressed bytes on disk so far; Parquet only grows per row group, which is one ``write`` call.
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._gzip is not None:
+            self._gzip.close()
+            self._gzip = None
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class RollingBackupSink:
+    """
+    Backup sink for the ingest pipeline. Records are appended to a local part file; once the part reaches
+    ``part_bytes`` it is closed and handed to a background thread that uploads it to
+    ``gs://<bucket>/<prefix>/part-NNNNN<suffix>`` with a resumable, chunked upload, and a new part is started.
+    Local disk usage is therefore bounded by a few parts instead of the whole corpus, and the backup is
+    complete as soon as the last part finishes uploading.
+    """
+
+    def __init__(
+        self,
+        bucket,
+        prefix: str,
+        backup_format: str = "parquet",
+        embedding_dtype: str = "float32",
+        part_bytes: int = int(BACKUP_PART_MB * 1024 * 1024),
+        upload_chunk_bytes: int = BACKUP_UPLOAD_CHUNK_MB * 1024 * 1024,
+        upload_workers: int = BACKUP_UPLOAD_WORKERS,
+    ):
+        if backup_format not in PART_SUFFIXES:
+            raise ValueError(f"Unsupported backup format: {backup_format}")
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.backup_format = backup_format
+        self.embedding_dtype = embedding_dtype
+        self.part_bytes = max(1, part_bytes)
+        self.upload_chunk_bytes = max(_CHUNK_ALIGNMENT, upload_chunk_bytes // _CHUNK_ALIGNMENT * _CHUNK_ALIGNMENT)
+        self.record_count = 0
+        self.uploaded_blobs: List[str] = []
+
+        self._part: Optional[_Part] = None
+        self._part_index = 0
+        self._tombstone_index = 0
+        self._lock = threading.Lock()
+        self._uploaded_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="backup-upload")
+        # Closed parts waiting for upload are capped so a slow network throttles the writer instead of the disk.
+        self._slots = threading.BoundedSemaphore(max(1, upload_workers) + 1)
+        self._futures: List[Future] = []
+
+    def write(self, records: Sequence[Dict[str, Any]]):
+        if not records:
+            return
+        with self._lock:
+            if self._part is None:
+                self._part = _Part(self.backup_format, self.embedding_dtype)
+            self._part.write(records)
+            self.record_count += len(records)
+            if self._part.size() >= self.part_bytes:
+                self._roll()
+
+    def _roll(self):
+        part, self._part = self._part, None
+        part.close()
+        blob_name = f"{self.prefix}/part-{self._part_index:05d}{PART_SUFFIXES[self.backup_format]}"
+        self._part_index += 1
+        self._slots.acquire()
+        future = self._executor.submit(self._upload, part, blob_name)
+        future.add_done_callback(lambda _f: self._slots.release())
+        self._futures.append(future)
+
+    def _upload(self, part: _Part, blob_name: str):
+        try:
+            blob = self.bucket.blob(blob_name, chunk_size=self.upload_chunk_bytes)
+            blob.upload_from_filename(part.path)
+            size_mb = os.path.getsize(part.path) / (1024 * 1024)
+            print(f"Uploaded gs://{self.bucket.name}/{blob_name} ({part.record_count} records, {size_mb:.1f} MB)")
+            # Not ``self._lock``: a writer blocked on a free upload slot holds it.
+            with self._uploaded_lock:
+                self.uploaded_blobs.append(blob_name)
+        finally:
+            part.remove()
+
+    def write_tombstones(self, pmids: Sequence[str]):
+        """
+        Record that every chunk of ``pmids`` was deleted from the collection during this run, so restores drop
+        the versions in earlier runs. Uploaded synchronously; may be called after ``finish``.
+        """
+        if not pmids:
+            return
+        blob_name = f"{self.prefix}/deleted-{self._tombstone_index:05d}{TOMBSTONE_SUFFIX}"
+        self._tombstone_index += 1
+        self.bucket.blob(blob_name).upload_from_string("\n".join(pmids) + "\n", content_type="text/plain")
+        print(f"Recorded {len(pmids)} deleted articles in gs://{self.bucket.name}/{blob_name}")
+
+    def finish(self):
+        """Upload the open part and wait for every pending upload; raises if any part failed to upload."""
+        with self._lock:
+            if self._part is not None and self._part.record_count:
+                self._roll()
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True)
+        if not self.record_count:
+            print("No records available for GCS backup.")
+            return
+        print(
+            f"✅ Backed up {self.record_count} records in {len(self.uploaded_blobs)} parts to "
+            f"gs://{self.bucket.name}/{self.prefix}/"
+        )
+
+    def discard(self):
+        """Remove any local part that was not handed to the uploader."""
+        with self._lock:
+            if self._part is not None:
+                self._part.close()
+                self._part.remove()
+                self._part = None
+        self._executor.shutdown(wait=True)
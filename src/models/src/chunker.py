@@ -1,47 +1,370 @@
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 # from models.semantic_splitter import SemanticChunker
+import os
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
 import pandas as pd
 from multiprocessing import Pool, cpu_count
 
+# Below this many rows that actually need splitting, a process pool costs more than it saves.
+CHUNK_POOL_MIN_ROWS = int(os.environ.get("CHUNK_POOL_MIN_ROWS", "20000"))
+
+# Chunk sizing unit: "chars" keeps the 350/20 character chunks, "tokens" sizes chunks by estimated tokens
+# so each one fills more of the embedding model's input instead of producing many tiny vectors.
+CHUNK_UNIT = os.environ.get("CHUNK_UNIT", "chars").lower()
+CHUNK_TOKEN_BUDGET = int(os.environ.get("CHUNK_TOKEN_BUDGET", "256"))
+CHUNK_TOKEN_OVERLAP = int(os.environ.get("CHUNK_TOKEN_OVERLAP", "16"))
+CHUNK_MIN_TOKENS = int(os.environ.get("CHUNK_MIN_TOKENS", "64"))  # smaller chunks are merged into a neighbour
+
+Span = Tuple[int, int]
+
+# Word pieces, digit runs and single punctuation marks; long words count as one token per ~6 characters,
+# which tracks SentencePiece/WordPiece counts on English abstracts closely enough for sizing.
+_TOKEN_PIECE = re.compile(r"[^\W\d_]+|\d+|[^\w\s]|_")
+_CHARS_PER_WORD_TOKEN = 6
+
+
+def estimate_tokens(text: str) -> int:
+    """Fast local approximation of the embedding tokenizer's token count for ``text``."""
+    return sum(
+        (len(piece) + _CHARS_PER_WORD_TOKEN - 1) // _CHARS_PER_WORD_TOKEN for piece in _TOKEN_PIECE.findall(text)
+    )
+
 
-def _init_splitter(chunk_size: int, chunk_overlap: int):
-    global _WORKER_SPLITTER
-    _WORKER_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+def _init_splitter(chunk_size: int, chunk_overlap: int, length_function=len, min_chunk_size: int = 0):
+    global _WORKER_SPLITTER, _WORKER_OVERLAP, _WORKER_LENGTH, _WORKER_SIZES
+    _WORKER_SPLITTER = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=length_function
+    )
+    _WORKER_OVERLAP = chunk_overlap
+    _WORKER_LENGTH = length_function
+    _WORKER_SIZES = (chunk_size, min_chunk_size)
 
 
 def _split_text_worker(text: str):
     if not text or not isinstance(text, str):
         return []
-    return _WORKER_SPLITTER.split_text(text)
+    spans = _split_offsets(_WORKER_SPLITTER, text, _WORKER_OVERLAP, _WORKER_LENGTH)
+    chunk_size, min_chunk_size = _WORKER_SIZES
+    if min_chunk_size > 0:
+        spans = _merge_small_spans(text, spans, _WORKER_LENGTH, chunk_size, min_chunk_size)
+    return spans
 
 
-def chunk_abstracts(
-    df: pd.DataFrame,
+def _overlap_start(text: str, start: int, end: int, chunk_overlap: int, length_function: Callable[[str], int]) -> int:
+    """
+    Earliest offset at which the chunk after ``text[start:end]`` can begin: the smallest ``p`` such that
+    ``text[p:end]`` still fits in ``chunk_overlap``. Suffix lengths only shrink as ``p`` grows, so a
+    binary search finds it for token lengths as well as characters.
+    """
+    if length_function is len:
+        return max(0, end - chunk_overlap)
+    low, high = start, end
+    while low < high:
+        middle = (low + high) // 2
+        if length_function(text[middle:end]) <= chunk_overlap:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def _split_offsets(
+    splitter: RecursiveCharacterTextSplitter,
+    text: str,
+    chunk_overlap: int,
+    length_function: Callable[[str], int] = len,
+) -> List[Span]:
+    """
+    Split ``text`` and return each chunk as a ``(start, end)`` offset pair instead of a copied string.
+    Chunks are located with ``str.find`` starting where the overlap with the previous chunk can begin,
+    the same way the splitter's own ``add_start_index`` does it.
+    """
+    spans: List[Span] = []
+    for chunk in splitter.split_text(text):
+        search_from = _overlap_start(text, *spans[-1], chunk_overlap, length_function) if spans else 0
+        start = text.find(chunk, search_from)
+        if start < 0:
+            start = text.find(chunk)
+        spans.append((start, start + len(chunk)))
+    return spans
+
+
+def _merge_small_spans(
+    text: str, spans: List[Span], length_function: Callable[[str], int], chunk_size: int, min_chunk_size: int
+) -> List[Span]:
+    """
+    Merge a chunk shorter than ``min_chunk_size`` into its neighbour as long as the merged chunk still fits in
+    ``chunk_size``. Offsets make this a plain ``(start of first, end of second)`` span, overlap included once.
+    """
+    if len(spans) < 2:
+        return spans
+    merged = [spans[0]]
+    for start, end in spans[1:]:
+        previous_start, previous_end = merged[-1]
+        undersized = (
+            length_function(text[previous_start:previous_end]) < min_chunk_size
+            or length_function(text[start:end]) < min_chunk_size
+        )
+        if undersized and length_function(text[previous_start:end]) <= chunk_size:
+            merged[-1] = (previous_start, end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _strip_span(text: str) -> Optional[Span]:
+    """Offsets of ``text`` without surrounding whitespace, i.e. what the splitter returns for a short text."""
+    start = len(text) - len(text.lstrip())
+    end = len(text.rstrip())
+    return (start, end) if end > start else None
+
+
+class ChunkSpans:
+    """
+    Chunks of a column of texts stored as parallel ``rows``/``starts``/``ends`` arrays that point into the
+    source texts. Chunk strings are only built when ``texts()`` is called, so a batch holds one copy of
+    its abstracts instead of two.
+    """
+
+    def __init__(
+        self,
+        texts: Sequence[str],
+        rows: np.ndarray,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        indices: Optional[np.ndarray] = None,
+    ):
+        self.source = texts
+        self.rows = rows
+        self.starts = starts
+        self.ends = ends
+        # Explicit chunk indices once individual chunks were dropped; otherwise derived from the row runs.
+        self.indices = indices
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def chunk_indices(self) -> np.ndarray:
+        """Position of each chunk within its row (0 for a row's first chunk)."""
+        if self.indices is not None:
+            return self.indices
+        if not len(self.rows):
+            return np.zeros(0, dtype=np.int64)
+        first_of_row = np.r_[True, self.rows[1:] != self.rows[:-1]]
+        run_starts = np.flatnonzero(first_of_row)
+        return np.arange(len(self.rows)) - np.repeat(run_starts, np.diff(np.r_[run_starts, len(self.rows)]))
+
+    def lengths(self, length_function: Callable[[str], int] = len) -> np.ndarray:
+        """Length of every chunk, in characters or in whatever unit ``length_function`` measures."""
+        if length_function is len:
+            return self.ends - self.starts
+        return np.fromiter((length_function(text) for text in self.texts()), dtype=np.int64, count=len(self))
+
+    def counts_per_row(self) -> np.ndarray:
+        return np.bincount(self.rows, minlength=len(self.source)).astype(np.int64)
+
+    def chunk_map(self) -> List[Tuple[int, int]]:
+        return list(zip(self.rows.tolist(), self.chunk_indices().tolist()))
+
+    def texts(self) -> List[str]:
+        source = self.source
+        return [
+            source[row][start:end]
+            for row, start, end in zip(self.rows.tolist(), self.starts.tolist(), self.ends.tolist())
+        ]
+
+    def chunk_lists(self) -> List[List[str]]:
+        """Chunk strings grouped per source row (empty list for rows without chunks)."""
+        grouped: List[List[str]] = [[] for _ in range(len(self.source))]
+        for row, text in zip(self.rows.tolist(), self.texts()):
+            grouped[row].append(text)
+        return grouped
+
+    def without_rows(self, drop: Sequence[bool]) -> "ChunkSpans":
+        """Copy without the chunks of rows flagged in ``drop``; chunk indices of the other rows are unchanged."""
+        keep = ~np.asarray(drop, dtype=bool)[self.rows] if len(self.rows) else np.zeros(0, dtype=bool)
+        return self.select(keep)
+
+    def select(self, keep: Sequence[bool]) -> "ChunkSpans":
+        """Copy with only the chunks flagged in ``keep``; kept chunks keep their original chunk index."""
+        keep = np.asarray(keep, dtype=bool)
+        indices = self.indices if self.indices is not None or keep.all() else self.chunk_indices()
+        return ChunkSpans(
+            self.source,
+            self.rows[keep],
+            self.starts[keep],
+            self.ends[keep],
+            None if indices is None else indices[keep],
+        )
+
+
+def chunk_spans(
+    texts: Sequence[str],
     chunk_size: int = 350,
     chunk_overlap: int = 20,
     parallel: bool = True,
-) -> pd.DataFrame:
-    """Add a column containing RecursiveCharacterTextSplitter chunks for each abstract."""
-    df = df.copy()
-    abstracts = df["abstract"].tolist()
+    pool_min_rows: int = CHUNK_POOL_MIN_ROWS,
+    length_function: Callable[[str], int] = len,
+    min_chunk_size: int = 0,
+) -> ChunkSpans:
+    """
+    Chunk ``texts`` into offset spans. Texts no longer than ``chunk_size`` (most abstracts) become a single
+    span without running the splitter; the rest are split in-process, or in a process pool when ``parallel``
+    and at least ``pool_min_rows`` texts need splitting.
 
-    if parallel and abstracts:
-        workers = max(1, min(cpu_count() - 1 or 1, len(abstracts)))
-        print(f"Chunking abstracts in parallel with {workers} workers ...")
+    ``chunk_size``, ``chunk_overlap`` and ``min_chunk_size`` are measured with ``length_function``
+    (characters by default). With ``min_chunk_size``, undersized neighbouring chunks of a text are merged.
+    """
+    spans_by_row: Dict[int, List[Span]] = {}
+    long_rows: List[int] = []
+    for row, text in enumerate(texts):
+        if not isinstance(text, str) or not text.strip():
+            continue
+        # A token never spans less than one character, so texts within chunk_size characters always fit.
+        if len(text) <= chunk_size or (length_function is not len and length_function(text) <= chunk_size):
+            spans_by_row[row] = [_strip_span(text)]
+        else:
+            long_rows.append(row)
+
+    long_texts = [texts[row] for row in long_rows]
+    if parallel and len(long_rows) >= max(1, pool_min_rows):
+        workers = max(1, min(cpu_count() - 1 or 1, len(long_rows)))
+        print(f"Chunking {len(long_rows)} long abstracts in parallel with {workers} workers ...")
         with Pool(
             processes=workers,
             initializer=_init_splitter,
-            initargs=(chunk_size, chunk_overlap),
+            initargs=(chunk_size, chunk_overlap, length_function, min_chunk_size),
         ) as pool:
-            chunk_lists = pool.map(_split_text_worker, abstracts, chunksize=200)
+            long_spans = pool.map(_split_text_worker, long_texts, chunksize=200)
     else:
-        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        chunk_lists = [
-            splitter.split_text(text) if isinstance(text, str) and text.strip() else [] for text in abstracts
-        ]
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=length_function
+        )
+        long_spans = [_split_offsets(splitter, text, chunk_overlap, length_function) for text in long_texts]
+        if min_chunk_size > 0:
+            long_spans = [
+                _merge_small_spans(text, spans, length_function, chunk_size, min_chunk_size)
+                for text, spans in zip(long_texts, long_spans)
+            ]
+    spans_by_row.update(zip(long_rows, long_spans))
+
+    rows: List[int] = []
+    starts: List[int] = []
+    ends: List[int] = []
+    for row in sorted(spans_by_row):
+        for start, end in spans_by_row[row]:
+            rows.append(row)
+            starts.append(start)
+            ends.append(end)
+    return ChunkSpans(
+        texts,
+        np.asarray(rows, dtype=np.int64),
+        np.asarray(starts, dtype=np.int64),
+        np.asarray(ends, dtype=np.int64),
+    )
+
+
+class ChunkLengthStats:
+    """Running distribution of chunk lengths across batches, kept as a histogram so memory stays constant."""
+
+    def __init__(self, unit: str = "chars"):
+        self.unit = unit
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, lengths: np.ndarray):
+        if not len(lengths):
+            return
+        binned = np.bincount(np.asarray(lengths, dtype=np.int64))
+        if len(binned) > len(self.counts):
+            self.counts = np.pad(self.counts, (0, len(binned) - len(self.counts)))
+        self.counts[: len(binned)] += binned
+
+    def summary(self) -> Dict[str, float]:
+        total = int(self.counts.sum())
+        if not total:
+            return {"chunks": 0}
+        values = np.arange(len(self.counts))
+        cumulative = np.cumsum(self.counts)
+
+        def percentile(q: float) -> int:
+            return int(np.searchsorted(cumulative, q * total))
+
+        return {
+            "chunks": total,
+            "mean": float((values * self.counts).sum() / total),
+            "min": int(np.flatnonzero(self.counts)[0]),
+            "p10": percentile(0.10),
+            "p50": percentile(0.50),
+            "p90": percentile(0.90),
+            "p99": percentile(0.99),
+            "max": len(self.counts) - 1,
+        }
 
-    df["abstract_chunks"] = chunk_lists
-    total_chunks = df["abstract_chunks"].map(len).sum()
-    print(f"Generated {total_chunks} total chunks (avg {total_chunks / max(len(df), 1):.2f} per row).")
-    return df
+    def report(self, label: str = "Chunk length"):
+        summary = self.summary()
+        if not summary["chunks"]:
+            print(f"{label}: no chunks")
+            return
+        print(
+            f"{label} ({self.unit}): {summary['chunks']} chunks, mean {summary['mean']:.1f}, "
+            f"min {summary['min']}, p10 {summary['p10']}, p50 {summary['p50']}, p90 {summary['p90']}, "
+            f"p99 {summary['p99']}, max {summary['max']}"
+        )
+
+
+def _sizing(unit: str, chunk_size: Optional[int], chunk_overlap: Optional[int]):
+    """``(chunk_size, chunk_overlap, length_function, min_chunk_size)`` for a sizing unit."""
+    if unit == "tokens":
+        return (
+            chunk_size or CHUNK_TOKEN_BUDGET,
+            CHUNK_TOKEN_OVERLAP if chunk_overlap is None else chunk_overlap,
+            estimate_tokens,
+            CHUNK_MIN_TOKENS,
+        )
+    if unit == "chars":
+        return chunk_size or 350, 20 if chunk_overlap is None else chunk_overlap, len, 0
+    raise ValueError(f"Unsupported chunk unit: {unit}")
+
+
+def chunk_abstract_spans(
+    df: pd.DataFrame,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    parallel: bool = True,
+    unit: str = CHUNK_UNIT,
+    stats: Optional[ChunkLengthStats] = None,
+) -> ChunkSpans:
+    """
+    Offset spans of the RecursiveCharacterTextSplitter chunks of ``df["abstract"]``. Sizes are in ``unit``:
+    characters (default 350/20) or estimated tokens (``CHUNK_TOKEN_BUDGET``/``CHUNK_TOKEN_OVERLAP``, with
+    chunks under ``CHUNK_MIN_TOKENS`` merged into a neighbour). Chunk lengths are added to ``stats`` if given.
+    """
+    chunk_size, chunk_overlap, length_function, min_chunk_size = _sizing(unit, chunk_size, chunk_overlap)
+    spans = chunk_spans(
+        df["abstract"].tolist(),
+        chunk_size,
+        chunk_overlap,
+        parallel=parallel,
+        length_function=length_function,
+        min_chunk_size=min_chunk_size,
+    )
+    print(f"Generated {len(spans)} total chunks (avg {len(spans) / max(len(df), 1):.2f} per row).")
+    if stats is not None:
+        stats.add(spans.lengths(length_function))
+    return spans
+
+
+def chunk_abstracts(
+    df: pd.DataFrame,
+    chunk_size: Optional[int] = None,
+    chunk_overlap: Optional[int] = None,
+    parallel: bool = True,
+    unit: str = CHUNK_UNIT,
+) -> pd.DataFrame:
+    """Add a column containing RecursiveCharacterTextSplitter chunks for each abstract."""
+    spans = chunk_abstract_spans(df, chunk_size, chunk_overlap, parallel=parallel, unit=unit)
+    return df.assign(abstract_chunks=spans.chunk_lists())
@@ -0,0 +1,350 @@
+"""
+Near-duplicate detection for chunk texts with MinHash signatures and an LSH band index.
+
+Errata, reprints and multi-journal publications produce chunks that are (nearly) identical to chunks of
+another article. The ingest drops such chunks before they are embedded and records the duplicates'
+PMIDs on the canonical (first seen) chunk instead. The canonical signatures and the duplicate map are kept
+in SQLite so later runs dedup against what is already in the collection, and so the duplicates of a
+canonical chunk that is deleted can be ingested again.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+
+DEDUP_NUM_PERM = int(os.environ.get("DEDUP_NUM_PERM", "64"))
+DEDUP_BANDS = int(os.environ.get("DEDUP_BANDS", "8"))  # rows per band = DEDUP_NUM_PERM / DEDUP_BANDS
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.85"))  # estimated Jaccard similarity
+DEDUP_SHINGLE_WORDS = int(os.environ.get("DEDUP_SHINGLE_WORDS", "3"))
+
+DUPLICATE_PMIDS_KEY = "duplicate_pmids"
+
+_MERSENNE_PRIME = (1 << 31) - 1
+_EMPTY_SIGNATURE = np.iinfo(np.uint32).max
+_GRAM_MULTIPLIER = 1_000_003
+_WORD = re.compile(r"\w+")
+
+
+def shingle_hashes(texts: Sequence[str], size: int = DEDUP_SHINGLE_WORDS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hashes of the lower-cased word ``size``-grams of every text (one gram of all words for shorter texts),
+    concatenated, plus the number of grams per text. Words are hashed once with CRC32 and grams are
+    combined with NumPy, so no gram strings are built.
+    """
+    word_lists = [_WORD.findall(text.lower()) for text in texts]
+    word_counts = np.fromiter((len(words) for words in word_lists), dtype=np.int64, count=len(word_lists))
+    gram_counts = np.where(word_counts > 0, np.maximum(word_counts - size + 1, 1), 0)
+    if not word_counts.sum():
+        return np.zeros(0, dtype=np.uint64), gram_counts
+
+    word_hashes = np.fromiter(
+        (zlib.crc32(word.encode()) for words in word_lists for word in words),
+        dtype=np.uint64,
+        count=int(word_counts.sum()),
+    )
+    word_starts = np.r_[0, np.cumsum(word_counts)[:-1]]
+    gram_starts = np.repeat(word_starts, gram_counts) + (
+        np.arange(int(gram_counts.sum())) - np.repeat(np.r_[0, np.cumsum(gram_counts)[:-1]], gram_counts)
+    )
+    last_word = np.repeat(word_starts + word_counts - 1, gram_counts)
+    combined = np.zeros(len(gram_starts), dtype=np.uint64)
+    for offset in range(size):
+        # Short texts repeat their last word instead of reading into the next text.
+        term = word_hashes[np.minimum(gram_starts + offset, last_word)]
+        combined = (combined * np.uint64(_GRAM_MULTIPLIER) + term) % _MERSENNE_PRIME
+    return combined, gram_counts
+
+
+class MinHashLSH:
+    """
+    MinHash signatures plus a banded LSH index over canonical signatures.
+
+    Every band maps a hash of its rows to the first canonical item that produced it, so memory grows by
+    ``bands`` dict entries and one ``num_perm`` x uint32 signature per canonical item. Band matches are
+    verified against the stored signature before an item is reported as a duplicate.
+    """
+
+    def __init__(
+        self,
+        num_perm: int = DEDUP_NUM_PERM,
+        bands: int = DEDUP_BANDS,
+        threshold: float = DEDUP_THRESHOLD,
+        shingle_size: int = DEDUP_SHINGLE_WORDS,
+        seed: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands}).")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: the high 32 bits of (a * x + b) mod 2**64 with odd a, no modulo needed.
+        self._a = rng.integers(0, np.iinfo(np.uint64).max, size=(num_perm, 1), dtype=np.uint64) | np.uint64(1)
+        self._b = rng.integers(0, np.iinfo(np.uint64).max, size=(num_perm, 1), dtype=np.uint64)
+        self._band_weights = rng.integers(1, np.iinfo(np.int64).max, size=self.rows, dtype=np.uint64)
+        self._buckets: List[Dict[int, int]] = [{} for _ in range(bands)]
+        self._signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        self.size = 0
+
+    def signatures(self, texts: Sequence[str]) -> np.ndarray:
+        """MinHash signatures of ``texts`` as a ``(len(texts), num_perm)`` matrix; rows of empty texts are all-max."""
+        values, counts = shingle_hashes(texts, self.shingle_size)
+        result = np.full((len(texts), self.num_perm), _EMPTY_SIGNATURE, dtype=np.uint32)
+        nonempty = np.flatnonzero(counts)
+        if not len(nonempty):
+            return result
+        permuted = ((self._a * values[None, :] + self._b) >> np.uint64(32)).astype(np.uint32)
+        offsets = np.r_[0, np.cumsum(counts[nonempty])[:-1]]
+        result[nonempty] = np.minimum.reduceat(permuted, offsets, axis=1).T
+        return result
+
+    def _band_keys(self, signature: np.ndarray) -> List[int]:
+        bands = signature.astype(np.uint64).reshape(self.bands, self.rows)
+        return (bands * self._band_weights).sum(axis=1).tolist()
+
+    def settings(self) -> str:
+        """The parameters a stored signature depends on; signatures made with other settings are not comparable."""
+        return f"num_perm={self.num_perm},bands={self.bands},shingle_size={self.shingle_size},seed={self.seed}"
+
+    def query(self, signature: np.ndarray) -> Optional[int]:
+        """Index of a canonical item whose estimated similarity to ``signature`` reaches the threshold, if any."""
+        checked: Set[int] = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidate = self._buckets[band].get(key)
+            if candidate is None or candidate in checked:
+                continue
+            checked.add(candidate)
+            if np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                return candidate
+        return None
+
+    def add(self, signature: np.ndarray) -> int:
+        """Add ``signature`` as a canonical item and return its index."""
+        if self.size == len(self._signatures):
+            self._signatures = np.vstack([self._signatures, np.zeros_like(self._signatures)])
+        self._signatures[self.size] = signature
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, self.size)
+        self.size += 1
+        return self.size - 1
+
+    def remove(self, item: int):
+        """
+        Stop matching canonical item ``item``. Its signature row stays allocated; a band it shared with a later
+        canonical item is not handed over, so that item can only be found through its other bands.
+        """
+        for band, key in enumerate(self._band_keys(self._signatures[item])):
+            if self._buckets[band].get(key) == item:
+                del self._buckets[band][key]
+
+    def query_or_add(self, signature: np.ndarray) -> Optional[int]:
+        """
+        Return the index of a canonical item whose estimated similarity to ``signature`` reaches the threshold,
+        or add ``signature`` as a new canonical item and return ``None``.
+        """
+        match = self.query(signature)
+        if match is None:
+            self.add(signature)
+        return match
+
+
+class ChunkDeduplicator:
+    """
+    Drops near-duplicate chunks across ingest runs and remembers which PMIDs each canonical chunk stands for.
+
+    ``filter`` is called per batch before embedding. ``duplicate_pmids_for`` gives the metadata value for a
+    canonical chunk when its record is built; duplicates found after a canonical chunk was written are
+    returned by ``pending_updates`` so they can be applied with ``collection.update`` at the end.
+
+    With a ``path``, canonical signatures and duplicates are stored in SQLite and loaded again by the next run,
+    whose canonical chunks from earlier runs count as written. ``forget_articles`` must be called for articles
+    whose chunks are deleted from the collection; it returns the duplicate PMIDs that lost their only copy.
+    """
+
+    def __init__(self, index: Optional[MinHashLSH] = None, path: Optional[str] = None, fresh: bool = False):
+        self.index = index or MinHashLSH()
+        self.canonical_ids: List[Optional[str]] = []
+        self._canonical_pmids: List[Optional[str]] = []
+        self._positions: Dict[str, int] = {}
+        self._by_pmid: Dict[str, List[int]] = {}
+        self._duplicates: Dict[str, List[str]] = {}
+        self._duplicate_of: Dict[str, Set[str]] = {}
+        self._written: Set[str] = set()
+        self._stale: Set[str] = set()
+        self.checked = 0
+        self.dropped = 0
+        # filter() runs in the dedup stage while records of earlier batches are built in another thread
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+        if path:
+            self._open(path, fresh)
+
+    def _open(self, path: str, fresh: bool):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS settings (value TEXT NOT NULL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS canonicals (chunk_id TEXT PRIMARY KEY, pmid TEXT NOT NULL, signature BLOB)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS duplicates ("
+                "canonical_id TEXT NOT NULL, pmid TEXT NOT NULL, PRIMARY KEY (canonical_id, pmid))"
+            )
+            stored = self._connection.execute("SELECT value FROM settings").fetchone()
+            if stored is None:
+                self._connection.execute("INSERT INTO settings (value) VALUES (?)", (self.index.settings(),))
+            elif stored[0] != self.index.settings():
+                raise RuntimeError(
+                    f"{path} holds signatures made with {stored[0]}; restore those DEDUP_* settings "
+                    "or start over with --fresh."
+                )
+        for chunk_id, pmid, signature in self._connection.execute(
+            "SELECT chunk_id, pmid, signature FROM canonicals ORDER BY rowid"
+        ):
+            self._add_canonical(chunk_id, pmid, self.index.add(np.frombuffer(signature, dtype=np.uint32)))
+            self._written.add(chunk_id)
+        for chunk_id, pmid in self._connection.execute("SELECT canonical_id, pmid FROM duplicates ORDER BY rowid"):
+            self._duplicates.setdefault(chunk_id, []).append(pmid)
+            self._duplicate_of.setdefault(pmid, set()).add(chunk_id)
+
+    def _add_canonical(self, chunk_id: str, pmid: str, position: int):
+        self.canonical_ids.append(chunk_id)
+        self._canonical_pmids.append(pmid)
+        self._positions[chunk_id] = position
+        self._by_pmid.setdefault(pmid, []).append(position)
+
+    def filter(self, ids: Sequence[str], pmids: Sequence[str], texts: Sequence[str]) -> np.ndarray:
+        """Boolean mask of the chunks to keep; dropped chunks are recorded against their canonical chunk."""
+        keep = np.ones(len(ids), dtype=bool)
+        signatures = self.index.signatures(texts)
+        empty = np.all(signatures == _EMPTY_SIGNATURE, axis=1)
+        with self._lock:
+            self._filter(ids, pmids, signatures, empty, keep)
+        return keep
+
+    def _filter(self, ids, pmids, signatures, empty, keep):
+        canonical_rows = []
+        duplicate_rows = []
+        for position, (chunk_id, pmid) in enumerate(zip(ids, pmids)):
+            if empty[position]:
+                continue
+            self.checked += 1
+            match = self.index.query(signatures[position])
+            if match is None:
+                if chunk_id in self._positions:
+                    # A chunk that is canonical already (e.g. a batch redone after a crash) stays so.
+                    continue
+                self._add_canonical(chunk_id, pmid, self.index.add(signatures[position]))
+                canonical_rows.append((chunk_id, pmid, signatures[position].tobytes()))
+                continue
+            canonical_id = self.canonical_ids[match]
+            # repeated passages inside one article are left alone
+            if self._canonical_pmids[match] == pmid:
+                continue
+            keep[position] = False
+            self.dropped += 1
+            duplicates = self._duplicates.setdefault(canonical_id, [])
+            if pmid not in duplicates:
+                duplicates.append(pmid)
+                self._duplicate_of.setdefault(pmid, set()).add(canonical_id)
+                duplicate_rows.append((canonical_id, pmid))
+                if canonical_id in self._written:
+                    self._stale.add(canonical_id)
+        if self._connection is not None and (canonical_rows or duplicate_rows):
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO canonicals (chunk_id, pmid, signature) VALUES (?, ?, ?)", canonical_rows
+                )
+                self._connection.executemany(
+                    "INSERT OR IGNORE INTO duplicates (canonical_id, pmid) VALUES (?, ?)", duplicate_rows
+                )
+
+    def forget_articles(self, pmids: Iterable[str]) -> List[str]:
+        """
+        Forget ``pmids``, whose chunks are being deleted from the collection: their canonical chunks stop
+        matching, and they are taken off the duplicate lists of other canonical chunks (which are then due an
+        update). Returns the PMIDs of other articles that were only stored as duplicates of the forgotten
+        chunks; they must be ingested again.
+        """
+        pmids = set(pmids)
+        orphaned: Set[str] = set()
+        removed_canonicals: List[str] = []
+        removed_duplicates: List[Tuple[str, str]] = []
+        with self._lock:
+            for pmid in pmids:
+                for position in self._by_pmid.pop(pmid, []):
+                    chunk_id = self.canonical_ids[position]
+                    self.index.remove(position)
+                    self.canonical_ids[position] = None
+                    self._canonical_pmids[position] = None
+                    del self._positions[chunk_id]
+                    self._written.discard(chunk_id)
+                    self._stale.discard(chunk_id)
+                    for duplicate in self._duplicates.pop(chunk_id, []):
+                        self._duplicate_of.get(duplicate, set()).discard(chunk_id)
+                        orphaned.add(duplicate)
+                    removed_canonicals.append(chunk_id)
+                for chunk_id in self._duplicate_of.pop(pmid, set()):
+                    self._duplicates[chunk_id].remove(pmid)
+                    if chunk_id in self._written:
+                        self._stale.add(chunk_id)
+                    removed_duplicates.append((chunk_id, pmid))
+            if self._connection is not None and (removed_canonicals or removed_duplicates):
+                with self._connection:
+                    self._connection.executemany(
+                        "DELETE FROM canonicals WHERE chunk_id = ?", [(chunk_id,) for chunk_id in removed_canonicals]
+                    )
+                    self._connection.executemany(
+                        "DELETE FROM duplicates WHERE canonical_id = ?",
+                        [(chunk_id,) for chunk_id in removed_canonicals],
+                    )
+                    self._connection.executemany(
+                        "DELETE FROM duplicates WHERE canonical_id = ? AND pmid = ?", removed_duplicates
+                    )
+        return sorted(orphaned - pmids)
+
+    def duplicate_pmids_for(self, chunk_id: str) -> Optional[str]:
+        """Comma-separated duplicate PMIDs for a canonical chunk about to be written; marks it as written."""
+        with self._lock:
+            self._written.add(chunk_id)
+            self._stale.discard(chunk_id)
+            duplicates = self._duplicates.get(chunk_id)
+            return ",".join(duplicates) if duplicates else None
+
+    def pending_updates(self) -> Dict[str, str]:
+        """
+        ``{chunk_id: duplicate_pmids}`` for written canonical chunks whose duplicates changed afterwards; an empty
+        string clears the duplicates of a chunk whose last duplicate was forgotten.
+        """
+        with self._lock:
+            return {chunk_id: ",".join(self._duplicates.get(chunk_id, [])) for chunk_id in sorted(self._stale)}
+
+    def close(self):
+        if self._connection is not None:
+            with self._lock:
+                self._connection.close()
+                self._connection = None
+
+
+def apply_duplicate_updates(collection, deduplicator: ChunkDeduplicator, batch_size: int = 500) -> int:
+    """Write late-found duplicate PMIDs onto canonical chunks already in ``collection``; returns the count."""
+    updates = deduplicator.pending_updates()
+    ids = list(updates)
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size]
+        # Chroma merges metadata on update, so only the one key is sent
+        collection.update(ids=batch, metadatas=[{DUPLICATE_PMIDS_KEY: updates[i]} for i in batch])
+    return len(ids)
@@ -1,14 +1,18 @@
+import math
 import os
-
-# import math
+import threading
 import time
-from typing import List, Sequence, Tuple
+from typing import Any, Dict, List, Sequence, Tuple
 
 # Iterable
 
 from google import genai
 from google.genai import types, errors
 
+from .chunker import estimate_tokens
+from .embedding_backends import EMBEDDING_BACKEND, EmbeddingBackend, create_backend
+from .metrics import SIZE_BUCKETS, registry
+
 # from tqdm import tqdm
 
 
@@ -19,22 +23,133 @@ EMBEDDING_DIMENSION = int(os.environ.get("EMBEDDING_DIMENSION", "256"))
 DEFAULT_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "100"))
 MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", "5"))
 RETRY_DELAY = float(os.environ.get("EMBEDDING_RETRY_DELAY", "5.0"))
+# Comma-separated regions to spread embedding requests over; a "project/location" entry uses another project.
+EMBEDDING_LOCATIONS = [
+    spec.strip() for spec in os.environ.get("EMBEDDING_LOCATIONS", GCP_LOCATION).split(",") if spec.strip()
+] or [GCP_LOCATION]
+# Requests per minute per region, across every thread of this process; 0 disables the limit.
+EMBEDDING_REQUESTS_PER_MINUTE = float(os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", "0"))
+# Vertex rejects requests with more than 250 texts or 20k input tokens, so larger payloads are split.
+EMBEDDING_MAX_TEXTS_PER_REQUEST = int(os.environ.get("EMBEDDING_MAX_TEXTS_PER_REQUEST", "250"))
+EMBEDDING_MAX_TOKENS_PER_REQUEST = int(os.environ.get("EMBEDDING_MAX_TOKENS_PER_REQUEST", "20000"))
+# Quota exhausted / unavailable: the region is cooled down and the request retried in another region.
+FAILOVER_STATUS_CODES = {429, 503}
+
+_clients: Dict[str, genai.Client] = {}
+_clients_lock = threading.Lock()
+_backend: EmbeddingBackend | None = None
+
+
+class RateLimiter:
+    """Thread-safe token bucket: ``rate`` tokens per second with bursts of up to ``capacity`` tokens."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self) -> float:
+        """Tokens that could be taken right now without waiting; ``inf`` when the limit is disabled."""
+        if self.rate <= 0:
+            return math.inf
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """Block until ``tokens`` are available and take them; returns the seconds spent waiting."""
+        if self.rate <= 0:
+            return 0.0
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
 
-_client = None
 
+class Region:
+    """One embedding endpoint (a Vertex location, optionally in another project) with its own quota."""
 
-def _get_client() -> genai.Client:
-    global _client
-    if _client is None:
-        if not GCP_PROJECT:
-            raise RuntimeError("Environment variable GCP_PROJECT must be set before creating the embedder client.")
+    def __init__(self, spec: str, requests_per_minute: float = EMBEDDING_REQUESTS_PER_MINUTE):
+        project, _, location = spec.rpartition("/")
+        self.spec = spec
+        self.project = project or GCP_PROJECT
+        self.location = location
+        self.limiter = RateLimiter(requests_per_minute / 60.0)
+        self.blocked_until = 0.0
+        self.in_flight = 0
 
-        _client = genai.Client(
-            vertexai=True,
-            project=GCP_PROJECT,
-            location=GCP_LOCATION,
-        )
-    return _client
+
+class RegionPool:
+    """
+    Spreads embedding requests over regions. Each request goes to the region with the most token-bucket
+    capacity left (fewest requests in flight on ties), skipping regions that are cooling down after a quota
+    or availability error; when every region is cooling down, the caller waits for the first to recover.
+    """
+
+    def __init__(self, specs: Sequence[str], requests_per_minute: float = EMBEDDING_REQUESTS_PER_MINUTE):
+        self.regions = [Region(spec, requests_per_minute) for spec in specs]
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Region:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                ready = [region for region in self.regions if region.blocked_until <= now]
+                if ready:
+                    region = max(ready, key=lambda r: (r.limiter.available(), -r.in_flight))
+                    region.in_flight += 1
+                    break
+                delay = min(region.blocked_until for region in self.regions) - now
+            time.sleep(delay)
+            waited += delay
+        waited += region.limiter.acquire()
+        registry.observe("embed.rate_limit_wait_seconds", waited)
+        return region
+
+    def release(self, region: Region, cooldown: float = 0.0):
+        """Return a request slot; ``cooldown`` keeps new requests away from ``region`` for that many seconds."""
+        with self._lock:
+            region.in_flight -= 1
+            if cooldown > 0:
+                region.blocked_until = max(region.blocked_until, time.monotonic() + cooldown)
+
+
+# Shared by every caller of embed_texts, so concurrent embedding threads stay within each region's quota.
+_regions = RegionPool(EMBEDDING_LOCATIONS)
+
+
+def _get_client(location: str | None = None) -> genai.Client:
+    """Client for a region spec from ``EMBEDDING_LOCATIONS`` (the first one by default); one per region."""
+    spec = location or EMBEDDING_LOCATIONS[0]
+    with _clients_lock:
+        client = _clients.get(spec)
+        if client is None:
+            if not GCP_PROJECT:
+                raise RuntimeError("Environment variable GCP_PROJECT must be set before creating the embedder client.")
+
+            project, _, region = spec.rpartition("/")
+            client = genai.Client(
+                vertexai=True,
+                project=project or GCP_PROJECT,
+                location=region,
+            )
+            _clients[spec] = client
+    return client
 
 
 def _valid_chunks(chunks: Sequence[str]) -> List[str]:
@@ -45,6 +160,97 @@ def _valid_chunks(chunks: Sequence[str]) -> List[str]:
     return texts
 
 
+def _request_batches(
+    texts: Sequence[str],
+    max_texts: int = EMBEDDING_MAX_TEXTS_PER_REQUEST,
+    max_tokens: int = EMBEDDING_MAX_TOKENS_PER_REQUEST,
+) -> List[List[str]]:
+    """Consecutive slices of ``texts`` within the per-request text and (estimated) token limits."""
+    batches: List[List[str]] = []
+    current: List[str] = []
+    current_tokens = 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if current and (len(current) >= max_texts or current_tokens + tokens > max_tokens):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+class VertexBackend(EmbeddingBackend):
+    """
+    Vertex AI text embeddings. The payload is sent in as few requests as the per-request limits allow, one
+    after the other, each to one region. Quota and availability errors move a request to another region;
+    other API errors are retried with exponential backoff.
+    """
+
+    name = "vertex"
+
+    def embed(
+        self,
+        texts: Sequence[str],
+        dimensionality: int,
+        max_retries: int = MAX_RETRIES,
+        retry_delay: float = RETRY_DELAY,
+        max_texts_per_request: int = EMBEDDING_MAX_TEXTS_PER_REQUEST,
+        **options,
+    ) -> List[List[float]]:
+        embeddings: List[List[float]] = []
+        for batch in _request_batches(texts, max_texts_per_request):
+            embeddings.extend(self._embed_request(batch, dimensionality, max_retries, retry_delay))
+        return embeddings
+
+    def _embed_request(
+        self, texts: List[str], dimensionality: int, max_retries: int, retry_delay: float
+    ) -> List[List[float]]:
+        attempt = 0
+
+        while True:
+            region = _regions.acquire()
+            registry.inc("embed.requests")
+            registry.inc(f"embed.requests.{region.spec}")
+            started = time.perf_counter()
+            cooldown = 0.0
+            retry_after = None
+            try:
+                response = _get_client(region.spec).models.embed_content(
+                    model=EMBEDDING_MODEL,
+                    contents=texts,
+                    config=types.EmbedContentConfig(output_dimensionality=dimensionality),
+                )
+            except errors.APIError as exc:
+                registry.inc(f"embed.errors.{exc.code}")
+                attempt += 1
+                delay = retry_delay * (2 ** (attempt - 1))
+                failover = exc.code in FAILOVER_STATUS_CODES
+                cooldown = delay if failover else 0.0
+                if attempt > max_retries:
+                    raise
+                retry_after = 0.0 if failover else delay
+            finally:
+                # Whatever the outcome (including timeouts or an interrupt), the region gets its slot back.
+                registry.observe("embed.request_seconds", time.perf_counter() - started)
+                _regions.release(region, cooldown=cooldown)
+
+            if retry_after is None:
+                return [e.values for e in response.embeddings]
+            registry.inc("embed.retries")
+            if retry_after:
+                time.sleep(retry_after)
+
+
+def get_backend() -> EmbeddingBackend:
+    """The process-wide backend chosen by ``EMBEDDING_BACKEND``; created on first use."""
+    global _backend
+    if _backend is None:
+        _backend = VertexBackend() if EMBEDDING_BACKEND == "vertex" else create_backend(EMBEDDING_BACKEND)
+    return _backend
+
+
 def embed_texts(
     texts: Sequence[str],
     dimensionality: int = EMBEDDING_DIMENSION,
@@ -56,24 +262,34 @@ def embed_texts(
     payload = _valid_chunks(texts)
     if not payload:
         return []
+    started = time.perf_counter()
+    embeddings = get_backend().embed(payload, dimensionality, max_retries=max_retries, retry_delay=retry_delay)
+    registry.observe("embed.call_seconds", time.perf_counter() - started)
+    registry.observe("embed.batch_texts", len(payload), SIZE_BUCKETS)
+    registry.inc("embed.calls")
+    registry.inc("embed.texts", len(payload))
+    registry.inc("embed.chars", sum(len(text) for text in payload))
+    registry.inc("embed.tokens", sum(estimate_tokens(text) for text in payload))
+    return embeddings
 
-    client = _get_client()
-    attempt = 0
-
-    while True:
-        try:
-            response = client.models.embed_content(
-                model=EMBEDDING_MODEL,
-                contents=payload,  # entire payload in one call
-                config=types.EmbedContentConfig(output_dimensionality=dimensionality),
-            )
-            return [e.values for e in response.embeddings]
 
-        except errors.APIError:
-            attempt += 1
-            if attempt > max_retries:
-                raise
-            time.sleep(retry_delay * (2 ** (attempt - 1)))
+def embedding_metrics() -> Dict[str, Any]:
+    """Ratios derived from the ``embed.*`` counters: batching efficiency, retry and 429 rates, throughput."""
+    summary = registry.summary()
+    counters = summary["counters"]
+    calls = counters.get("embed.calls", 0)
+    # local backends make one "request" per call
+    requests = counters.get("embed.requests", 0) or calls
+    busy = summary["histograms"].get("embed.call_seconds", {}).get("sum", 0.0)
+    return {
+        "backend": get_backend().name,
+        "regions": len(_regions.regions),
+        "texts_per_request": counters.get("embed.texts", 0) / requests if requests else 0.0,
+        "retry_rate": counters.get("embed.retries", 0) / requests if requests else 0.0,
+        "rate_429": counters.get("embed.errors.429", 0) / requests if requests else 0.0,
+        "tokens_per_s": counters.get("embed.tokens", 0) / summary["elapsed_s"] if summary["elapsed_s"] else 0.0,
+        "tokens_per_busy_s": counters.get("embed.tokens", 0) / busy if busy else 0.0,
+    }
 
 
 def embed_chunk_lists(
@@ -0,0 +1,108 @@
+"""Local fingerprint index for delta ingest: which PMIDs were ingested from which version of their row."""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# SQLite caps the number of bound parameters per statement (999 on older builds).
+_MAX_PARAMS = 900
+
+
+def row_fingerprints(df: pd.DataFrame, columns: Sequence[str]) -> np.ndarray:
+    """One 64-bit hash per row over ``columns`` (those present in ``df``), as int64 so SQLite can store it."""
+    present = [column for column in columns if column in df.columns]
+    if not present or df.empty:
+        return np.zeros(len(df), dtype=np.int64)
+    return pd.util.hash_pandas_object(df[present], index=False).to_numpy().view(np.int64)
+
+
+class FingerprintIndex:
+    """
+    SQLite table of ``pmid -> fingerprint`` for the rows whose chunks are in the collection, plus the run in
+    which each PMID was last seen in the source. A fingerprint is only committed once the row's chunks have
+    been uploaded, so an interrupted delta run simply redoes the rows it had not finished.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Stages and upload callbacks run on different threads; the lock serialises them.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.run_id = time.time_ns()
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                "pmid TEXT PRIMARY KEY, fingerprint INTEGER NOT NULL, seen_run INTEGER NOT NULL)"
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM fingerprints").fetchone()[0]
+
+    def changes(self, pmids: Sequence[str], fingerprints: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        ``(new, changed)`` masks for a batch of rows, looked up in bulk. Every PMID of the batch is marked as
+        seen in this run, so ``unseen`` only reports PMIDs that are gone from the source.
+        """
+        known = {}
+        with self._lock, self._connection:
+            for start in range(0, len(pmids), _MAX_PARAMS):
+                part = list(pmids[start : start + _MAX_PARAMS])
+                placeholders = ",".join("?" * len(part))
+                known.update(
+                    self._connection.execute(
+                        f"SELECT pmid, fingerprint FROM fingerprints WHERE pmid IN ({placeholders})", part
+                    ).fetchall()
+                )
+                self._connection.execute(
+                    f"UPDATE fingerprints SET seen_run = ? WHERE pmid IN ({placeholders})", [self.run_id, *part]
+                )
+        stored = [known.get(pmid) for pmid in pmids]
+        new = np.array([value is None for value in stored], dtype=bool)
+        changed = np.array(
+            [value is not None and value != int(fingerprint) for value, fingerprint in zip(stored, fingerprints)],
+            dtype=bool,
+        )
+        self.new += int(new.sum())
+        self.changed += int(changed.sum())
+        self.unchanged += len(pmids) - int(new.sum()) - int(changed.sum())
+        return new, changed
+
+    def commit(self, pmids: Sequence[str], fingerprints: Sequence[int]):
+        """Record rows whose chunks are now in the collection."""
+        rows = [(pmid, int(fingerprint), self.run_id) for pmid, fingerprint in zip(pmids, fingerprints)]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO fingerprints (pmid, fingerprint, seen_run) VALUES (?, ?, ?) "
+                "ON CONFLICT(pmid) DO UPDATE SET fingerprint = excluded.fingerprint, seen_run = excluded.seen_run",
+                rows,
+            )
+
+    def unseen(self) -> List[str]:
+        """PMIDs in the index that were not in the source during this run."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT pmid FROM fingerprints WHERE seen_run < ? ORDER BY pmid", (self.run_id,)
+            ).fetchall()
+        return [pmid for (pmid,) in rows]
+
+    def remove(self, pmids: Sequence[str]):
+        with self._lock, self._connection:
+            for start in range(0, len(pmids), _MAX_PARAMS):
+                part = list(pmids[start : start + _MAX_PARAMS])
+                self._connection.execute(f"DELETE FROM fingerprints WHERE pmid IN ({','.join('?' * len(part))})", part)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,9 +1,33 @@
 from google.cloud import storage
+import gzip
 import json
+import os
+import posixpath
+import tempfile
 import pandas as pd
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
 from tqdm import tqdm
-from typing import Generator, Dict, Any  # Iterable
+from typing import Generator, Dict, Any, Deque, List, Optional, Tuple  # Iterable
+
+import pyarrow.parquet as pq
+
+from .backup_format import iter_backup_parquet
+from .backup_sink import TOMBSTONE_SUFFIX
+
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:  # pragma: no cover - orjson ships with chromadb, but keep the stdlib fallback
+    _json_loads = json.loads
+
+BACKUP_SUFFIXES = (".jsonl", ".json", ".jsonl.gz", ".parquet")
+BACKUP_PREFETCH_BLOBS = int(os.environ.get("BACKUP_PREFETCH_BLOBS", "2"))  # blobs downloaded ahead of the reader
+BACKUP_DECODE_WORKERS = int(os.environ.get("BACKUP_DECODE_WORKERS", "4"))
+BACKUP_DECODE_BLOCK_LINES = int(os.environ.get("BACKUP_DECODE_BLOCK_LINES", "1000"))
 
 
 def read_parquet_from_gcs(bucket_name, parquet_folder):
@@ -26,54 +50,264 @@ def read_parquet_from_gcs(bucket_name, parquet_folder):
     return alldf
 
 
-def read_backup_from_gcs(bucket_name, backup_prefix):
-    """Reads backup files from GCS and returns a list of their contents."""
+def iter_parquet_batches_from_gcs(
+    bucket_name: str, parquet_folder: str, batch_rows: int = 1000
+) -> Generator[Tuple[str, int, pd.DataFrame], None, None]:
+    """
+    Streams the Parquet files under a GCS folder as DataFrames of at most ``batch_rows`` rows.
+    Yields ``(blob_name, row_start, df)`` where ``row_start`` is the offset of the batch within its blob.
+    Only one blob's compressed bytes and one decoded batch are held in memory at a time.
+    """
     client = storage.Client()
-    # list the available buckets
-    buckets = list(client.list_buckets())
-    print(f"Available buckets: {[bucket.name for bucket in buckets]}")
     bucket = client.get_bucket(bucket_name)
 
-    backup_blobs = [
-        blob
-        for blob in bucket.list_blobs(prefix=backup_prefix)
-        if blob.name.endswith(".jsonl") or blob.name.endswith(".json")
-    ]
+    parquet_blobs = [blob for blob in bucket.list_blobs(prefix=parquet_folder) if blob.name.endswith(".parquet")]
+    print(f"Found {len(parquet_blobs)} parquet files in gs://{bucket_name}/{parquet_folder}")
+
+    for blob in parquet_blobs:
+        parquet_file = pq.ParquetFile(BytesIO(blob.download_as_bytes()))
+        print(f"Streaming {parquet_file.metadata.num_rows} rows from {blob.name}")
+        row_start = 0
+        for record_batch in parquet_file.iter_batches(batch_size=batch_rows):
+            df = record_batch.to_pandas()
+            yield blob.name, row_start, df
+            row_start += len(df)
+
+
+@dataclass(frozen=True)
+class BackupUnit:
+    """A unit of restore work: a whole backup blob, or a line-aligned byte range ``[start, end)`` of a JSONL blob."""
 
-    backups = []
-    for blob in tqdm(backup_blobs):
-        content = blob.download_as_text()
-        print(f"Read backup file {blob.name} with size {len(content)} characters")
-        lines = content.splitlines()
-        for line in lines:
-            line = line.strip()
-            line = json.loads(line)
-            backups.append(line)  # Store as JSON object
+    blob: Any
+    start: int = 0
+    end: Optional[int] = None
 
-    return backups
+    @property
+    def name(self) -> str:
+        return self.blob.name
 
+    @property
+    def size(self) -> int:
+        end = self.end if self.end is not None else (self.blob.size or 0)
+        return end - self.start
 
-def stream_backup_from_gcs(bucket_name: str, backup_prefix: str) -> Generator[Dict[str, Any], None, None]:
+    @property
+    def key(self) -> str:
+        return self.name if self.end is None else f"{self.name}@{self.start}-{self.end}"
+
+
+def _download_unit(unit: BackupUnit) -> str:
+    """Download ``unit`` to a local temp file (keeping the blob's suffix) and return the path."""
+    blob = unit.blob
+    suffix = ".gz" if blob.name.endswith(".gz") else os.path.splitext(blob.name)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmpfile:
+        local_path = tmpfile.name
+    try:
+        if unit.end is None:
+            blob.download_to_filename(local_path)
+        else:
+            blob.download_to_filename(local_path, start=unit.start, end=unit.end - 1)  # ``end`` is inclusive
+    except BaseException:
+        _remove_quietly(local_path)
+        raise
+    return local_path
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _decode_lines(lines: List[bytes]) -> List[Dict[str, Any]]:
+    return [_json_loads(line) for line in lines if line.strip()]
+
+
+def _iter_jsonl_file(
+    path: str, decoders: ThreadPoolExecutor, max_pending: int
+) -> Generator[Dict[str, Any], None, None]:
+    """Decode a local (optionally gzip-compressed) JSONL file in blocks of lines on the ``decoders`` pool, in order."""
+    opener = gzip.open if path.endswith(".gz") else open
+    pending: Deque[Future] = deque()
+    with opener(path, "rb") as f:
+        block: List[bytes] = []
+        for line in f:
+            block.append(line)
+            if len(block) >= BACKUP_DECODE_BLOCK_LINES:
+                pending.append(decoders.submit(_decode_lines, block))
+                block = []
+                while len(pending) > max_pending:
+                    yield from pending.popleft().result()
+        if block:
+            pending.append(decoders.submit(_decode_lines, block))
+    while pending:
+        yield from pending.popleft().result()
+
+
+def list_backup_blobs(bucket, backup_prefix: str) -> List[Any]:
+    """Backup blobs (JSONL, gzip JSONL or Parquet) under ``backup_prefix``, in name order."""
+    blobs = [blob for blob in bucket.list_blobs(prefix=backup_prefix) if blob.name.endswith(BACKUP_SUFFIXES)]
+    return sorted(blobs, key=lambda blob: blob.name)
+
+
+def backup_run(blob_name: str) -> str:
     """
-    Streams backup files from GCS line-by-line to avoid loading everything into memory.
-    Yields parsed JSON objects one at a time.
+    The run a backup blob belongs to: its directory. Run directories end in a sortable UTC timestamp, and
+    blobs written directly under the prefix by older versions sort before every run.
+    """
+    return posixpath.dirname(blob_name)
+
+
+def load_tombstones(bucket, backup_prefix: str) -> Dict[str, str]:
+    """``pmid -> latest run that deleted it`` from the tombstone files written by delta and prune runs."""
+    latest: Dict[str, str] = {}
+    for blob in bucket.list_blobs(prefix=backup_prefix):
+        if not blob.name.endswith(TOMBSTONE_SUFFIX):
+            continue
+        run = backup_run(blob.name)
+        for line in blob.download_as_bytes().decode("utf-8").splitlines():
+            pmid = line.strip()
+            if pmid and run > latest.get(pmid, ""):
+                latest[pmid] = run
+    return latest
+
+
+def is_superseded(record: Dict[str, Any], run: str, tombstones: Dict[str, str]) -> bool:
+    """
+    True when the record's article was deleted in a later run than the one that backed the record up. A
+    changed article is deleted and re-written in the same run, so only its new chunks survive.
+    """
+    if not tombstones:
+        return False
+    pmid = (record.get("metadata") or {}).get("pmid")
+    return pmid is not None and tombstones.get(str(pmid), "") > run
+
+
+def _line_boundaries(blob, split_bytes: int, probe_bytes: int = 256 * 1024) -> List[int]:
+    """Offsets just past the first newline after every ``split_bytes`` of ``blob``, found with small ranged reads."""
+    boundaries: List[int] = []
+    size = blob.size or 0
+    for offset in range(split_bytes, size, split_bytes):
+        if boundaries and offset < boundaries[-1]:
+            continue
+        window = blob.download_as_bytes(start=offset, end=min(size, offset + probe_bytes) - 1)
+        newline = window.find(b"\n")
+        if newline < 0:
+            continue  # one very long line; the previous range simply absorbs it
+        boundary = offset + newline + 1
+        if boundary < size:
+            boundaries.append(boundary)
+    return boundaries
+
+
+def plan_backup_units(bucket, backup_prefix: str, split_bytes: Optional[int] = None) -> List[BackupUnit]:
+    """
+    List the backup under ``backup_prefix`` as restore units. Uncompressed JSONL blobs larger than
+    ``split_bytes`` are cut into line-aligned byte ranges; gzip and Parquet parts are always whole units.
+    The plan only depends on the stored blobs, so every shard computes the same one.
+    """
+    units: List[BackupUnit] = []
+    for blob in list_backup_blobs(bucket, backup_prefix):
+        splittable = blob.name.endswith((".jsonl", ".json"))
+        if not split_bytes or not splittable or (blob.size or 0) <= split_bytes:
+            units.append(BackupUnit(blob))
+            continue
+        edges = [0] + _line_boundaries(blob, split_bytes) + [blob.size]
+        units.extend(BackupUnit(blob, start, end) for start, end in zip(edges, edges[1:]))
+    return units
+
+
+def assign_backup_units(units: List[BackupUnit], shard_index: int, shard_count: int) -> List[BackupUnit]:
+    """
+    Deterministically pick shard ``shard_index`` of ``shard_count``: units are handed out largest first
+    to the least-loaded shard, then returned in plan order.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index}/{shard_count}")
+    loads = [0] * shard_count
+    owner: Dict[str, int] = {}
+    for unit in sorted(units, key=lambda u: (-u.size, u.key)):
+        target = min(range(shard_count), key=lambda shard: (loads[shard], shard))
+        owner[unit.key] = target
+        loads[target] += unit.size
+    return [unit for unit in units if owner[unit.key] == shard_index]
+
+
+def read_backup_from_gcs(bucket_name, backup_prefix):
+    """Reads backup files from GCS and returns a list of their contents."""
+    return list(stream_backup_from_gcs(bucket_name, backup_prefix))
+
+
+def stream_backup_from_gcs(
+    bucket_name: str,
+    backup_prefix: str,
+    prefetch: int = BACKUP_PREFETCH_BLOBS,
+    decode_workers: int = BACKUP_DECODE_WORKERS,
+) -> Generator[Dict[str, Any], None, None]:
+    """
+    Streams backup records from GCS one at a time without loading whole backups into memory.
+
+    The next ``prefetch`` blobs are downloaded to local temp files in background threads while the
+    current one is decoded, and JSONL lines are parsed in blocks on a small decoder pool, so a restore
+    is paced by the slower of the network and the consumer rather than by both in turn. Records of
+    articles deleted by a later delta or prune run are left out.
     """
     client = storage.Client()
-    buckets = list(client.list_buckets())
-    print(f"Available buckets: {[bucket.name for bucket in buckets]}")
-    bucket = client.get_bucket(bucket_name)
+    bucket = client.bucket(bucket_name)
+    units = [BackupUnit(blob) for blob in list_backup_blobs(bucket, backup_prefix)]
+    tombstones = load_tombstones(bucket, backup_prefix)
+    superseded = 0
+    for unit, _, record in stream_backup_units(units, prefetch, decode_workers):
+        if is_superseded(record, backup_run(unit.name), tombstones):
+            superseded += 1
+            continue
+        yield record
+    if superseded:
+        print(f"Left out {superseded} backup records of articles deleted by a later run.")
+
+
+def stream_backup_units(
+    units: List[BackupUnit], prefetch: int = BACKUP_PREFETCH_BLOBS, decode_workers: int = BACKUP_DECODE_WORKERS
+) -> Generator[Tuple[BackupUnit, int, Dict[str, Any]], None, None]:
+    """Like ``stream_backup_from_gcs`` for an explicit list of units; yields ``(unit, index_in_unit, record)``."""
+    prefetch = max(1, prefetch)
+    decode_workers = max(1, decode_workers)
+    remaining = iter(units)
+    pending: Deque[Tuple[BackupUnit, Future]] = deque()
+
+    downloads = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="backup-prefetch")
+    decoders = ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix="backup-decode")
+
+    def schedule_next():
+        unit = next(remaining, None)
+        if unit is not None:
+            pending.append((unit, downloads.submit(_download_unit, unit)))
 
-    backup_blobs = [
-        blob
-        for blob in bucket.list_blobs(prefix=backup_prefix)
-        if blob.name.endswith(".jsonl") or blob.name.endswith(".json")
-    ]
-
-    for blob in tqdm(backup_blobs):
-        print(f"Streaming backup file {blob.name} (size: {blob.size} bytes)")
-        with blob.open("r") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                yield json.loads(line)
+    try:
+        for _ in range(prefetch):
+            schedule_next()
+        for _ in tqdm(range(len(units))):
+            unit, future = pending.popleft()
+            local_path = future.result()
+            # Keep ``prefetch`` downloads in flight while this unit is decoded.
+            schedule_next()
+            print(f"Streaming backup file {unit.key} (size: {unit.size} bytes)")
+            try:
+                if unit.name.endswith(".parquet"):
+                    records = iter_backup_parquet(local_path)
+                else:
+                    records = _iter_jsonl_file(local_path, decoders, max_pending=decode_workers * 2)
+                for index, record in enumerate(records):
+                    yield unit, index, record
+            finally:
+                _remove_quietly(local_path)
+    finally:
+        # The consumer may stop early: drop queued downloads and clean up the ones that already finished.
+        for _, future in pending:
+            future.cancel()
+        downloads.shutdown(wait=True)
+        decoders.shutdown(wait=True)
+        for _, future in pending:
+            if not future.cancelled() and future.exception() is None:
+                _remove_quietly(future.result())
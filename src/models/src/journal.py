@@ -0,0 +1,66 @@
+"""Append-only journal of completed ingest batches, used to resume interrupted runs."""
+
+import json
+import os
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+
+class RunJournal:
+    """
+    Records each batch that has been fully written (source blob, row range, chunk ids) as one JSON line.
+    A batch counts as done when its row range is covered by the ranges already recorded for its source,
+    so a restart with a different batch size still skips completed work.
+    """
+
+    def __init__(self, path: str, fresh: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ranges: Dict[str, List[Tuple[int, int]]] = {}
+        self.entries = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if fresh and os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write can leave a truncated last line; that batch is simply redone.
+                    continue
+                self._add_range(entry["source"], entry["row_start"], entry["row_end"])
+                self.entries += 1
+
+    def _add_range(self, source: str, row_start: int, row_end: int):
+        merged = []
+        for start, end in sorted(self._ranges.get(source, []) + [(row_start, row_end)]):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        self._ranges[source] = merged
+
+    def is_done(self, source: str, row_start: int, row_end: int) -> bool:
+        with self._lock:
+            return any(start <= row_start and row_end <= end for start, end in self._ranges.get(source, []))
+
+    def record(self, source: str, row_start: int, row_end: int, chunk_ids: Sequence[str] = ()):
+        entry = {"source": source, "row_start": row_start, "row_end": row_end, "chunk_ids": list(chunk_ids)}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry))
+                f.write("\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._add_range(source, row_start, row_end)
+            self.entries += 1
@@ -0,0 +1,154 @@
+"""
+In-process counters and histograms for the embedding path.
+
+Instrumented code updates the module-level ``registry``. Scripts print ``dump_summary()`` as JSON at the end of
+a run (and write it to ``METRICS_SUMMARY_PATH`` when set), which is what quota sizing and batching-efficiency
+regressions are read from. Nothing is exported while a run is in progress.
+"""
+
+import bisect
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence
+
+METRICS_SUMMARY_PATH = os.environ.get("METRICS_SUMMARY_PATH", "")
+
+# Default bucket upper bounds: request sizes (texts per request) and latencies in seconds.
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+SECONDS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Histogram:
+    """Fixed-bucket histogram; quantiles are bucket upper bounds, capped at the largest observation."""
+
+    def __init__(self, buckets: Sequence[float] = SECONDS_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.bounds) + 1)  # the last bucket is +inf
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.count += 1
+            self.total += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            if not self.count:
+                return {"count": 0}
+            buckets = {f"le_{bound:g}": count for bound, count in zip(self.bounds, self.counts) if count}
+            if self.counts[-1]:
+                buckets["le_inf"] = self.counts[-1]
+            return {
+                "count": self.count,
+                "sum": round(self.total, 6),
+                "mean": round(self.total / self.count, 6),
+                "min": round(self.min, 6),
+                "max": round(self.max, 6),
+                "p50": round(self.quantile(0.5), 6),
+                "p90": round(self.quantile(0.9), 6),
+                "p99": round(self.quantile(0.99), 6),
+                "buckets": buckets,
+            }
+
+
+class MetricsRegistry:
+    """Named counters and histograms, created on first use; ``elapsed`` runs from creation or ``reset``."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counters: Dict[str, Counter] = {}
+            self._histograms: Dict[str, Histogram] = {}
+            self.started = time.monotonic()
+
+    def counter(self, name: str) -> Counter:
+        with self._lock:
+            if name not in self._counters:
+                self._counters[name] = Counter()
+            return self._counters[name]
+
+    def histogram(self, name: str, buckets: Sequence[float] = SECONDS_BUCKETS) -> Histogram:
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram(buckets)
+            return self._histograms[name]
+
+    def inc(self, name: str, amount: float = 1):
+        self.counter(name).inc(amount)
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = SECONDS_BUCKETS):
+        self.histogram(name, buckets).observe(value)
+
+    def value(self, name: str) -> float:
+        with self._lock:
+            counter = self._counters.get(name)
+        return counter.value if counter is not None else 0
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+        values = {name: counters[name].value for name in sorted(counters)}
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "counters": values,
+            "rates_per_s": {name: round(value / elapsed, 3) for name, value in values.items()} if elapsed > 0 else {},
+            "histograms": {name: histograms[name].as_dict() for name in sorted(histograms)},
+        }
+
+
+registry = MetricsRegistry()
+
+
+def dump_summary(
+    title: str = "Metrics summary",
+    extra: Optional[Dict[str, Any]] = None,
+    path: str = METRICS_SUMMARY_PATH,
+    metrics: MetricsRegistry = registry,
+) -> Dict[str, Any]:
+    """Print the registry summary (plus ``extra`` sections) as JSON and write it to ``path`` when given."""
+    summary = {**metrics.summary(), **(extra or {})}
+    text = json.dumps(summary, indent=2, sort_keys=True)
+    print(f"{title}:\n{text}")
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+    return summary
@@ -0,0 +1,218 @@
+"""Bounded-queue streaming pipeline used by the ingest scripts.
+
+Each stage runs in its own thread(s) and is connected to the next one by a
+``queue.Queue`` with a fixed ``maxsize``. A slow stage therefore blocks the
+stages upstream of it (backpressure), and the number of batches held in memory
+at any time is bounded by the queue depth rather than by the corpus size.
+"""
+
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, List, Optional, Sequence
+
+_END = object()
+_POLL_SECONDS = 0.1
+
+
+@dataclass
+class Stage:
+    """One step of the pipeline.
+
+    ``func`` receives one item and returns the item to hand downstream, or
+    ``None`` to drop it. ``size`` measures an item for throughput reporting
+    (e.g. number of rows or chunks); it defaults to counting batches.
+    """
+
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+    size: Optional[Callable[[Any], int]] = None
+
+
+@dataclass
+class StageStats:
+    name: str
+    workers: int = 1
+    batches: int = 0
+    items: int = 0
+    busy_seconds: float = 0.0
+    starved_seconds: float = 0.0  # waiting on the upstream queue
+    blocked_seconds: float = 0.0  # waiting on a full downstream queue
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None or self.finished_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "batches": self.batches,
+            "items": self.items,
+            "elapsed_s": round(self.elapsed, 3),
+            "busy_s": round(self.busy_seconds, 3),
+            "starved_s": round(self.starved_seconds, 3),
+            "blocked_s": round(self.blocked_seconds, 3),
+            "items_per_s": round(self.throughput, 2),
+        }
+
+
+class PipelineError(RuntimeError):
+    """Raised in the caller's thread when any stage fails."""
+
+
+def _put(q: "queue.Queue", item: Any, abort: threading.Event) -> bool:
+    while not abort.is_set():
+        try:
+            q.put(item, timeout=_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(q: "queue.Queue", abort: threading.Event) -> Any:
+    while not abort.is_set():
+        try:
+            return q.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+    return _END
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    stages: Sequence[Stage],
+    queue_size: int = 2,
+    source_name: str = "reader",
+    source_size: Optional[Callable[[Any], int]] = None,
+) -> List[StageStats]:
+    """Stream ``source`` through ``stages`` and return per-stage statistics.
+
+    The output of the last stage is discarded, so it should act as a sink
+    (e.g. upload to ChromaDB). The first exception raised by any stage stops
+    the whole pipeline and is re-raised here wrapped in ``PipelineError``.
+    """
+    if not stages:
+        raise ValueError("run_pipeline requires at least one stage.")
+
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    abort = threading.Event()
+    errors: List[BaseException] = []
+    stats = [StageStats(name=source_name)] + [StageStats(name=s.name, workers=max(1, s.workers)) for s in stages]
+
+    def fail(exc: BaseException):
+        errors.append(exc)
+        abort.set()
+
+    def read_source():
+        st = stats[0]
+        st.started_at = time.perf_counter()
+        try:
+            iterator = iter(source)
+            while not abort.is_set():
+                t0 = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                st.busy_seconds += time.perf_counter() - t0
+                st.batches += 1
+                st.items += source_size(item) if source_size else 1
+                t0 = time.perf_counter()
+                if not _put(queues[0], item, abort):
+                    break
+                st.blocked_seconds += time.perf_counter() - t0
+        except BaseException as exc:  # noqa: B902 - propagate to the caller thread
+            fail(exc)
+        finally:
+            st.finished_at = time.perf_counter()
+            for _ in range(stats[1].workers):
+                _put(queues[0], _END, abort)
+
+    remaining = [s.workers for s in stats[1:]]
+    remaining_lock = threading.Lock()
+
+    def run_stage(index: int):
+        stage = stages[index]
+        st = stats[index + 1]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        with st._lock:
+            if st.started_at is None:
+                st.started_at = time.perf_counter()
+        try:
+            while True:
+                t0 = time.perf_counter()
+                item = _get(inbox, abort)
+                waited = time.perf_counter() - t0
+                if item is _END:
+                    break
+                size = stage.size(item) if stage.size else 1
+                t0 = time.perf_counter()
+                result = stage.func(item)
+                busy = time.perf_counter() - t0
+                blocked = 0.0
+                if outbox is not None and result is not None:
+                    t0 = time.perf_counter()
+                    if not _put(outbox, result, abort):
+                        break
+                    blocked = time.perf_counter() - t0
+                with st._lock:
+                    st.batches += 1
+                    st.items += size
+                    st.busy_seconds += busy
+                    st.starved_seconds += waited
+                    st.blocked_seconds += blocked
+        except BaseException as exc:  # noqa: B902 - propagate to the caller thread
+            fail(exc)
+        finally:
+            with st._lock:
+                st.finished_at = time.perf_counter()
+            with remaining_lock:
+                remaining[index] -= 1
+                last_worker = remaining[index] == 0
+            if last_worker and outbox is not None:
+                for _ in range(stats[index + 2].workers):
+                    _put(outbox, _END, abort)
+
+    threads = [threading.Thread(target=read_source, name=source_name, daemon=True)]
+    for index, stage in enumerate(stages):
+        for worker in range(stats[index + 1].workers):
+            threads.append(
+                threading.Thread(target=run_stage, args=(index,), name=f"{stage.name}-{worker}", daemon=True)
+            )
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise PipelineError(f"Ingest pipeline failed: {errors[0]!r}") from errors[0]
+    return stats
+
+
+def print_stage_stats(stats: Sequence[StageStats], item_label: str = "items"):
+    """Print a compact per-stage throughput table."""
+    print(f"Pipeline stage statistics ({item_label}/s over each stage's wall time):")
+    print(
+        f"{'stage':<12}{'workers':>8}{'batches':>9}{'items':>10}{'busy s':>10}"
+        f"{'starved s':>11}{'blocked s':>11}{'rate':>10}"
+    )
+    for st in stats:
+        print(
+            f"{st.name:<12}{st.workers:>8}{st.batches:>9}{st.items:>10}{st.busy_seconds:>10.2f}"
+            f"{st.starved_seconds:>11.2f}{st.blocked_seconds:>11.2f}{st.throughput:>10.1f}"
+        )
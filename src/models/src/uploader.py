@@ -0,0 +1,255 @@
+"""Concurrent, adaptive-batch uploader for ChromaDB collections."""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+CHROMADB_UPLOAD_WORKERS = int(os.environ.get("CHROMADB_UPLOAD_WORKERS", "4"))
+CHROMADB_UPLOAD_TARGET_SECONDS = float(os.environ.get("CHROMADB_UPLOAD_TARGET_SECONDS", "2.0"))
+CHROMADB_UPLOAD_MAX_BYTES = int(os.environ.get("CHROMADB_UPLOAD_MAX_BYTES", str(8 * 1024 * 1024)))
+CHROMADB_UPLOAD_RETRIES = int(os.environ.get("CHROMADB_UPLOAD_RETRIES", "3"))
+CHROMADB_UPLOAD_RETRY_DELAY = float(os.environ.get("CHROMADB_UPLOAD_RETRY_DELAY", "1.0"))
+
+# Rough JSON size of one float on the wire; used only to keep request bodies under the byte cap.
+_BYTES_PER_FLOAT = 20
+
+# Failures that say nothing about the records themselves: the same request may well succeed later.
+try:
+    import httpx
+
+    _TRANSIENT_ERRORS: Tuple[type, ...] = (ConnectionError, TimeoutError, httpx.TransportError)
+except ImportError:  # httpx ships with chromadb
+    _TRANSIENT_ERRORS = (ConnectionError, TimeoutError)
+_TRANSIENT_STATUS = {408, 429, 502, 503, 504}
+
+
+def server_max_batch_size(client, default: int = 5000) -> int:
+    """Largest batch the Chroma server accepts, falling back to ``default`` when it cannot be queried."""
+    try:
+        return int(client.get_max_batch_size())
+    except Exception:
+        return default
+
+
+def estimate_record_bytes(record: Dict[str, Any]) -> int:
+    size = len(record.get("document") or "") + _BYTES_PER_FLOAT * len(record.get("embedding") or ())
+    for key, value in (record.get("metadata") or {}).items():
+        size += len(key) + len(str(value))
+    return size
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """
+    True for connection problems, timeouts, throttling and gateway errors, which warrant resending the same
+    batch; anything else (rejected payloads, invalid records, plain server errors) is blamed on the records.
+    """
+    if isinstance(exc, _TRANSIENT_ERRORS):
+        return True
+    response = getattr(exc, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        code = getattr(exc, "code", None)
+        status = code() if callable(code) else code
+    return status in _TRANSIENT_STATUS
+
+
+class _Ticket:
+    """Tracks one ``submit`` call so its callback fires once every record has been written or has failed."""
+
+    def __init__(self, count: int, on_done: Optional[Callable[[List[str]], None]]):
+        self.pending = count
+        self.failed_ids: List[str] = []
+        self.on_done = on_done
+
+
+class ChromaUploader:
+    """
+    Uploads records (dicts with ``id``, ``document``, ``metadata`` and ``embedding``) to a collection
+    using several concurrent ``add``/``upsert`` calls. All workers share the collection's HTTP client and
+    therefore its connection pool.
+
+    The batch size adapts after every call: it grows while calls finish under ``target_seconds`` and
+    shrinks when they run slower, and it never exceeds the server's max batch or ``max_payload_bytes``.
+    A batch that fails with a transient error (see ``is_transient_error``) is resent whole, up to ``retries``
+    times with exponential backoff; if the server stays unreachable the whole batch is reported as failed.
+    Any other failure is blamed on the payload and the batch is bisected, so that a single bad record cannot
+    sink its neighbours. Records that fail, either way, are reported in ``failed_ids``.
+    """
+
+    def __init__(
+        self,
+        collection,
+        mode: str = "upsert",
+        workers: int = CHROMADB_UPLOAD_WORKERS,
+        initial_batch_size: int = 50,
+        max_batch_size: int = 5000,
+        min_batch_size: int = 1,
+        target_seconds: float = CHROMADB_UPLOAD_TARGET_SECONDS,
+        max_payload_bytes: int = CHROMADB_UPLOAD_MAX_BYTES,
+        retries: int = CHROMADB_UPLOAD_RETRIES,
+        retry_delay: float = CHROMADB_UPLOAD_RETRY_DELAY,
+    ):
+        if mode not in {"add", "upsert"}:
+            raise ValueError(f"Unsupported upload mode: {mode}")
+        self.collection = collection
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.max_batch_size = max(1, max_batch_size)
+        self.min_batch_size = max(1, min(min_batch_size, self.max_batch_size))
+        self.batch_size = max(self.min_batch_size, min(initial_batch_size, self.max_batch_size))
+        self.target_seconds = target_seconds
+        self.max_payload_bytes = max_payload_bytes
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chroma-upload")
+        # At most two batches per worker in flight, so a fast producer blocks instead of buffering the corpus.
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._lock = threading.Lock()
+        self._buffer: List[Tuple[Dict[str, Any], _Ticket]] = []
+        self._futures: List[Future] = []
+        self._bytes_per_record: Optional[float] = None
+
+        self.failed_ids: List[str] = []
+        self.stats = {
+            "records": 0,
+            "requests": 0,
+            "failed_requests": 0,
+            "retries": 0,
+            "bisections": 0,
+            "upload_seconds": 0.0,
+            "max_batch_used": 0,
+        }
+
+    # -- public API -----------------------------------------------------------------------------------------
+
+    def submit(self, records: Sequence[Dict[str, Any]], on_done: Optional[Callable[[List[str]], None]] = None):
+        """
+        Queue ``records`` for upload. ``on_done`` is called with the list of ids that failed (empty on
+        success) once every record of this call has been processed.
+        """
+        if not records:
+            if on_done is not None:
+                on_done([])
+            return
+        ticket = _Ticket(len(records), on_done)
+        self._buffer.extend((record, ticket) for record in records)
+        while len(self._buffer) >= self.batch_size:
+            self._dispatch(self.batch_size)
+
+    def flush(self):
+        """Send any buffered records and wait until every in-flight batch has finished."""
+        while self._buffer:
+            self._dispatch(self.batch_size)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def print_summary(self):
+        stats = self.stats
+        avg = stats["upload_seconds"] / stats["requests"] if stats["requests"] else 0.0
+        print(
+            f"Uploaded {stats['records']} records in {stats['requests']} {self.mode} calls "
+            f"(avg {avg:.2f}s/call, final batch size {self.batch_size}, largest {stats['max_batch_used']}, "
+            f"{stats['retries']} retries, {stats['bisections']} bisections, {len(self.failed_ids)} failed records)."
+        )
+        if self.failed_ids:
+            print(f"Failed record ids (first 20): {self.failed_ids[:20]}")
+
+    # -- internals ------------------------------------------------------------------------------------------
+
+    def _dispatch(self, size: int):
+        batch, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._slots.acquire()
+        future = self._executor.submit(self._run_batch, batch)
+        future.add_done_callback(lambda _f: self._slots.release())
+        self._futures = [f for f in self._futures if not f.done()]
+        self._futures.append(future)
+
+    def _call(self, records: Sequence[Dict[str, Any]]):
+        method = getattr(self.collection, self.mode)
+        method(
+            ids=[item["id"] for item in records],
+            documents=[item["document"] for item in records],
+            metadatas=[item["metadata"] for item in records],
+            embeddings=[item["embedding"] for item in records],
+        )
+
+    def _run_batch(self, batch: List[Tuple[Dict[str, Any], _Ticket]]):
+        failed = self._send([record for record, _ in batch])
+        failed_set = set(failed)
+        finished: List[_Ticket] = []
+        with self._lock:
+            self.failed_ids.extend(failed)
+            for record, ticket in batch:
+                ticket.pending -= 1
+                if record["id"] in failed_set:
+                    ticket.failed_ids.append(record["id"])
+                if ticket.pending == 0:
+                    finished.append(ticket)
+        for ticket in finished:
+            if ticket.on_done is not None:
+                ticket.on_done(ticket.failed_ids)
+
+    def _send(self, records: List[Dict[str, Any]]) -> List[str]:
+        """Upload ``records``; returns the ids that could not be written."""
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                self._call(records)
+                break
+            except Exception as exc:
+                with self._lock:
+                    self.stats["failed_requests"] += 1
+                if not is_transient_error(exc):
+                    return self._bisect(records, exc)
+                if attempt >= self.retries:
+                    print(f"Giving up on a batch of {len(records)} records after {attempt} retries: {exc}")
+                    return [record["id"] for record in records]
+                with self._lock:
+                    self.stats["retries"] += 1
+                time.sleep(self.retry_delay * 2**attempt)
+                attempt += 1
+
+        self._adapt(len(records), time.perf_counter() - start, sum(estimate_record_bytes(r) for r in records))
+        return []
+
+    def _bisect(self, records: List[Dict[str, Any]], exc: Exception) -> List[str]:
+        """Split a rejected batch to isolate the bad record(s); a rejected single record is given up on."""
+        if len(records) == 1:
+            print(f"Giving up on record {records[0]['id']}: {exc}")
+            return [records[0]["id"]]
+        # Smaller future batches too, in case the payload itself was too large for the server.
+        with self._lock:
+            self.stats["bisections"] += 1
+            self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+        middle = len(records) // 2
+        return self._send(records[:middle]) + self._send(records[middle:])
+
+    def _adapt(self, count: int, seconds: float, payload_bytes: int):
+        with self._lock:
+            self.stats["records"] += count
+            self.stats["requests"] += 1
+            self.stats["upload_seconds"] += seconds
+            self.stats["max_batch_used"] = max(self.stats["max_batch_used"], count)
+
+            per_record = payload_bytes / count
+            if self._bytes_per_record is None:
+                self._bytes_per_record = per_record
+            else:
+                self._bytes_per_record = 0.8 * self._bytes_per_record + 0.2 * per_record
+
+            # Only batches close to the current size say anything about how the server copes with it.
+            if count < self.batch_size // 2:
+                return
+            scale = self.target_seconds / seconds if seconds > 0 else 2.0
+            desired = int(count * min(2.0, max(0.5, scale)))
+            byte_cap = int(self.max_payload_bytes / max(self._bytes_per_record, 1.0))
+            self.batch_size = max(self.min_batch_size, min(desired, byte_cap, self.max_batch_size))
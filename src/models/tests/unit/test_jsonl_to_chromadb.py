@@ -10,6 +10,7 @@ from unittest import mock
 import pytest
 
 from models import jsonl_to_chromadb as jsonl_module
+from models.src.gcs import BackupUnit
 
 
 class TestJsonlToChromaDB:
@@ -41,6 +42,7 @@ class TestJsonlToChromaDB:
         module.BACKUP_BUCKET = "bucket"
         module.BACKUP_PREFIX = "prefix"
         module.CHROMADB_BATCH_SIZE = 2
+        module.CHROMADB_UPLOAD_WORKERS = 1  # one upload worker keeps the call order deterministic
 
         backups = [
             {
@@ -75,13 +77,13 @@ class TestJsonlToChromaDB:
 
         read_mock.assert_called_once_with("bucket", "prefix")
         fake_client.get_or_create_collection.assert_called_once_with(name=module.CHROMADB_COLLECTION)
-        assert fake_collection.add.call_count == 2
-        first_call = fake_collection.add.call_args_list[0].kwargs
+        assert fake_collection.upsert.call_count == 2
+        first_call = fake_collection.upsert.call_args_list[0].kwargs
         assert first_call["ids"] == ["1", "2"]
         assert first_call["embeddings"] == [[0.1], [0.2]]
         assert first_call["metadatas"] == [{"pmid": "1"}, {"pmid": "2"}]
         assert first_call["documents"] == ["doc1", "doc2"]
-        second_call = fake_collection.add.call_args_list[1].kwargs
+        second_call = fake_collection.upsert.call_args_list[1].kwargs
         assert second_call["ids"] == ["3"]
 
     def test_load_backups_to_chromadb_uses_non_semantic_embeddings(self, monkeypatch: pytest.MonkeyPatch):
@@ -114,6 +116,224 @@ class TestJsonlToChromaDB:
 
         module.load_backups_to_chromadb(fake_client, semantic=False)
 
-        fake_collection.add.assert_called_once()
-        call_kwargs = fake_collection.add.call_args.kwargs
+        fake_collection.upsert.assert_called_once()
+        call_kwargs = fake_collection.upsert.call_args.kwargs
         assert call_kwargs["embeddings"] == [[9.1], [9.2]]
+
+    def test_load_backups_to_chromadb_skips_records_without_embeddings(self, monkeypatch: pytest.MonkeyPatch):
+        module = self._reload_module(monkeypatch)
+        module.BACKUP_ENABLED = True
+        module.CHROMADB_BATCH_SIZE = 10
+
+        backups = [
+            {"id": "1", "embedding": [9.1], "metadata": {"pmid": "1"}, "document": "doc1"},
+            {"id": "2", "embeddings_semantic": [0.2], "metadata": {"pmid": "2"}, "document": "doc2"},
+        ]
+        monkeypatch.setattr(module, "stream_backup_from_gcs", mock.Mock(return_value=backups))
+        fake_collection = mock.Mock()
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+
+        module.load_backups_to_chromadb(fake_client, semantic=True)
+
+        call_kwargs = fake_collection.upsert.call_args.kwargs
+        assert call_kwargs["ids"] == ["2"]
+        assert call_kwargs["embeddings"] == [[0.2]]
+
+    def test_load_backups_to_chromadb_exits_non_zero_on_failed_records(self, monkeypatch: pytest.MonkeyPatch):
+        module = self._reload_module(monkeypatch)
+        module.BACKUP_ENABLED = True
+
+        backups = [
+            {"id": "1", "embeddings_semantic": [0.1], "metadata": {"pmid": "1"}, "document": "doc1"},
+            {"id": "2", "embeddings_semantic": [0.2], "metadata": {"pmid": "2"}, "document": "doc2"},
+        ]
+        monkeypatch.setattr(module, "stream_backup_from_gcs", mock.Mock(return_value=backups))
+        fake_collection = mock.Mock()
+        fake_collection.upsert.side_effect = ValueError("rejected")
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+
+        with pytest.raises(SystemExit, match="2 records could not be restored"):
+            module.load_backups_to_chromadb(fake_client, semantic=True)
+
+    def test_sharded_restore_checkpoints_and_resumes(self, monkeypatch: pytest.MonkeyPatch, tmp_path):
+        module = self._reload_module(monkeypatch, RESTORE_CHECKPOINT_DIR=str(tmp_path))
+        module.BACKUP_ENABLED = True
+        module.CHROMADB_BATCH_SIZE = 2
+        module.CHROMADB_UPLOAD_WORKERS = 1
+
+        units = [BackupUnit(mock.Mock(size=10), 0, 10), BackupUnit(mock.Mock(size=10), 0, 10)]
+        units[0].blob.name, units[1].blob.name = "a.jsonl", "b.jsonl"
+
+        def stream(todo):
+            for unit in todo:
+                for index in range(3):
+                    yield unit, index, {
+                        "id": f"{unit.name}-{index}",
+                        "embeddings_semantic": [0.1],
+                        "metadata": {},
+                        "document": "d",
+                    }
+
+        monkeypatch.setattr(module.storage, "Client", mock.Mock())
+        monkeypatch.setattr(module, "plan_backup_units", mock.Mock(return_value=units))
+        monkeypatch.setattr(module, "load_tombstones", mock.Mock(return_value={}))
+        monkeypatch.setattr(module, "stream_backup_units", mock.Mock(side_effect=stream))
+        fake_collection = mock.Mock()
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+
+        module.load_backups_to_chromadb(fake_client, semantic=True, shard=(0, 2))
+
+        uploaded = [i for call in fake_collection.upsert.call_args_list for i in call.kwargs["ids"]]
+        owned = module.assign_backup_units(units, 0, 2)
+        assert uploaded == [f"{owned[0].name}-{index}" for index in range(3)]
+        report = module.report_restore_progress(str(tmp_path))
+        assert report["units_done"] == report["units_total"] == 1
+        assert report["records_loaded"] == 3 and report["shards_finished"] == 1
+
+        fake_collection.reset_mock()
+        module.load_backups_to_chromadb(fake_client, semantic=True, shard=(0, 2))
+        fake_collection.upsert.assert_not_called()
+        module.stream_backup_units.assert_called_with([])
+
+    def test_sharded_restore_counts_partial_batches_at_unit_boundaries(self, monkeypatch, tmp_path, capsys):
+        module = self._reload_module(monkeypatch, RESTORE_CHECKPOINT_DIR=str(tmp_path))
+        module.BACKUP_ENABLED = True
+        module.CHROMADB_BATCH_SIZE = 2
+        module.CHROMADB_UPLOAD_WORKERS = 1
+
+        units = [BackupUnit(mock.Mock(size=10)), BackupUnit(mock.Mock(size=10))]
+        units[0].blob.name, units[1].blob.name = "a.jsonl", "b.jsonl"
+
+        def stream(todo):
+            for unit in todo:
+                for index in range(3):
+                    yield unit, index, {
+                        "id": f"{unit.name}-{index}",
+                        "embeddings_semantic": [0.1],
+                        "metadata": {},
+                        "document": "d",
+                    }
+
+        monkeypatch.setattr(module.storage, "Client", mock.Mock())
+        monkeypatch.setattr(module, "plan_backup_units", mock.Mock(return_value=units))
+        monkeypatch.setattr(module, "load_tombstones", mock.Mock(return_value={}))
+        monkeypatch.setattr(module, "stream_backup_units", mock.Mock(side_effect=stream))
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=mock.Mock()))
+
+        module.load_backups_to_chromadb(fake_client, semantic=True, shard=(0, 1))
+
+        # Each unit ends with a one-record batch that is flushed at the unit boundary.
+        assert module.report_restore_progress(str(tmp_path))["records_loaded"] == 6
+        assert "Finished loading 6 records" in capsys.readouterr().out
+
+    def test_sharded_restore_resumes_on_a_new_pod_from_the_gcs_checkpoint(self, monkeypatch, tmp_path):
+        class FakeBlob:
+            def __init__(self, store, name):
+                self.store, self.name = store, name
+
+            def exists(self):
+                return self.name in self.store
+
+            def download_to_filename(self, path):
+                with open(path, "wb") as f:
+                    f.write(self.store[self.name])
+
+            def upload_from_filename(self, path):
+                with open(path, "rb") as f:
+                    self.store[self.name] = f.read()
+
+            def download_as_bytes(self):
+                return self.store[self.name]
+
+        class FakeBucket:
+            name = "ckpt"
+
+            def __init__(self):
+                self.store = {}
+
+            def blob(self, name):
+                return FakeBlob(self.store, name)
+
+            def list_blobs(self, prefix):
+                return [FakeBlob(self.store, name) for name in self.store if name.startswith(prefix)]
+
+        bucket = FakeBucket()
+        units = [BackupUnit(mock.Mock(size=10)), BackupUnit(mock.Mock(size=10))]
+        units[0].blob.name, units[1].blob.name = "a.jsonl", "b.jsonl"
+
+        def stream(todo):
+            for unit in todo:
+                for index in range(2):
+                    yield unit, index, {
+                        "id": f"{unit.name}-{index}",
+                        "embeddings_semantic": [0.1],
+                        "metadata": {},
+                        "document": "d",
+                    }
+
+        def run_pod(checkpoint_dir):
+            # Every pod starts with an empty local checkpoint directory.
+            module = self._reload_module(
+                monkeypatch, RESTORE_CHECKPOINT_DIR=str(checkpoint_dir), RESTORE_CHECKPOINT_GCS="gs://ckpt/restore/"
+            )
+            module.BACKUP_ENABLED = True
+            module.CHROMADB_UPLOAD_WORKERS = 1
+            monkeypatch.setattr(module.storage, "Client", mock.Mock(return_value=mock.Mock(bucket=lambda _: bucket)))
+            monkeypatch.setattr(module, "plan_backup_units", mock.Mock(return_value=units))
+            monkeypatch.setattr(module, "load_tombstones", mock.Mock(return_value={}))
+            monkeypatch.setattr(module, "stream_backup_units", mock.Mock(side_effect=stream))
+            collection = mock.Mock()
+            module.load_backups_to_chromadb(
+                mock.Mock(get_or_create_collection=mock.Mock(return_value=collection)), semantic=True, shard=(0, 1)
+            )
+            return module, collection
+
+        module, collection = run_pod(tmp_path / "pod-1")
+        assert collection.upsert.call_count == 2
+        assert sorted(bucket.store) == ["restore/shard-000-of-001.jsonl", "restore/shard-000-of-001.progress.json"]
+
+        module, collection = run_pod(tmp_path / "pod-2")
+        collection.upsert.assert_not_called()
+        module.stream_backup_units.assert_called_with([])
+        report = module.report_restore_progress()
+        assert report["units_done"] == report["units_total"] == 2 and report["shards_finished"] == 1
+
+    def test_parse_shard(self):
+        assert jsonl_module._parse_shard("1/4") == (1, 4)
+        for bad in ["4/4", "x", "1-4"]:
+            with pytest.raises(jsonl_module.ArgumentTypeError):
+                jsonl_module._parse_shard(bad)
+
+    def test_build_snapshot_loads_local_client_and_restores(self, monkeypatch: pytest.MonkeyPatch, tmp_path):
+        import chromadb
+
+        from models import snapshot
+
+        from .test_snapshot import FakeBucket
+
+        module = self._reload_module(monkeypatch)
+        module.SNAPSHOT_BATCH_SIZE = 2
+        backups = [
+            {"id": str(i), "embeddings_semantic": [float(i), 1.0], "metadata": {"pmid": str(i)}, "document": f"doc{i}"}
+            for i in range(5)
+        ]
+        monkeypatch.setattr(module, "stream_backup_from_gcs", mock.Mock(return_value=backups))
+        bucket = FakeBucket()
+        monkeypatch.setattr(module.storage, "Client", mock.Mock(return_value=mock.Mock(bucket=lambda name: bucket)))
+
+        manifest = module.build_snapshot(str(tmp_path / "build"), semantic=True)
+
+        assert manifest["record_count"] == 5
+        assert manifest["embedding_key"] == "embeddings_semantic"
+        snapshot.restore_snapshot(bucket, str(tmp_path / "dest"), prefix=snapshot.SNAPSHOT_PREFIX)
+        restored = chromadb.PersistentClient(path=str(tmp_path / "dest")).get_collection(module.CHROMADB_COLLECTION)
+        assert restored.count() == 5
+        assert restored.query(query_embeddings=[[3.0, 1.0]], n_results=1)["ids"] == [["3"]]
+        chromadb.api.client.SharedSystemClient.clear_system_cache()
+
+    def test_build_snapshot_refuses_non_empty_directory(self, monkeypatch: pytest.MonkeyPatch, tmp_path):
+        module = self._reload_module(monkeypatch)
+        (tmp_path / "leftover").write_text("x")
+
+        with pytest.raises(RuntimeError, match="not empty"):
+            module.build_snapshot(str(tmp_path), publish=False)
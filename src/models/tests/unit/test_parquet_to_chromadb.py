@@ -4,6 +4,10 @@ Unit test for parquet_to_chromadb.py pipeline
 
 import pytest
 import pandas as pd
+from argparse import Namespace
+from unittest import mock
+
+from models import parquet_to_chromadb
 from models.parquet_to_chromadb import _build_chunk_records
 
 # from models.parquet_to_chromadb import connect_to_chromadb, _build_chunk_records, _upload_records
@@ -11,6 +15,10 @@ from models.parquet_to_chromadb import _build_chunk_records
 
 class TestParquetToChromaDB:
 
+    @pytest.fixture(autouse=True)
+    def _dedup_state(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_DEDUP_PATH", str(tmp_path / "dedup.sqlite3"))
+
     def test_build_chunk_records(self):
 
         data = {
@@ -44,3 +52,216 @@ class TestParquetToChromaDB:
 
         with pytest.raises(ValueError):
             _build_chunk_records(df, chunk_map, chunk_texts, embeddings)
+
+    def test_build_chunk_records_row_offset_for_missing_pmid(self):
+        df = pd.DataFrame({"title": ["Title 1"]})
+
+        records = _build_chunk_records(df, [(0, 1)], ["text"], [[0.1]], row_offset=40)
+
+        assert records[0]["id"] == "row-40-1"
+        assert records[0]["metadata"]["pmid"] == "row-40"
+
+    def test_main_streams_batches_to_chromadb(self, monkeypatch, tmp_path):
+        batches = [
+            ("blob-a.parquet", 0, pd.DataFrame({"pmid": [1, 2], "abstract": ["First abstract.", "Second."]})),
+            ("blob-b.parquet", 0, pd.DataFrame({"pmid": [3], "abstract": ["Third abstract."]})),
+        ]
+        monkeypatch.setattr(parquet_to_chromadb, "iter_parquet_batches_from_gcs", mock.Mock(return_value=batches))
+
+        monkeypatch.setattr(parquet_to_chromadb, "embed_texts", lambda texts: [[0.5] * 4 for _ in texts])
+        monkeypatch.setattr(parquet_to_chromadb, "BACKUP_ENABLED", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_JOURNAL_PATH", str(tmp_path / "journal.jsonl"))
+        fake_collection = mock.Mock()
+        fake_collection.get.return_value = {"ids": ["2-0"]}
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+        monkeypatch.setattr(parquet_to_chromadb, "connect_to_chromadb", mock.Mock(return_value=fake_client))
+
+        parquet_to_chromadb.main()
+
+        uploaded = sorted(i for call in fake_collection.upsert.call_args_list for i in call.kwargs["ids"])
+        assert uploaded == ["1-0", "3-0"]
+        fake_collection.add.assert_not_called()
+
+        # A rerun resumes from the journal and does no work at all.
+        fake_collection.upsert.reset_mock()
+        fake_collection.get.reset_mock()
+        parquet_to_chromadb.main()
+
+        fake_collection.upsert.assert_not_called()
+        fake_collection.get.assert_not_called()
+
+    def test_main_exits_non_zero_when_records_fail_to_upload(self, monkeypatch, tmp_path):
+        batches = [("blob-a.parquet", 0, pd.DataFrame({"pmid": [1, 2], "abstract": ["First abstract.", "Second."]}))]
+        monkeypatch.setattr(parquet_to_chromadb, "iter_parquet_batches_from_gcs", mock.Mock(return_value=batches))
+        monkeypatch.setattr(parquet_to_chromadb, "embed_texts", lambda texts: [[0.5] * 4 for _ in texts])
+        monkeypatch.setattr(parquet_to_chromadb, "BACKUP_ENABLED", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_JOURNAL_PATH", str(tmp_path / "journal.jsonl"))
+
+        def upsert(ids, **_kwargs):
+            if "2-0" in ids:
+                raise ValueError("bad record")
+
+        fake_collection = mock.Mock()
+        fake_collection.get.return_value = {"ids": []}
+        fake_collection.upsert.side_effect = upsert
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+        monkeypatch.setattr(parquet_to_chromadb, "connect_to_chromadb", mock.Mock(return_value=fake_client))
+
+        with pytest.raises(SystemExit, match="1 records could not be uploaded"):
+            parquet_to_chromadb.main()
+
+    def test_main_drops_near_duplicate_chunks_before_embedding(self, monkeypatch, tmp_path):
+        text = "Hydroxychloroquine did not reduce mortality in hospitalized adults with pneumonia."
+        batches = [
+            ("blob-a.parquet", 0, pd.DataFrame({"pmid": [1, 2], "abstract": [text, "Unrelated sleep study."]})),
+            ("blob-b.parquet", 0, pd.DataFrame({"pmid": [3], "abstract": [text + " "]})),
+        ]
+        monkeypatch.setattr(parquet_to_chromadb, "iter_parquet_batches_from_gcs", mock.Mock(return_value=batches))
+        embedded = []
+
+        def fake_embed(texts):
+            embedded.extend(texts)
+            return [[0.5] * 4 for _ in texts]
+
+        monkeypatch.setattr(parquet_to_chromadb, "embed_texts", fake_embed)
+        monkeypatch.setattr(parquet_to_chromadb, "BACKUP_ENABLED", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_SKIP_EXISTING", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_JOURNAL_PATH", str(tmp_path / "journal.jsonl"))
+        fake_collection = mock.Mock()
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+        monkeypatch.setattr(parquet_to_chromadb, "connect_to_chromadb", mock.Mock(return_value=fake_client))
+
+        parquet_to_chromadb.main()
+
+        assert embedded == [text, "Unrelated sleep study."]
+        uploaded = sorted(i for call in fake_collection.upsert.call_args_list for i in call.kwargs["ids"])
+        assert uploaded == ["1-0", "2-0"]
+        # Depending on timing, the duplicate is recorded on the canonical record as it is built or,
+        # if that record was already built, with an update at the end of the run.
+        written = {
+            record_id: metadata.get("duplicate_pmids")
+            for call in fake_collection.upsert.call_args_list
+            for record_id, metadata in zip(call.kwargs["ids"], call.kwargs["metadatas"])
+        }
+        updated = {
+            record_id: metadata["duplicate_pmids"]
+            for call in fake_collection.update.call_args_list
+            for record_id, metadata in zip(call.kwargs["ids"], call.kwargs["metadatas"])
+        }
+        assert {**{k: v for k, v in written.items() if v}, **updated} == {"1-0": "3"}
+
+    def test_build_chunk_records_stringifies_columns_once_per_row(self):
+        df = pd.DataFrame(
+            {
+                "pmid": [123, 456],
+                "journal_title": ["JAMA", None],
+                "publication_date": pd.to_datetime(["2024-01-02", None]),
+                "is_top_journal": [True, False],
+            }
+        )
+
+        records = _build_chunk_records(df, [(0, 0), (0, 1), (1, 0)], ["a", "bb", "c"], [[0.1], [0.2], [0.3]])
+
+        assert [r["id"] for r in records] == ["123-0", "123-1", "456-0"]
+        assert records[0]["metadata"] == {
+            "pmid": "123",
+            "journal_title": "JAMA",
+            "publication_date": "2024-01-02T00:00:00",
+            "is_top_journal": "True",
+            "chunk_index": 0,
+            "chunk_char_count": 1,
+        }
+        assert records[1]["metadata"]["chunk_index"] == 1
+        assert records[1]["metadata"]["chunk_char_count"] == 2
+        # NA values are dropped rather than stored as "None"/"NaT"
+        assert records[2]["metadata"] == {
+            "pmid": "456",
+            "is_top_journal": "False",
+            "chunk_index": 0,
+            "chunk_char_count": 1,
+        }
+
+    def test_main_delta_ingests_changed_rows_only_and_prunes_missing_articles(self, monkeypatch, tmp_path):
+        runs = [
+            pd.DataFrame({"pmid": [1, 2, 3], "abstract": ["First abstract.", "Second abstract.", "Third abstract."]}),
+            pd.DataFrame({"pmid": [1, 2, 4], "abstract": ["First abstract.", "Second, revised.", "Fourth abstract."]}),
+        ]
+        source = mock.Mock(side_effect=[[("blob.parquet", 0, df)] for df in runs])
+        monkeypatch.setattr(parquet_to_chromadb, "iter_parquet_batches_from_gcs", source)
+        embedded = []
+
+        def fake_embed(texts):
+            embedded.append(list(texts))
+            return [[0.5] * 4 for _ in texts]
+
+        monkeypatch.setattr(parquet_to_chromadb, "embed_texts", fake_embed)
+        backup = mock.Mock()
+        monkeypatch.setattr(parquet_to_chromadb, "BACKUP_ENABLED", True)
+        monkeypatch.setattr(parquet_to_chromadb, "_make_backup_sink", mock.Mock(return_value=backup))
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_SKIP_EXISTING", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_FINGERPRINT_PATH", str(tmp_path / "fingerprints.sqlite3"))
+        fake_collection = mock.Mock()
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+        monkeypatch.setattr(parquet_to_chromadb, "connect_to_chromadb", mock.Mock(return_value=fake_client))
+        args = Namespace(fresh=False, no_journal=False, delta=True, prune=True)
+
+        parquet_to_chromadb.main(args)
+        fake_collection.delete.assert_not_called()
+        fake_collection.upsert.reset_mock()
+
+        parquet_to_chromadb.main(args)
+
+        assert embedded[1] == ["Second, revised.", "Fourth abstract."]
+        uploaded = sorted(i for call in fake_collection.upsert.call_args_list for i in call.kwargs["ids"])
+        assert uploaded == ["2-0", "4-0"]
+        deleted = [call.kwargs["where"] for call in fake_collection.delete.call_args_list]
+        assert deleted == [{"pmid": {"$in": ["2"]}}, {"pmid": {"$in": ["3"]}}]
+        # Both deletions are recorded in the backup so a restore does not bring the old chunks back.
+        tombstones = [call.args[0] for call in backup.write_tombstones.call_args_list if call.args[0]]
+        assert tombstones == [["2"], ["3"]]
+        assert not (tmp_path / "journal.jsonl").exists()
+
+    def test_main_delta_reingests_duplicates_of_a_changed_canonical(self, monkeypatch, tmp_path):
+        text = "Hydroxychloroquine did not reduce mortality in hospitalized adults with pneumonia."
+        runs = [
+            pd.DataFrame({"pmid": [1, 2, 3], "abstract": [text, text + " ", "Unrelated sleep study."]}),
+            # the canonical article is rewritten; its reprint (2) is unchanged
+            pd.DataFrame({"pmid": [1, 2, 3], "abstract": ["Retracted.", text + " ", "Unrelated sleep study."]}),
+            pd.DataFrame(
+                {"pmid": [1, 2, 3, 4], "abstract": ["Retracted.", text + " ", "Unrelated sleep study.", text]}
+            ),
+        ]
+        source = mock.Mock(side_effect=lambda *_args, **_kwargs: [("blob.parquet", 0, runs[len(embedded) - 1])])
+        monkeypatch.setattr(parquet_to_chromadb, "iter_parquet_batches_from_gcs", source)
+        embedded = []
+
+        def fake_embed(texts):
+            embedded[-1].extend(texts)
+            return [[0.5] * 4 for _ in texts]
+
+        monkeypatch.setattr(parquet_to_chromadb, "embed_texts", fake_embed)
+        monkeypatch.setattr(parquet_to_chromadb, "BACKUP_ENABLED", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_SKIP_EXISTING", False)
+        monkeypatch.setattr(parquet_to_chromadb, "INGEST_FINGERPRINT_PATH", str(tmp_path / "fingerprints.sqlite3"))
+        fake_collection = mock.Mock()
+        fake_client = mock.Mock(get_or_create_collection=mock.Mock(return_value=fake_collection))
+        monkeypatch.setattr(parquet_to_chromadb, "connect_to_chromadb", mock.Mock(return_value=fake_client))
+        args = Namespace(fresh=False, no_journal=False, delta=True, prune=False)
+
+        def run():
+            embedded.append([])
+            fake_collection.reset_mock()
+            parquet_to_chromadb.main(args)
+            return sorted(i for call in fake_collection.upsert.call_args_list for i in call.kwargs["ids"])
+
+        assert run() == ["1-0", "3-0"]
+
+        # Deleting the canonical chunk of 1 would lose 2, which was only stored as its duplicate.
+        assert run() == ["1-0", "2-0"]
+        assert [call.kwargs["where"] for call in fake_collection.delete.call_args_list] == [{"pmid": {"$in": ["1"]}}]
+        assert text in embedded[1]
+
+        # The next run knows 2-0 from the stored dedup state: a new reprint is not embedded.
+        assert run() == []
+        assert embedded[2] == []
+        fake_collection.update.assert_called_once_with(ids=["2-0"], metadatas=[{"duplicate_pmids": "4"}])
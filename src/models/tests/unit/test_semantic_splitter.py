@@ -4,42 +4,62 @@ Unit tests for semantic_splitter helpers.
 
 from __future__ import annotations
 
+import json
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import numpy as np
 import pytest
+from langchain_core.documents import Document
+
+from models.src import embedder
 
 from models.semantic_splitter import (
     SemanticChunker,
     calculate_cosine_distances,
     combine_sentences,
+    pooled_accuracy_report,
 )
 
 
 def test_combine_sentences_applies_buffer():
-    sentences = [
-        {"sentence": "alpha"},
-        {"sentence": "beta"},
-        {"sentence": "gamma"},
-    ]
+    combined = combine_sentences(["alpha", "beta", "gamma"], buffer_size=1)
+
+    assert combined == ["alpha beta", "alpha beta gamma", "beta gamma"]
+    assert combine_sentences(["alpha", "beta", "gamma"], buffer_size=2)[0] == "alpha beta gamma"
 
-    combined = combine_sentences(sentences, buffer_size=1)
 
-    assert combined[0]["combined_sentence"] == "alpha beta"
-    assert combined[1]["combined_sentence"] == "alpha beta gamma"
-    assert combined[2]["combined_sentence"] == "beta gamma"
+def test_calculate_cosine_distances_between_adjacent_rows():
+    embeddings = np.array([[1.0, 0.0], [0.0, 2.0], [3.0, 0.0], [0.0, 0.0]])
 
+    distances = calculate_cosine_distances(embeddings)
 
-def test_calculate_cosine_distances_tracks_distance_to_next():
-    sentences = [
-        {"combined_sentence_embedding": [1.0, 0.0]},
-        {"combined_sentence_embedding": [0.0, 1.0]},
-        {"combined_sentence_embedding": [1.0, 0.0]},
-    ]
+    assert distances.shape == (3,)
+    assert distances[:2] == pytest.approx([1.0, 1.0])
+    # an all-zero row is treated as orthogonal to everything instead of producing NaN
+    assert distances[2] == pytest.approx(1.0)
+    assert calculate_cosine_distances(embeddings[:1]).shape == (0,)
 
-    distances, enriched = calculate_cosine_distances(sentences)
 
-    assert len(distances) == 2
-    assert distances[0] == pytest.approx(1.0)
-    assert "distance_to_next" in enriched[0]
-    assert enriched[0]["distance_to_next"] == pytest.approx(1.0)
+@pytest.mark.parametrize("threshold_type", ["percentile", "standard_deviation", "interquartile", "gradient"])
+def test_split_texts_matches_per_document_thresholds(threshold_type):
+    rng = np.random.default_rng(0)
+    vectors = {}
+
+    def fake_embed(texts, batch_size=50):
+        return [vectors.setdefault(text, rng.normal(size=8).tolist()) for text in texts]
+
+    documents = [" ".join(f"S{d}x{i}." for i in range(n)) for d, n in enumerate([2, 3, 5, 5, 8, 1, 8])]
+    chunker = SemanticChunker(
+        embedding_function=fake_embed, breakpoint_threshold_type=threshold_type, breakpoint_threshold_amount=50
+    )
+
+    batched = chunker.split_texts(documents)
+
+    # documents of equal length are thresholded together; each must match a split on its own
+    assert batched == [chunker.split_text(document) for document in documents]
+    assert all(" ".join(chunks) == document for chunks, document in zip(batched, documents))
 
 
 def test_split_text_chunks_on_large_distance():
@@ -63,3 +83,216 @@ def test_split_text_chunks_on_large_distance():
     chunks = chunker.split_text("A. B. C. D.")
 
     assert chunks == ["A. B.", "C. D."]
+
+
+def test_split_texts_packs_windows_across_documents():
+    mapping = {
+        "A. B.": [1.0, 0.0],
+        "A. B. C.": [1.0, 0.0],
+        "B. C. D.": [-1.0, 0.0],
+        "C. D.": [-1.0, 0.0],
+    }
+    calls = []
+
+    def fake_embed(texts, batch_size=50):
+        calls.append(list(texts))
+        return [mapping[text] for text in texts]
+
+    chunker = SemanticChunker(
+        embedding_function=fake_embed,
+        breakpoint_threshold_amount=80,
+        embedding_batch_size=6,
+    )
+
+    chunks = chunker.split_texts(["A. B. C. D.", "Single sentence.", "A. B. C. D."])
+
+    assert chunks == [["A. B.", "C. D."], ["Single sentence."], ["A. B.", "C. D."]]
+    # 8 windows from two documents in requests of at most 6, instead of one request per document
+    assert [len(batch) for batch in calls] == [6, 2]
+
+
+def test_create_documents_flushes_pending_windows_and_keeps_metadata():
+    def fake_embed(texts, batch_size=50):
+        return [[1.0, float(i % 2)] for i, _ in enumerate(texts)]
+
+    chunker = SemanticChunker(embedding_function=fake_embed, max_pending_windows=2, add_start_index=True)
+
+    documents = chunker.create_documents(
+        ["One. Two.", "Three. Four.", "Five."], metadatas=[{"pmid": str(i)} for i in range(3)]
+    )
+
+    assert [doc.metadata["pmid"] for doc in documents][-1] == "2"
+    assert {doc.metadata["pmid"] for doc in documents} == {"0", "1", "2"}
+    assert documents[-1].page_content == "Five."
+    assert all("start_index" in doc.metadata for doc in documents)
+
+
+def test_split_texts_rejects_mismatched_embedding_count():
+    chunker = SemanticChunker(embedding_function=lambda texts, batch_size=50: [[1.0, 0.0]])
+
+    with pytest.raises(ValueError, match="returned 1 embeddings for 2 texts"):
+        chunker.split_texts(["One. Two."])
+
+
+def _additive_embedder():
+    """Embeds a text as the sum of fixed unit vectors of its sentences, so pooling is exact."""
+    rng = np.random.default_rng(1)
+    vectors = {}
+    calls = []
+
+    def sentence_vector(sentence):
+        if sentence not in vectors:
+            vector = rng.normal(size=16)
+            vectors[sentence] = vector / np.linalg.norm(vector)
+        return vectors[sentence]
+
+    def embed(texts, batch_size=50):
+        calls.append(list(texts))
+        return [sum(sentence_vector(s) for s in text.split(" ")).tolist() for text in texts]
+
+    return embed, calls
+
+
+def test_pooled_mode_embeds_each_sentence_once():
+    embed, calls = _additive_embedder()
+    documents = [" ".join(f"D{d}s{i}." for i in range(n)) for d, n in enumerate([6, 1, 4])]
+    chunker = SemanticChunker(embedding_function=embed, window_embedding="pooled", breakpoint_threshold_amount=60)
+
+    results = list(chunker.iter_split_texts_with_embeddings(documents))
+
+    embedded = [text for batch in calls for text in batch]
+    assert sorted(embedded) == sorted(sentence for document in documents for sentence in document.split(" "))
+    for (chunks, vectors), document in zip(results, documents):
+        assert " ".join(chunks) == document
+        assert vectors.shape == (len(chunks), 16)
+        assert np.linalg.norm(vectors, axis=1) == pytest.approx(np.ones(len(chunks)))
+
+
+def test_pooled_mode_skips_blank_sentences_like_embed_texts():
+    embed, calls = _additive_embedder()
+
+    def embed_nonblank(texts, batch_size=50):
+        # embed_texts drops empty strings before calling the service
+        return embed([text for text in texts if text.strip()], batch_size)
+
+    documents = ["Statins lower LDL. They reduce events. Adherence matters. ", "Aspirin. Bleeding risk. "]
+    for mode in ("pooled", "exact"):
+        chunker = SemanticChunker(
+            embedding_function=embed_nonblank, window_embedding=mode, breakpoint_threshold_amount=60
+        )
+
+        results = list(chunker.iter_split_texts_with_embeddings(documents))
+
+        assert all(text.strip() for batch in calls for text in batch)
+        for (chunks, vectors), document in zip(results, documents):
+            assert " ".join(chunks).strip() == document.strip()
+            assert vectors.shape == (len(chunks), 16)
+
+
+def test_pooled_accuracy_report_matches_exact_for_additive_embeddings():
+    embed, _ = _additive_embedder()
+    documents = [" ".join(f"D{d}s{i}." for i in range(n)) for d, n in enumerate([6, 2, 9, 1, 5])]
+
+    report = pooled_accuracy_report(documents, embed, breakpoint_threshold_amount=60)
+
+    assert report["identical_chunking"] == 1.0
+    assert report["boundary_f1"] == 1.0
+    assert report["chunk_embedding_cosine_min"] == pytest.approx(1.0)
+    assert report["embedding_reduction"] > 2
+
+
+def test_report_metrics_prints_embedding_summary_after_a_run(capsys):
+    embed, calls = _additive_embedder()
+    documents = [" ".join(f"D{d}s{i}." for i in range(n)) for d, n in enumerate([6, 4])]
+    chunker = SemanticChunker(
+        embedding_function=embed, window_embedding="pooled", breakpoint_threshold_amount=60, report_metrics=True
+    )
+
+    chunker.split_texts(documents)
+
+    output = capsys.readouterr().out
+    summary = json.loads(output.split("Semantic chunking metrics:\n", 1)[1])
+    assert summary["embedding_stats"] == chunker.embedding_stats
+    assert summary["counters"]["semantic.texts"] >= chunker.embedding_stats["texts"]
+    assert summary["histograms"]["semantic.request_texts"]["count"] >= len(calls)
+
+
+def test_split_documents_prints_the_metrics_summary_by_default(capsys):
+    embed, _ = _additive_embedder()
+    chunker = SemanticChunker(embedding_function=embed, breakpoint_threshold_amount=60)
+    documents = [Document(page_content=" ".join(f"D{d}s{i}." for i in range(n))) for d, n in enumerate([6, 4])]
+
+    chunker.split_documents(documents)
+
+    output = capsys.readouterr().out
+    assert output.count("Semantic chunking metrics:") == 1
+    summary = json.loads(output.split("Semantic chunking metrics:\n", 1)[1])
+    assert summary["embedding_stats"] == chunker.embedding_stats
+
+    chunker.split_text("D0s0. D0s1. D0s2.")
+    assert "Semantic chunking metrics:" not in capsys.readouterr().out
+
+
+def test_parallel_driver_matches_serial_and_embeds_in_main_process():
+    embed, calls = _additive_embedder()
+    documents = [" ".join(f"D{d}s{i}." for i in range(n)) for d, n in enumerate([6, 1, 4, 9, 2, 7, 3])]
+    serial = SemanticChunker(embedding_function=embed, breakpoint_threshold_amount=60)
+    parallel = SemanticChunker(
+        embedding_function=embed,
+        breakpoint_threshold_amount=60,
+        workers=2,
+        documents_per_task=3,
+        embedding_workers=2,
+        embedding_batch_size=5,
+    )
+
+    expected = serial.split_texts(documents)
+    calls.clear()
+
+    assert parallel.split_texts(documents) == expected
+    # the workers never see the embedding function; every request was made here
+    assert sum(len(batch) for batch in calls) == parallel.embedding_stats["texts"] > 0
+
+
+def test_default_embedding_threads_share_the_embedder_rate_limiter():
+    embed, _ = _additive_embedder()
+    pool = embedder.RegionPool(["us-central1"], requests_per_minute=60_000)
+    limiter = pool.regions[0].limiter
+    acquire = limiter.acquire
+    threads = set()
+
+    def counting_acquire(*args, **kwargs):
+        threads.add(threading.get_ident())
+        return acquire(*args, **kwargs)
+
+    def embed_content(model, contents, config):
+        time.sleep(0.01)
+        return MagicMock(embeddings=[MagicMock(values=vector) for vector in embed(contents)])
+
+    client = MagicMock()
+    client.models.embed_content.side_effect = embed_content
+    documents = [" ".join(f"D{d}s{i}." for i in range(n)) for d, n in enumerate([6, 4, 9, 7, 5])]
+    with (
+        patch.object(limiter, "acquire", side_effect=counting_acquire) as spy,
+        patch.object(embedder, "_regions", pool),
+        patch.object(embedder, "_backend", embedder.VertexBackend()),
+        patch.object(embedder, "_get_client", return_value=client),
+    ):
+        chunker = SemanticChunker(breakpoint_threshold_amount=60, embedding_workers=4, embedding_batch_size=3)
+        chunker.split_texts(documents)
+
+    # every packed request of every thread took a token from the one process-wide region limiter
+    assert spy.call_count == client.models.embed_content.call_count == chunker.embedding_stats["requests"] > 4
+    assert len(threads) > 1
+    assert pool.regions[0].in_flight == 0
+
+
+def test_create_documents_shares_metadata_between_chunks():
+    embed, _ = _additive_embedder()
+    chunker = SemanticChunker(embedding_function=embed, breakpoint_threshold_amount=10)
+    metadata = {"pmid": "1", "authors": ["A", "B"]}
+
+    documents = chunker.create_documents(["D0s0. D0s1. D0s2. D0s3."], metadatas=[metadata])
+
+    assert len(documents) > 1
+    assert all(doc.metadata is metadata for doc in documents)
@@ -0,0 +1,102 @@
+"""
+Unit tests for snapshot.py
+"""
+
+import json
+import os
+
+import pytest
+
+from models import snapshot
+
+
+class FakeBlob:
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def upload_from_filename(self, path):
+        with open(path, "rb") as f:
+            self.store[self.name] = f.read()
+
+    def upload_from_string(self, data, content_type=None):
+        self.store[self.name] = data.encode() if isinstance(data, str) else data
+
+    def download_as_text(self):
+        return self.store[self.name].decode()
+
+    def download_to_filename(self, path):
+        with open(path, "wb") as f:
+            f.write(self.store[self.name])
+
+
+class FakeBucket:
+    def __init__(self):
+        self.store = {}
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self.store, name)
+
+
+def _make_db(path, content="v1"):
+    os.makedirs(os.path.join(path, "segment"), exist_ok=True)
+    with open(os.path.join(path, "chroma.sqlite3"), "w") as f:
+        f.write(content)
+    with open(os.path.join(path, "segment", "data_level0.bin"), "w") as f:
+        f.write(content * 10)
+
+
+class TestSnapshot:
+
+    def test_create_publishes_archive_manifest_and_latest(self, tmp_path):
+        bucket = FakeBucket()
+        _make_db(tmp_path / "db")
+
+        manifest = snapshot.create_snapshot(
+            str(tmp_path / "db"), bucket, prefix="snaps/", version="v1", metadata={"n": 3}
+        )
+
+        assert set(bucket.store) == {"snaps/v1/snapshot.tar.gz", "snaps/v1/manifest.json", "snaps/LATEST"}
+        assert bucket.store["snaps/LATEST"] == b"v1"
+        stored = json.loads(bucket.store["snaps/v1/manifest.json"])
+        assert stored == manifest
+        assert stored["n"] == 3 and stored["archive_bytes"] == len(bucket.store["snaps/v1/snapshot.tar.gz"])
+
+    def test_restore_latest_replaces_previous_snapshot_and_skips_same_version(self, tmp_path):
+        bucket = FakeBucket()
+        _make_db(tmp_path / "v1", "v1")
+        _make_db(tmp_path / "v2", "v2")
+        snapshot.create_snapshot(str(tmp_path / "v1"), bucket, prefix="snaps", version="v1")
+        dest = tmp_path / "dest"
+
+        assert snapshot.restore_snapshot(bucket, str(dest), prefix="snaps")["version"] == "v1"
+        assert (dest / "chroma.sqlite3").read_text() == "v1"
+
+        snapshot.create_snapshot(str(tmp_path / "v2"), bucket, prefix="snaps", version="v2")
+        assert snapshot.restore_snapshot(bucket, str(dest), prefix="snaps")["version"] == "v2"
+        assert (dest / "segment" / "data_level0.bin").read_text() == "v2" * 10
+        assert sorted(os.listdir(dest)) == [snapshot.MARKER_NAME, "chroma.sqlite3", "segment"]
+
+        assert snapshot.restore_snapshot(bucket, str(dest), prefix="snaps") is None
+
+    def test_restore_keeps_database_not_from_snapshot_unless_forced(self, tmp_path):
+        bucket = FakeBucket()
+        _make_db(tmp_path / "src", "snap")
+        snapshot.create_snapshot(str(tmp_path / "src"), bucket, prefix="snaps", version="v1")
+        _make_db(tmp_path / "dest", "live")
+
+        assert snapshot.restore_snapshot(bucket, str(tmp_path / "dest"), prefix="snaps") is None
+        assert (tmp_path / "dest" / "chroma.sqlite3").read_text() == "live"
+
+        snapshot.restore_snapshot(bucket, str(tmp_path / "dest"), prefix="snaps", force=True)
+        assert (tmp_path / "dest" / "chroma.sqlite3").read_text() == "snap"
+
+    def test_restore_rejects_corrupt_archive(self, tmp_path):
+        bucket = FakeBucket()
+        _make_db(tmp_path / "src")
+        snapshot.create_snapshot(str(tmp_path / "src"), bucket, prefix="snaps", version="v1")
+        bucket.store["snaps/v1/snapshot.tar.gz"] += b"garbage"
+
+        with pytest.raises(ValueError, match="Checksum mismatch"):
+            snapshot.restore_snapshot(bucket, str(tmp_path / "dest"), prefix="snaps")
+        assert os.listdir(tmp_path / "dest") == []
@@ -2,14 +2,54 @@
 Unit tests for Utilities functions
 """
 
+import importlib.util
+import inspect
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
 import pytest
 from unittest.mock import patch, MagicMock
 
-from models.src.chunker import chunk_abstracts
-from models.src.embedder import _get_client, embed_texts, embed_chunk_lists
-from models.src.gcs import read_parquet_from_gcs
+from google.genai import errors
 
+from models.src.backup_format import ParquetBackupWriter, iter_backup_parquet, write_backup_parquet
+from models.src.backup_sink import RollingBackupSink
+from models.src.chunker import ChunkLengthStats, chunk_abstracts, chunk_spans, estimate_tokens
+from models.src.dedup import ChunkDeduplicator, MinHashLSH, apply_duplicate_updates
+from models.src.embedder import (
+    RateLimiter,
+    RegionPool,
+    VertexBackend,
+    _get_client,
+    _request_batches,
+    embed_chunk_lists,
+    embed_texts,
+    embedding_metrics,
+)
+from models.src import embedding_backends
+from models.src.embedding_backends import (
+    EmbeddingBackend,
+    HashingBackend,
+    create_backend,
+    get_local_backend,
+    hash_embed,
+)
+from models.src.fingerprints import FingerprintIndex, row_fingerprints
+from models.src.gcs import (
+    BackupUnit,
+    assign_backup_units,
+    plan_backup_units,
+    read_parquet_from_gcs,
+    stream_backup_from_gcs,
+    stream_backup_units,
+)
+from models.src.journal import RunJournal
+from models.src.metrics import Histogram, MetricsRegistry, dump_summary
+from models.src.pipeline import PipelineError, Stage, run_pipeline
+from models.src.uploader import ChromaUploader, is_transient_error, server_max_batch_size
 
 # ----------------------------------------------------------------------
 # GCS tests
@@ -80,6 +120,90 @@ class TestUtils:
         with pytest.raises(KeyError):
             chunk_abstracts(df, chunk_size=50, chunk_overlap=5, parallel=False)
 
+    def test_chunk_spans_match_splitter_output(self):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        texts = [
+            "  Short one.  ",
+            "Background: " + "word " * 120,
+            "Para one.\n\n" + "Methods were applied. " * 20 + "\nResults follow. " * 10,
+            None,
+            "   ",
+            "x" * 120,
+        ]
+        splitter = RecursiveCharacterTextSplitter(chunk_size=50, chunk_overlap=5)
+        expected = [splitter.split_text(t) if isinstance(t, str) and t.strip() else [] for t in texts]
+
+        spans = chunk_spans(texts, chunk_size=50, chunk_overlap=5, parallel=False)
+
+        assert spans.chunk_lists() == expected
+        assert spans.counts_per_row().tolist() == [len(chunks) for chunks in expected]
+        assert spans.chunk_map()[:3] == [(0, 0), (1, 0), (1, 1)]
+
+    def test_chunk_spans_short_texts_skip_the_splitter(self):
+        texts = ["Short abstract.", "Another one."]
+        with patch("models.src.chunker.RecursiveCharacterTextSplitter.split_text") as split_text:
+            spans = chunk_spans(texts, chunk_size=50, chunk_overlap=5, parallel=True)
+        split_text.assert_not_called()
+        assert spans.texts() == texts
+        assert spans.starts.dtype.kind == "i"
+
+    def test_chunk_spans_without_rows_keeps_other_chunk_indices(self):
+        texts = ["a " * 40, "b " * 40, "c"]
+        spans = chunk_spans(texts, chunk_size=30, chunk_overlap=0, parallel=False)
+
+        kept = spans.without_rows([True, False, False])
+
+        assert set(kept.rows.tolist()) == {1, 2}
+        assert kept.chunk_map()[0] == (1, 0)
+        assert kept.texts()[-1] == "c"
+
+    def test_estimate_tokens_counts_word_pieces_and_punctuation(self):
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("Patients were randomized.") == 2 + 1 + 2 + 1
+        assert estimate_tokens("hydroxychloroquine 25mg") == 3 + 1 + 1
+        assert estimate_tokens("a  b\n\n") == 2
+
+    def test_token_chunks_respect_budget_and_merge_small_neighbours(self):
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+        text = "Sentence number one is here. " * 30 + "\n\nTail."
+        splitter = RecursiveCharacterTextSplitter(chunk_size=40, chunk_overlap=8, length_function=estimate_tokens)
+        spans = chunk_spans([text], chunk_size=40, chunk_overlap=8, parallel=False, length_function=estimate_tokens)
+        merged = chunk_spans(
+            [text], chunk_size=40, chunk_overlap=8, parallel=False, length_function=estimate_tokens, min_chunk_size=10
+        )
+
+        # Repeated sentences must not send str.find back to an earlier occurrence.
+        assert spans.texts() == splitter.split_text(text)
+        assert (spans.starts[1:] > spans.starts[:-1]).all()
+        assert all(estimate_tokens(chunk) <= 40 for chunk in merged.texts())
+        assert spans.texts()[-1] == "Tail."
+        assert not merged.texts()[-1].startswith("Tail")
+        assert len(merged) == len(spans) - 1
+        assert merged.lengths(estimate_tokens).min() >= 10
+
+    def test_chunk_length_stats_accumulates_distribution(self):
+        stats = ChunkLengthStats(unit="tokens")
+        stats.add([10, 20])
+        stats.add([30, 40, 50])
+
+        summary = stats.summary()
+
+        assert summary["chunks"] == 5
+        assert summary["mean"] == 30
+        assert (summary["min"], summary["p50"], summary["max"]) == (10, 30, 50)
+        assert ChunkLengthStats().summary() == {"chunks": 0}
+
+    def test_chunk_spans_uses_pool_only_above_threshold(self):
+        texts = ["Long. " * 50] * 3
+        with patch("models.src.chunker.Pool") as pool:
+            chunk_spans(texts, chunk_size=50, chunk_overlap=5, parallel=True, pool_min_rows=4)
+        pool.assert_not_called()
+
+        spans = chunk_spans(texts, chunk_size=50, chunk_overlap=5, parallel=True, pool_min_rows=2)
+        assert spans.chunk_lists() == chunk_spans(texts, chunk_size=50, chunk_overlap=5, parallel=False).chunk_lists()
+
 
 # ----------------------------------------------------------------------
 # Embedder tests
@@ -115,6 +239,33 @@ def test_embed_texts(MockGetClient):
     assert len(embs) == 3
 
 
+@patch("models.src.embedder._get_client")
+def test_embed_texts_splits_payload_into_vertex_sized_requests(MockGetClient):
+    fake_client = MagicMock()
+    fake_client.models.embed_content.side_effect = lambda model, contents, config: MagicMock(
+        embeddings=[MagicMock(values=[float(text)]) for text in contents]
+    )
+    MockGetClient.return_value = fake_client
+
+    with patch("models.src.embedder._backend", VertexBackend()):
+        embs = embed_texts([str(i) for i in range(600)])
+
+    sizes = [len(call.kwargs["contents"]) for call in fake_client.models.embed_content.call_args_list]
+    assert sizes == [250, 250, 100]
+    assert [vector[0] for vector in embs] == [float(i) for i in range(600)]
+
+
+def test_request_batches_respect_token_limit():
+    texts = ["word " * 40] * 10
+
+    batches = _request_batches(texts, max_texts=250, max_tokens=100)
+
+    assert [len(batch) for batch in batches] == [2] * 5
+    assert _request_batches(["one very long text " * 100], max_texts=250, max_tokens=10) == [
+        ["one very long text " * 100]
+    ]
+
+
 def test_embed_texts_empty():
     assert embed_texts(["", " ", None]) == []
 
@@ -143,3 +294,779 @@ def test_embed_chunk_lists(MockGetClient):
     ]
     result = embed_chunk_lists(chunk_lists, batch_size=3)
     assert len(result) == 4
+
+
+def test_rate_limiter_allows_burst_then_waits():
+    clock = {"now": 0.0}
+
+    def fake_sleep(seconds):
+        clock["now"] += seconds
+
+    with (
+        patch("models.src.embedder.time.monotonic", side_effect=lambda: clock["now"]),
+        patch("models.src.embedder.time.sleep", side_effect=fake_sleep),
+    ):
+        limiter = RateLimiter(rate=2.0, capacity=2)
+        assert limiter.acquire() == 0.0
+        assert limiter.acquire() == 0.0
+        assert limiter.acquire() == pytest.approx(0.5)
+        clock["now"] += 10  # idle time refills the bucket only up to its capacity
+        assert [limiter.acquire() for _ in range(3)] == pytest.approx([0.0, 0.0, 0.5])
+
+
+def test_rate_limiter_disabled_never_waits():
+    limiter = RateLimiter(rate=0)
+    with patch("models.src.embedder.time.sleep") as sleep:
+        for _ in range(10):
+            assert limiter.acquire() == 0.0
+    sleep.assert_not_called()
+
+
+def test_region_pool_prefers_region_with_spare_capacity():
+    pool = RegionPool(["us-central1", "other-project/europe-west4"], requests_per_minute=60)
+    busy, spare = pool.regions
+    assert (spare.project, spare.location) == ("other-project", "europe-west4")
+
+    busy.limiter.acquire()  # drain the first region's one-request burst
+    assert pool.acquire() is spare
+
+
+def test_embed_texts_fails_over_to_another_region_on_quota_errors():
+    pool = RegionPool(["us-central1", "europe-west4"], requests_per_minute=0)
+    clients = {spec: MagicMock() for spec in ("us-central1", "europe-west4")}
+    clients["us-central1"].models.embed_content.side_effect = errors.ClientError(
+        429, {"error": {"code": 429, "message": "Quota exceeded", "status": "RESOURCE_EXHAUSTED"}}
+    )
+    clients["europe-west4"].models.embed_content.return_value.embeddings = [MagicMock(values=[0.5] * 4)]
+
+    with (
+        patch("models.src.embedder._regions", pool),
+        patch("models.src.embedder._get_client", side_effect=lambda spec: clients[spec]),
+        patch("models.src.embedder.time.sleep") as sleep,
+    ):
+        assert embed_texts(["A"], retry_delay=30.0) == [[0.5] * 4]
+        assert embed_texts(["B"], retry_delay=30.0) == [[0.5] * 4]
+
+    sleep.assert_not_called()
+    assert clients["us-central1"].models.embed_content.call_count == 1  # cooled down after the 429
+    assert clients["europe-west4"].models.embed_content.call_count == 2
+    assert all(region.in_flight == 0 for region in pool.regions)
+
+
+def test_embed_texts_releases_the_region_on_non_api_errors():
+    pool = RegionPool(["us-central1"], requests_per_minute=0)
+    client = MagicMock()
+    client.models.embed_content.side_effect = TimeoutError("read timed out")
+
+    with (
+        patch("models.src.embedder._regions", pool),
+        patch("models.src.embedder._get_client", return_value=client),
+    ):
+        with pytest.raises(TimeoutError):
+            embed_texts(["A"])
+
+    assert pool.regions[0].in_flight == 0
+
+
+def test_hashing_backend_is_deterministic_normalised_and_lexical():
+    backend = create_backend("hash")
+    assert isinstance(backend, HashingBackend)
+    texts = ["Aspirin lowers stroke risk", "aspirin lowers the risk of stroke", "Statins and liver enzymes"]
+    first = np.array(backend.embed(texts, 256))
+    second = np.array(create_backend("hash").embed(texts, 256))
+
+    assert first.shape == (3, 256)
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_allclose(np.linalg.norm(first, axis=1), 1.0, rtol=1e-6)
+    assert first[0] @ first[1] > first[0] @ first[2]
+
+
+def _llm_api_embeddings():
+    path = Path(__file__).resolve().parents[3] / "llm-api" / "api" / "embeddings.py"
+    spec = importlib.util.spec_from_file_location("llm_api_embeddings", path)
+    module = importlib.util.module_from_spec(spec)
+    # registered so ``inspect`` can find the source of its classes
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_local_backends_match_the_llm_api_copy():
+    # The API embeds queries with its own copy of the backends; a drift would silently break offline retrieval.
+    api_embeddings = _llm_api_embeddings()
+    names = ["EmbeddingBackend", "hashed_ngram_features", "hash_embed", "HashingBackend", "OnnxBackend"]
+    for name in names + ["create_backend", "get_local_backend"]:
+        assert inspect.getsource(getattr(api_embeddings, name)) == inspect.getsource(
+            getattr(embedding_backends, name)
+        ), name
+    assert list(api_embeddings.LOCAL_BACKENDS) == list(embedding_backends.LOCAL_BACKENDS)
+
+    texts = ["Aspirin lowers stroke risk", "", "COVID-19 mRNA vaccine efficacy (95%) in adults >65", "ünïcode tèxt"]
+    for dimensionality in (7, 256, 768):
+        np.testing.assert_array_equal(
+            api_embeddings.hash_embed(texts, dimensionality), hash_embed(texts, dimensionality)
+        )
+        assert api_embeddings.HashingBackend().embed(texts, dimensionality) == HashingBackend().embed(
+            texts, dimensionality
+        )
+
+    # ONNX pooling with a stand-in tokenizer and session, so no model or onnxruntime is needed
+    rng = np.random.default_rng(0)
+    hidden = rng.normal(size=(2, 5, 32)).astype(np.float32)
+    encodings = [
+        MagicMock(ids=[1, 2, 3, 0, 0], attention_mask=[1, 1, 1, 0, 0], type_ids=[0] * 5),
+        MagicMock(ids=[4, 5, 6, 7, 8], attention_mask=[1] * 5, type_ids=[0] * 5),
+    ]
+    vectors = []
+    for module in (api_embeddings, embedding_backends):
+        backend = module.OnnxBackend.__new__(module.OnnxBackend)
+        backend.tokenizer = MagicMock(encode_batch=MagicMock(return_value=encodings))
+        backend.session = MagicMock(run=MagicMock(return_value=[hidden]))
+        backend._input_names = {"input_ids", "attention_mask"}
+        vectors.append(backend.embed(["a b c", "d e f g h"], 16))
+    assert vectors[0] == vectors[1]
+
+
+def test_get_local_backend_is_created_once_per_process():
+    with patch.dict(embedding_backends._backends, clear=True):
+        assert get_local_backend("hash") is get_local_backend("hash")
+
+
+def test_embedding_backend_requires_embed():
+    class Incomplete(EmbeddingBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_embed_texts_uses_selected_backend_without_vertex():
+    with (
+        patch("models.src.embedder._backend", HashingBackend()),
+        patch("models.src.embedder._get_client", side_effect=AssertionError("Vertex must not be called")),
+    ):
+        embeddings = embed_texts(["A", "", "B"], dimensionality=32)
+    assert len(embeddings) == 2 and all(len(vector) == 32 for vector in embeddings)
+
+
+def test_create_backend_rejects_unknown_name():
+    with pytest.raises(ValueError, match="Unknown embedding backend"):
+        create_backend("word2vec")
+
+
+# ----------------------------------------------------------------------
+# Metrics tests
+# ----------------------------------------------------------------------
+
+
+def test_histogram_quantiles_are_bucket_bounds_capped_at_max():
+    histogram = Histogram(buckets=(1, 10, 100))
+    for value in [0.5, 3, 4, 5, 7, 8, 9, 20, 50, 70]:
+        histogram.observe(value)
+
+    summary = histogram.as_dict()
+    assert summary["count"] == 10 and summary["max"] == 70
+    assert summary["buckets"] == {"le_1": 1, "le_10": 6, "le_100": 3}
+    assert summary["p50"] == 10
+    assert summary["p99"] == 70
+
+
+def test_embed_texts_records_request_metrics_and_summary_is_written(tmp_path, capsys):
+    metrics = MetricsRegistry()
+    with (
+        patch("models.src.embedder.registry", metrics),
+        patch("models.src.embedder._backend", HashingBackend()),
+    ):
+        embed_texts(["Aspirin lowers stroke risk.", " ", "Statins."], dimensionality=8)
+        embed_texts(["Metformin and weight."], dimensionality=8)
+        derived = embedding_metrics()
+
+    counters = metrics.summary()["counters"]
+    assert counters["embed.calls"] == 2 and counters["embed.texts"] == 3
+    assert counters["embed.tokens"] > 0
+    assert metrics.histogram("embed.batch_texts").counts[:2] == [1, 1]  # one call of 1 text, one of 2
+    assert derived["backend"] == "hash" and derived["texts_per_request"] == 1.5
+
+    path = tmp_path / "metrics" / "summary.json"
+    dump_summary("Test metrics", extra={"embedding": derived}, path=str(path), metrics=metrics)
+
+    written = json.loads(path.read_text())
+    assert written["counters"]["embed.calls"] == 2
+    assert written["embedding"]["texts_per_request"] == 1.5
+    assert "Test metrics:" in capsys.readouterr().out
+
+
+# ----------------------------------------------------------------------
+# Near-duplicate detection tests
+# ----------------------------------------------------------------------
+
+ABSTRACT = (
+    "Background: hydroxychloroquine was evaluated in hospitalized adults with covid-19 pneumonia. "
+    "Methods: patients were randomized to treatment or placebo and followed for twenty eight days. "
+    "Results: mortality did not differ between the groups and adverse events were more common."
+)
+
+
+def test_minhash_estimates_similarity_of_near_duplicates():
+    lsh = MinHashLSH()
+    edited = ABSTRACT.replace("twenty eight", "28")
+    signatures = lsh.signatures([ABSTRACT, edited, "An unrelated abstract about sleep and cognition.", ""])
+
+    assert signatures.shape == (4, lsh.num_perm)
+    assert np.mean(signatures[0] == signatures[1]) > 0.7
+    assert np.mean(signatures[0] == signatures[2]) < 0.2
+    assert lsh.query_or_add(signatures[0]) is None
+    assert lsh.query_or_add(signatures[0]) == 0
+    assert lsh.query_or_add(signatures[2]) is None
+
+
+def test_chunk_deduplicator_keeps_canonical_and_tracks_late_duplicates():
+    dedup = ChunkDeduplicator()
+
+    keep = dedup.filter(["1-0", "2-0", "1-1"], ["1", "2", "1"], [ABSTRACT, ABSTRACT + " ", ABSTRACT])
+    # a reprint in another article is dropped; the same passage repeated in one article is kept
+    assert keep.tolist() == [True, False, True]
+    assert dedup.duplicate_pmids_for("1-0") == "2"
+    assert dedup.pending_updates() == {}
+
+    assert dedup.filter(["3-0"], ["3"], [ABSTRACT.upper()]).tolist() == [False]
+    assert dedup.pending_updates() == {"1-0": "2,3"}
+
+    collection = MagicMock()
+    assert apply_duplicate_updates(collection, dedup) == 1
+    collection.update.assert_called_once_with(ids=["1-0"], metadatas=[{"duplicate_pmids": "2,3"}])
+
+
+def test_chunk_deduplicator_persists_state_and_requeues_orphaned_duplicates(tmp_path):
+    path = str(tmp_path / "dedup.sqlite3")
+    first = ChunkDeduplicator(path=path)
+    first.filter(["1-0", "2-0", "4-0"], ["1", "2", "4"], [ABSTRACT, ABSTRACT + " ", "Sleep and cognition study."])
+    assert first.duplicate_pmids_for("1-0") == "2"
+    first.close()
+
+    second = ChunkDeduplicator(path=path)
+    # chunks of earlier runs are canonical and already written
+    assert second.filter(["3-0"], ["3"], [ABSTRACT.upper()]).tolist() == [False]
+    assert second.pending_updates() == {"1-0": "2,3"}
+
+    assert second.forget_articles(["1"]) == ["2", "3"]
+    assert second.pending_updates() == {}
+    second.close()
+
+    third = ChunkDeduplicator(path=path)
+    assert third.filter(["2-0"], ["2"], [ABSTRACT]).tolist() == [True]
+    assert third.filter(["5-0"], ["5"], ["Sleep and cognition study."]).tolist() == [False]
+    # forgetting a duplicate takes it off its canonical chunk
+    assert third.forget_articles(["5"]) == []
+    assert third.pending_updates() == {"4-0": ""}
+    third.close()
+
+
+# ----------------------------------------------------------------------
+# Pipeline tests
+# ----------------------------------------------------------------------
+
+
+class TestPipeline:
+
+    def test_run_pipeline_passes_items_through_stages(self):
+        sink = []
+        stages = [
+            Stage("double", lambda x: x * 2, workers=2),
+            Stage("keep_fours", lambda x: None if x % 4 else x),
+            Stage("sink", sink.append),
+        ]
+
+        stats = run_pipeline(range(10), stages, queue_size=1)
+
+        assert sorted(sink) == [0, 4, 8, 12, 16]
+        assert [st.name for st in stats] == ["reader", "double", "keep_fours", "sink"]
+        assert stats[0].batches == 10
+        assert stats[1].batches == 10
+        assert stats[3].batches == 5
+
+    def test_run_pipeline_reports_item_sizes(self):
+        stages = [Stage("sink", lambda batch: None, size=len)]
+
+        stats = run_pipeline([[1, 2], [3]], stages, source_size=len)
+
+        assert stats[0].items == 3
+        assert stats[1].items == 3
+        assert stats[1].as_dict()["stage"] == "sink"
+
+    def test_run_pipeline_propagates_stage_errors(self):
+        def explode(item):
+            if item == 3:
+                raise ValueError("boom")
+            return item
+
+        with pytest.raises(PipelineError) as excinfo:
+            run_pipeline(range(100), [Stage("explode", explode), Stage("sink", lambda x: None)], queue_size=1)
+
+        assert isinstance(excinfo.value.__cause__, ValueError)
+
+
+# ----------------------------------------------------------------------
+# Run journal tests
+# ----------------------------------------------------------------------
+
+
+def test_run_journal_resumes_completed_ranges(tmp_path):
+    path = tmp_path / "journal" / "run.jsonl"
+    journal = RunJournal(str(path))
+    journal.record("blob-a", 0, 100, ["1-0", "2-0"])
+    journal.record("blob-a", 100, 200)
+
+    resumed = RunJournal(str(path))
+
+    assert resumed.entries == 2
+    assert resumed.is_done("blob-a", 0, 100)
+    assert resumed.is_done("blob-a", 50, 150)  # covered by the merged ranges
+    assert not resumed.is_done("blob-a", 150, 250)
+    assert not resumed.is_done("blob-b", 0, 100)
+
+
+def test_run_journal_fresh_and_truncated_lines(tmp_path):
+    path = tmp_path / "run.jsonl"
+    path.write_text('{"source": "blob-a", "row_start": 0, "row_end": 10, "chunk_ids": []}\n{"source": "blo')
+
+    assert RunJournal(str(path)).is_done("blob-a", 0, 10)
+    assert not RunJournal(str(path), fresh=True).is_done("blob-a", 0, 10)
+
+
+def test_fingerprint_index_reports_new_changed_and_unseen_articles(tmp_path):
+    path = str(tmp_path / "fp.sqlite3")
+    df = pd.DataFrame({"pmid": ["1", "2", "3"], "abstract": ["a", "b", "c"], "title": ["x", "y", "z"]})
+    fingerprints = row_fingerprints(df, ["abstract", "title", "missing_column"])
+    index = FingerprintIndex(path)
+    new, changed = index.changes(["1", "2", "3"], fingerprints)
+    assert new.all() and not changed.any()
+    index.commit(["1", "2", "3"], fingerprints)
+    index.close()
+
+    updated = df.assign(title=["x", "y2", "z"]).iloc[:2]
+    index = FingerprintIndex(path)
+    new, changed = index.changes(["1", "2"], row_fingerprints(updated, ["abstract", "title"]))
+    assert new.tolist() == [False, False] and changed.tolist() == [False, True]
+    assert index.unseen() == ["3"]
+    index.remove(["3"])
+    assert len(index) == 2
+
+
+# ----------------------------------------------------------------------
+# Uploader tests
+# ----------------------------------------------------------------------
+
+
+def _records(n):
+    return [
+        {"id": str(i), "document": f"doc {i}", "metadata": {"pmid": str(i)}, "embedding": [0.1, 0.2]} for i in range(n)
+    ]
+
+
+class TestChromaUploader:
+
+    def test_uploads_everything_and_reports_per_submit(self):
+        collection = MagicMock()
+        done = []
+        uploader = ChromaUploader(collection, mode="upsert", workers=3, initial_batch_size=4, retry_delay=0)
+
+        uploader.submit(_records(10), on_done=done.append)
+        uploader.submit(_records(3), on_done=done.append)
+        uploader.close()
+
+        sent = [i for call in collection.upsert.call_args_list for i in call.kwargs["ids"]]
+        assert sorted(sent) == sorted([str(i) for i in range(10)] + ["0", "1", "2"])
+        assert done == [[], []]
+        assert uploader.stats["records"] == 13
+        collection.add.assert_not_called()
+
+    def test_batch_size_grows_when_calls_are_fast_and_respects_caps(self):
+        collection = MagicMock()
+        uploader = ChromaUploader(collection, workers=1, initial_batch_size=2, max_batch_size=16, retry_delay=0)
+
+        for _ in range(10):
+            uploader.submit(_records(uploader.batch_size))
+            uploader.flush()
+        uploader.close()
+
+        assert uploader.batch_size == 16
+
+        capped = ChromaUploader(MagicMock(), workers=1, initial_batch_size=8, max_payload_bytes=200, retry_delay=0)
+        capped.submit(_records(8))
+        capped.close()
+        assert capped.batch_size < 8
+
+    def test_failed_batches_are_bisected_to_isolate_bad_records(self):
+        def upsert(ids, **_kwargs):
+            if "5" in ids:
+                raise ValueError("bad record")
+
+        collection = MagicMock()
+        collection.upsert.side_effect = upsert
+        done = []
+        uploader = ChromaUploader(collection, workers=2, initial_batch_size=8, retries=1, retry_delay=0)
+
+        uploader.submit(_records(8), on_done=done.append)
+        uploader.close()
+
+        assert uploader.failed_ids == ["5"]
+        assert done == [["5"]]
+        assert uploader.stats["records"] == 7
+        assert uploader.stats["bisections"] >= 1
+
+    def test_transient_errors_resend_the_whole_batch_instead_of_bisecting(self):
+        calls = []
+
+        def upsert(ids, **_kwargs):
+            calls.append(list(ids))
+            if len(calls) <= 2:
+                raise ConnectionError("connection reset")
+
+        collection = MagicMock()
+        collection.upsert.side_effect = upsert
+        uploader = ChromaUploader(collection, workers=1, initial_batch_size=8, retries=3, retry_delay=0)
+
+        uploader.submit(_records(8))
+        uploader.close()
+
+        assert calls == [[str(i) for i in range(8)]] * 3
+        assert uploader.failed_ids == []
+        assert uploader.stats["retries"] == 2
+        assert uploader.stats["bisections"] == 0
+
+    def test_unreachable_server_fails_the_batch_after_retries(self):
+        collection = MagicMock()
+        collection.upsert.side_effect = TimeoutError("timed out")
+        done = []
+        uploader = ChromaUploader(collection, workers=1, initial_batch_size=4, retries=2, retry_delay=0)
+
+        uploader.submit(_records(4), on_done=done.append)
+        uploader.close()
+
+        assert collection.upsert.call_count == 3
+        assert uploader.failed_ids == ["0", "1", "2", "3"]
+        assert done == [["0", "1", "2", "3"]]
+        assert uploader.stats["bisections"] == 0
+
+    def test_is_transient_error_classification(self):
+        throttled = Exception("throttled")
+        throttled.response = MagicMock(status_code=429)
+        rejected = Exception("bad request")
+        rejected.response = MagicMock(status_code=400)
+
+        assert is_transient_error(ConnectionError())
+        assert is_transient_error(throttled)
+        assert not is_transient_error(rejected)
+        assert not is_transient_error(ValueError("bad record"))
+
+    def test_server_max_batch_size_fallback(self):
+        client = MagicMock()
+        client.get_max_batch_size.return_value = 41666
+        assert server_max_batch_size(client) == 41666
+
+        client.get_max_batch_size.side_effect = RuntimeError("old server")
+        assert server_max_batch_size(client, default=100) == 100
+
+
+# ----------------------------------------------------------------------
+# Backup format tests
+# ----------------------------------------------------------------------
+
+
+class TestBackupFormat:
+
+    def test_parquet_backup_round_trip(self, tmp_path):
+        records = [
+            {
+                "id": f"{i}-0",
+                "document": f"chunk {i}",
+                "metadata": {"pmid": str(i), "chunk_index": 0, "is_top_journal": "True"},
+                "embedding": [0.25 * i, -0.5, 1.0],
+            }
+            for i in range(5)
+        ]
+        records[3]["metadata"]["chunk_index"] = "not-an-int"  # type drift goes to extra_metadata
+        records[4]["metadata"]["late_key"] = "x"  # keys unseen in the first batch too
+        path = str(tmp_path / "backup.parquet")
+
+        writer = ParquetBackupWriter(path)
+        writer.write(records[:3])
+        writer.write(records[3:])
+        writer.close()
+
+        restored = list(iter_backup_parquet(path, batch_size=2))
+
+        assert writer.record_count == 5
+        assert [r["id"] for r in restored] == [r["id"] for r in records]
+        assert [r["metadata"] for r in restored] == [r["metadata"] for r in records]
+        assert restored[2]["embedding"] == [0.5, -0.5, 1.0]
+        assert restored[0]["document"] == "chunk 0"
+
+    def test_parquet_backup_float16_and_multiple_embeddings(self, tmp_path):
+        records = [
+            {"id": "a", "document": "d", "metadata": {}, "embedding": [0.1] * 4, "embeddings_semantic": [0.5] * 8}
+        ]
+        path = str(tmp_path / "backup.parquet")
+
+        write_backup_parquet(
+            records, path, embedding_keys=("embedding", "embeddings_semantic"), embedding_dtype="float16"
+        )
+        restored = next(iter_backup_parquet(path, memory_map=False))
+
+        assert restored["embeddings_semantic"] == [0.5] * 8
+        assert restored["embedding"] == pytest.approx([0.1] * 4, abs=1e-3)
+        assert restored["metadata"] == {}
+
+    def test_parquet_backup_is_much_smaller_than_jsonl(self, tmp_path):
+        import json
+        import random
+
+        rng = random.Random(0)
+        records = [
+            {
+                "id": f"{i}-0",
+                "document": "Abstract text " * 20,
+                "metadata": {"pmid": str(i), "title": "A title", "chunk_index": 0},
+                "embedding": [rng.uniform(-1, 1) for _ in range(256)],
+            }
+            for i in range(200)
+        ]
+        parquet_path = tmp_path / "backup.parquet"
+        jsonl_path = tmp_path / "backup.jsonl"
+
+        write_backup_parquet(records, str(parquet_path))
+        jsonl_path.write_text("\n".join(json.dumps(r) for r in records))
+
+        assert parquet_path.stat().st_size * 3 < jsonl_path.stat().st_size
+
+    def test_parquet_backup_rejects_wrong_dimension(self, tmp_path):
+        writer = ParquetBackupWriter(str(tmp_path / "backup.parquet"))
+        writer.write([{"id": "a", "document": "d", "metadata": {}, "embedding": [0.1, 0.2]}])
+        with pytest.raises(ValueError):
+            writer.write([{"id": "b", "document": "d", "metadata": {}, "embedding": [0.1, 0.2, 0.3]}])
+        writer.close()
+
+
+class _FakeBucket:
+    name = "bucket"
+
+    def __init__(self):
+        self.uploads = {}
+        self.chunk_sizes = []
+
+    def blob(self, name, chunk_size=None):
+        bucket = self
+        self.chunk_sizes.append(chunk_size)
+
+        class _Blob:
+            def upload_from_filename(self, path):
+                with open(path, "rb") as f:
+                    bucket.uploads[name] = f.read()
+
+            def upload_from_string(self, data, content_type=None):
+                bucket.uploads[name] = data.encode()
+
+        return _Blob()
+
+
+class TestRollingBackupSink:
+
+    def _records(self, start, n):
+        return [
+            {"id": f"{i}-0", "document": "text " * 50, "metadata": {"pmid": str(i)}, "embedding": [0.1 * i] * 16}
+            for i in range(start, start + n)
+        ]
+
+    def test_rolls_parts_and_uploads_them_all(self, tmp_path):
+        bucket = _FakeBucket()
+        sink = RollingBackupSink(bucket, "backups/run/", backup_format="parquet", part_bytes=1)
+
+        sink.write(self._records(0, 3))
+        sink.write(self._records(3, 3))
+        sink.write([])
+        sink.finish()
+
+        assert sorted(bucket.uploads) == ["backups/run/part-00000.parquet", "backups/run/part-00001.parquet"]
+        assert all(size % (256 * 1024) == 0 for size in bucket.chunk_sizes)
+        restored = []
+        for name in sorted(bucket.uploads):
+            path = tmp_path / name.replace("/", "_")
+            path.write_bytes(bucket.uploads[name])
+            restored.extend(record["id"] for record in iter_backup_parquet(str(path)))
+        assert restored == [f"{i}-0" for i in range(6)]
+
+    def test_jsonl_parts_are_gzipped(self):
+        import gzip
+        import json
+
+        bucket = _FakeBucket()
+        sink = RollingBackupSink(bucket, "backups/run", backup_format="jsonl")
+        sink.write(self._records(0, 2))
+        sink.finish()
+
+        (name,) = bucket.uploads
+        assert name == "backups/run/part-00000.jsonl.gz"
+        lines = gzip.decompress(bucket.uploads[name]).decode("utf-8").splitlines()
+        assert [json.loads(line)["id"] for line in lines] == ["0-0", "1-0"]
+
+    def test_tombstones_are_written_next_to_the_parts(self):
+        bucket = _FakeBucket()
+        sink = RollingBackupSink(bucket, "backups/run")
+        sink.write_tombstones([])
+        sink.write_tombstones(["2", "3"])
+        sink.finish()
+        sink.write_tombstones(["4"])
+
+        assert bucket.uploads == {
+            "backups/run/deleted-00000.tombstones.txt": b"2\n3\n",
+            "backups/run/deleted-00001.tombstones.txt": b"4\n",
+        }
+
+    def test_failed_part_upload_raises_on_finish(self):
+        bucket = _FakeBucket()
+        bucket.blob = MagicMock(side_effect=RuntimeError("network down"))
+        sink = RollingBackupSink(bucket, "backups/run", part_bytes=1)
+        sink.write(self._records(0, 1))
+
+        with pytest.raises(RuntimeError, match="network down"):
+            sink.finish()
+
+
+# ----------------------------------------------------------------------
+# Backup streaming tests
+# ----------------------------------------------------------------------
+
+
+class _FakeBackupBlob:
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = payload
+        self.size = len(payload)
+
+    def download_to_filename(self, path, start=None, end=None):
+        with open(path, "wb") as f:
+            f.write(self.payload if start is None else self.payload[start : end + 1])
+
+    def download_as_bytes(self, start=0, end=None):
+        return self.payload[start : None if end is None else end + 1]
+
+
+class TestStreamBackupFromGcs:
+
+    def _blobs(self, tmp_path):
+        import gzip
+        import json
+
+        def jsonl(ids):
+            return "\n".join(json.dumps({"id": i, "document": i, "metadata": {}}) for i in ids).encode()
+
+        parquet_path = tmp_path / "part.parquet"
+        write_backup_parquet(
+            [{"id": "p0", "document": "d", "metadata": {"pmid": "1"}, "embedding": [0.5, 0.25]}], str(parquet_path)
+        )
+        return [
+            _FakeBackupBlob("backups/b/part-00001.jsonl.gz", gzip.compress(jsonl(["g0", "g1"]))),
+            _FakeBackupBlob("backups/a.jsonl", jsonl([f"j{i}" for i in range(5)]) + b"\n\n"),
+            _FakeBackupBlob("backups/notes.txt", b"ignored"),
+            _FakeBackupBlob("backups/b/part-00002.parquet", parquet_path.read_bytes()),
+        ]
+
+    @patch("models.src.gcs.BACKUP_DECODE_BLOCK_LINES", 2)
+    @patch("models.src.gcs.storage.Client")
+    def test_streams_all_formats_in_blob_order(self, mock_client, tmp_path):
+        blobs = self._blobs(tmp_path)
+        mock_client.return_value.bucket.return_value.list_blobs.return_value = blobs
+
+        records = list(stream_backup_from_gcs("bucket", "backups/", prefetch=2, decode_workers=2))
+
+        assert [r["id"] for r in records] == ["j0", "j1", "j2", "j3", "j4", "g0", "g1", "p0"]
+        assert records[-1]["embedding"] == [0.5, 0.25]
+        mock_client.return_value.list_buckets.assert_not_called()
+
+    @patch("models.src.gcs.storage.Client")
+    def test_records_deleted_by_a_later_run_are_left_out(self, mock_client):
+        import json
+
+        def jsonl(records):
+            return "\n".join(json.dumps({"id": i, "document": i, "metadata": {"pmid": p}}) for i, p in records).encode()
+
+        blobs = [
+            _FakeBackupBlob(
+                "backups/c-20250101-000000/part-00000.jsonl", jsonl([("2-0", "2"), ("2-1", "2"), ("3-0", "3")])
+            ),
+            _FakeBackupBlob("backups/c-20250201-000000/part-00000.jsonl", jsonl([("2-0", "2")])),
+            _FakeBackupBlob("backups/c-20250201-000000/deleted-00000.tombstones.txt", b"2\n"),
+            _FakeBackupBlob("backups/c-20250301-000000/deleted-00000.tombstones.txt", b"3\n"),
+        ]
+        mock_client.return_value.bucket.return_value.list_blobs.return_value = blobs
+
+        records = list(stream_backup_from_gcs("bucket", "backups/"))
+
+        # pmid 2 was replaced in February (only its new chunk survives), pmid 3 was pruned in March.
+        assert [(r["id"], r["metadata"]["pmid"]) for r in records] == [("2-0", "2")]
+        assert records[0]["document"] == "2-0"
+
+    @patch("models.src.gcs.storage.Client")
+    def test_early_stop_removes_prefetched_files(self, mock_client, tmp_path):
+        import os
+
+        downloaded = []
+        blobs = self._blobs(tmp_path)
+        for blob in blobs:
+            original = blob.download_to_filename
+
+            def download(path, original=original):
+                downloaded.append(path)
+                original(path)
+
+            blob.download_to_filename = download
+        mock_client.return_value.bucket.return_value.list_blobs.return_value = blobs
+
+        stream = stream_backup_from_gcs("bucket", "backups/", prefetch=2)
+        assert next(stream)["id"] == "j0"
+        stream.close()
+
+        assert downloaded and not any(os.path.exists(path) for path in downloaded)
+
+
+class TestShardedBackupUnits:
+
+    def _jsonl_blob(self, name, count):
+        import json
+
+        lines = [
+            json.dumps({"id": f"{name}-{i}", "document": "x" * (i % 7) * 10, "metadata": {}}) for i in range(count)
+        ]
+        return _FakeBackupBlob(name, ("\n".join(lines) + "\n").encode())
+
+    def test_large_jsonl_blobs_split_on_line_boundaries(self):
+        big = self._jsonl_blob("backups/big.jsonl", 200)
+        small = self._jsonl_blob("backups/small.jsonl", 3)
+        gz = _FakeBackupBlob("backups/part-00000.jsonl.gz", b"x" * 5000)
+        bucket = MagicMock()
+        bucket.list_blobs.return_value = [small, gz, big]
+
+        units = plan_backup_units(bucket, "backups/", split_bytes=1000)
+
+        big_units = [u for u in units if u.name == "backups/big.jsonl"]
+        assert len(big_units) > 5
+        assert big_units[0].start == 0 and big_units[-1].end == big.size
+        assert all(a.end == b.start for a, b in zip(big_units, big_units[1:]))
+        assert all(big.payload[u.start - 1 : u.start] == b"\n" for u in big_units[1:])
+        assert [u.end for u in units if u.name != "backups/big.jsonl"] == [None, None]
+
+        restored = [record["id"] for _, _, record in stream_backup_units(big_units)]
+        assert restored == [f"backups/big.jsonl-{i}" for i in range(200)]
+
+    def test_shards_partition_units_and_balance_bytes(self):
+        blobs = [_FakeBackupBlob(f"b{i}.parquet", b"x" * size) for i, size in enumerate([90, 50, 40, 30, 30, 10])]
+        units = [BackupUnit(blob) for blob in blobs]
+
+        shards = [assign_backup_units(units, index, 2) for index in range(2)]
+
+        assert sorted(u.key for shard in shards for u in shard) == sorted(u.key for u in units)
+        assert [sum(u.size for u in shard) for shard in shards] == [130, 120]
+        assert assign_backup_units(units, 1, 2) == shards[1]
+        with pytest.raises(ValueError):
+            assign_backup_units(units, 2, 2)